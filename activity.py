@@ -0,0 +1,143 @@
+'''
+Created on Oct 19, 2026
+Remembers which players have used their sheets recently, so that after a
+restart their sheets can be loaded into the cache before they ask for them,
+rather than every player's first command going to the database at once.
+
+Like the roll history, the log never touches the database while a command
+is being handled. Each use is noted in memory, and a background task writes
+the last time each player was seen every minute. Once the bot is ready, the
+players seen in the last day are read back and their sheets fetched with a
+few find_many queries per server, a handful at a time, while the bot goes
+on answering commands. A player playing another of their characters has
+that character's sheet fetched too.
+
+Classes
+-------
+ActivityLog
+    Records recently active players and warms the sheet cache from them
+'''
+import asyncio, threading, time
+from storage import get_storage
+
+class ActivityLog():
+    '''
+    Records the last time each player used their sheet on each server.
+
+    Attributes
+    ----------
+    seen : dic
+        the time each (server id, user id) was last seen since the last flush
+    flush_interval : int
+        the number of seconds between flushes
+    keep_days : int
+        the number of days a player is remembered after they were last seen
+    warm_hours : int
+        how recently a player must have been seen for their sheet to be
+        loaded at startup
+    batch_size : int
+        the most sheets fetched by a single query while warming up
+    concurrency : int
+        the most queries run at once while warming up
+
+    Methods
+    -------
+    record
+        Notes that a player used their sheet. Never touches the database
+    start
+        Starts the background flushing task and the warm-up on the given
+        event loop
+    flush
+        Writes the players seen since the last flush
+    warm
+        Loads the sheets of recently active players into the cache
+    '''
+
+    def __init__(self, flush_interval=60, keep_days=7, warm_hours=24, batch_size=100, concurrency=4):
+        self.seen = {}
+        self.lock = threading.Lock() #players are recorded from executor threads too
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.warm_hours = warm_hours
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.task = None
+        self.warmed = 0
+
+    def record(self, server_id, user_id):
+        with self.lock:
+            self.seen[(str(server_id), user_id)] = time.time()
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.flush_loop(loop))
+            loop.create_task(self.warm(loop))
+
+    async def flush_loop(self, loop):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                print("Unable to flush player activity: {}".format(str(e)))
+
+    def flush(self):
+        '''Writes the last time each player was seen since the last flush, and
+        forgets players not seen for keep_days. Players that could not be
+        written are kept for the next flush.
+        '''
+        with self.lock:
+            seen = self.seen
+            self.seen = {}
+        if len(seen) == 0:
+            return 0
+        try:
+            get_storage().record_activity([(x[0], x[1], seen[x]) for x in seen], self.keep_days)
+        except Exception:
+            with self.lock:
+                for player in seen:
+                    self.seen.setdefault(player, seen[player])
+            raise
+        return len(seen)
+
+    async def warm(self, loop):
+        '''Fetches the sheets of the players seen in the last warm_hours, most
+        recent first and no more than the cache holds, with at most
+        concurrency queries of batch_size sheets in flight, followed by the
+        characters they are playing when that is not their first. Sheets
+        already cached are not fetched again. Returns the number of sheets
+        loaded.
+        '''
+        storage = get_storage()
+        started = time.perf_counter()
+        try:
+            players = await loop.run_in_executor(None, storage.recent_activity, time.time() - self.warm_hours * 3600, storage.cache.size)
+        except Exception as e:
+            print("Unable to read player activity: {}".format(str(e)))
+            return 0
+        servers = {}
+        for server_id, user_id in players:
+            servers.setdefault(server_id, []).append(user_id)
+        batches = []
+        for server_id in servers:
+            users = servers[server_id]
+            for i in range(0, len(users), self.batch_size):
+                batches.append((server_id, users[i:i + self.batch_size]))
+        limit = asyncio.Semaphore(self.concurrency)
+        async def fetch(server_id, users):
+            async with limit:
+                try:
+                    sheets = await loop.run_in_executor(None, storage.find_many, server_id, users)
+                    active = [x['active'] for x in sheets if x.get('active') is not None]
+                    if len(active) > 0:
+                        sheets += await loop.run_in_executor(None, storage.find_many, server_id, active)
+                    return len(sheets)
+                except Exception as e:
+                    print("Unable to warm the cache for server {}: {}".format(server_id, str(e)))
+                    return 0
+        loaded = await asyncio.gather(*[fetch(x, y) for x, y in batches])
+        self.warmed = sum(loaded)
+        print("Warmed the cache with {} sheets from {} servers in {:.2f}s".format(str(self.warmed), str(len(servers)), time.perf_counter() - started))
+        return self.warmed
+
+activity = ActivityLog()
\ No newline at end of file
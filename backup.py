@@ -0,0 +1,194 @@
+'''
+Created on Oct 19, 2026
+Backs up and restores character sheets. Run it with the same .env file as
+the bot:
+
+    python backup.py backup [--full] [--compress gzip|zstd] [--chunk-size N]
+    python backup.py restore [--guild ID] [--backup NAME] [--workers N]
+
+Each backup is a directory under BACKUP_PATH (defaults to backups), named
+after the time it was taken. The first backup, or one taken with --full,
+holds every sheet. Later backups only hold the sheets written since the
+previous one, found by the modified time the storage backend stamps on
+every sheet. Sheets are kept in the compact form they are stored in, as
+compressed JSON Lines files of at most --chunk-size sheets each. zstd
+compression needs the zstandard package, gzip needs nothing extra.
+
+Every backup also lists the users with a sheet on each server, so that a
+restore deletes sheets that were deleted before the backup was taken. A
+restore replays the latest full backup and every backup taken after it, up
+to the one named by --backup, oldest first. Servers are restored in
+parallel, one per worker thread, and --guild restores just one.
+
+Methods
+-------
+open_chunk
+    Opens a compressed chunk of sheets for reading or writing
+backup_sets
+    Returns every complete backup, oldest first
+take_backup
+    Writes the sheets changed since the last backup
+restore
+    Restores every server, or one, from the backups
+'''
+import argparse, gzip, io, json, os, time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+load_dotenv()
+from storage import get_storage
+
+manifest_name = 'manifest.json'
+extensions = {'gzip' : '.jsonl.gz', 'zstd' : '.jsonl.zst'}
+clock_skew = 60 #seconds of overlap between backups, in case the bot's clock and this one disagree
+
+def open_chunk(path, mode):
+    '''Opens a chunk as text, compressed according to its extension. mode is
+    'r' or 'w'.
+    '''
+    if path.endswith(extensions['zstd']):
+        import zstandard #only needed for zstd backups
+        raw = open(path, mode + 'b')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(raw)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return gzip.open(path, mode + 't', encoding='utf-8')
+
+def backup_sets(directory):
+    '''Returns (name, manifest) for every complete backup in directory,
+    oldest first. Backups that were interrupted have no manifest and are
+    ignored.
+    '''
+    sets = []
+    if not os.path.isdir(directory):
+        return sets
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name, manifest_name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                sets.append((name, json.load(f)))
+    return sets
+
+def take_backup(storage, directory, full=False, compression='gzip', chunk_size=5000):
+    '''Writes a backup of every sheet changed since the last backup, or of
+    every sheet if full or if there is no earlier backup. Returns the name
+    and manifest of the new backup.
+    '''
+    started = time.time()
+    since = None
+    previous = backup_sets(directory)
+    if not full and len(previous) > 0:
+        since = previous[-1][1]['started'] - clock_skew
+    name = time.strftime('%Y%m%d-%H%M%S', time.gmtime(started))
+    partial = os.path.join(directory, name + '.partial')
+    os.makedirs(partial)
+    manifest = {'started' : started, 'since' : since, 'full' : since is None, 'compression' : compression, 'servers' : {}}
+    for server_id in storage.sheet_servers():
+        chunks = []
+        count = 0
+        out = None
+        for doc in storage.changed_sheets(server_id, since):
+            if out is None or count % chunk_size == 0:
+                if out is not None:
+                    out.close()
+                chunks.append('{}-{}{}'.format(server_id, str(len(chunks)), extensions[compression]))
+                out = open_chunk(os.path.join(partial, chunks[-1]), 'w')
+            out.write(json.dumps(doc, separators=(',', ':')) + '\n')
+            count += 1
+        if out is not None:
+            out.close()
+        manifest['servers'][str(server_id)] = {'chunks' : chunks, 'count' : count, 'users' : storage.sheet_users(server_id)}
+    with open(os.path.join(partial, manifest_name), 'w') as f:
+        json.dump(manifest, f)
+    os.rename(partial, os.path.join(directory, name)) #only now does the backup count as complete
+    return name, manifest
+
+def restore_chain(directory, until=None):
+    '''Returns the backups needed to restore the state at backup until, or
+    at the latest backup: the last full backup before it and every backup
+    from there on.
+    '''
+    sets = backup_sets(directory)
+    if until is not None:
+        names = [x[0] for x in sets]
+        if until not in names:
+            raise ValueError('No complete backup named {}'.format(until))
+        sets = sets[:names.index(until) + 1]
+    start = None
+    for i, (name, manifest) in enumerate(sets):
+        if manifest['full']:
+            start = i
+    if start is None:
+        raise ValueError('No full backup to restore from')
+    return sets[start:]
+
+def restore_server(storage, directory, chain, server_id, batch_size=500):
+    '''Replays one server's sheets from a chain of backups, then deletes any
+    sheet that did not exist when the last one was taken. Returns the number
+    of sheets written and deleted.
+    '''
+    written = 0
+    for name, manifest in chain:
+        for chunk in manifest['servers'].get(server_id, {}).get('chunks', []):
+            batch = []
+            with open_chunk(os.path.join(directory, name, chunk), 'r') as f:
+                for line in f:
+                    batch.append(json.loads(line))
+                    if len(batch) >= batch_size:
+                        storage.restore_sheets(server_id, batch)
+                        written += len(batch)
+                        batch = []
+            if len(batch) > 0:
+                storage.restore_sheets(server_id, batch)
+                written += len(batch)
+    users = chain[-1][1]['servers'].get(server_id, {}).get('users', [])
+    return written, storage.prune_sheets(server_id, users)
+
+def restore(storage, directory, guild_id=None, until=None, workers=4):
+    '''Restores every server found in the chain of backups, or only
+    guild_id, with up to workers servers restored at once. Yields the server
+    id and the number of sheets written and deleted as each finishes.
+    '''
+    chain = restore_chain(directory, until)
+    if guild_id is not None:
+        servers = [str(guild_id)]
+    else:
+        servers = sorted(set([x for _, manifest in chain for x in manifest['servers']]))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(x, pool.submit(restore_server, storage, directory, chain, x)) for x in servers]
+        for server_id, future in futures:
+            written, deleted = future.result()
+            yield server_id, written, deleted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backs up and restores character sheets.')
+    parser.add_argument('action', choices=['backup', 'restore'])
+    parser.add_argument('--dir', default=os.environ.get('BACKUP_PATH', 'backups'), help='the directory backups are kept in')
+    parser.add_argument('--full', action='store_true', help='back up every sheet, not just those changed since the last backup')
+    parser.add_argument('--compress', choices=list(extensions), default='gzip', help='the compression used for new backups')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='the number of sheets in each file of a backup')
+    parser.add_argument('--guild', help='the id of the only server to restore')
+    parser.add_argument('--backup', help='the name of the backup to restore, instead of the latest')
+    parser.add_argument('--workers', type=int, default=4, help='the number of servers restored at once')
+    options = parser.parse_args()
+    if options.compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            parser.error('zstd compression needs the zstandard package')
+    storage = get_storage()
+    if options.action == 'backup':
+        name, manifest = take_backup(storage, options.dir, options.full, options.compress, options.chunk_size)
+        total = sum([x['count'] for x in manifest['servers'].values()])
+        kind = 'Full' if manifest['full'] else 'Incremental'
+        print('{} backup {} complete. {} sheets written.'.format(kind, name, str(total)))
+    else:
+        try:
+            total = 0
+            for server_id, written, deleted in restore(storage, options.dir, options.guild, options.backup, options.workers):
+                total += written
+                print('Server {}: {} sheets restored, {} deleted'.format(server_id, str(written), str(deleted)))
+            print('Restore complete. {} sheets restored.'.format(str(total)))
+        except ValueError as e:
+            print(str(e))
\ No newline at end of file
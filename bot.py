@@ -2,19 +2,65 @@
 Created on Jun 16, 2021
 
 @author: Fred
+
+The commands are loaded as a discord.py extension, so they can be reloaded
+with !reload while the bot stays connected. The time taken by each stage of
+startup is printed once the bot is ready.
+
+Setting LOW_MEMORY in the .env file starts the bot with only the gateway
+intents its commands need, and without the member and presence caches that
+otherwise grow with every server the bot is in.
 '''
-import os
+import time
+start = time.perf_counter()
+import os, discord
 from dotenv import load_dotenv
 from discord.ext import commands
-from bot_commands import initialize_commands
 load_dotenv()
+timings = [('configuration', time.perf_counter() - start)]
+
+def bot_options():
+    '''Returns the options the bot is created with. The low memory profile
+    subscribes only to server and message events, caches no members, and
+    keeps at most MESSAGE_CACHE messages (none by default).
+    '''
+    if os.environ.get('LOW_MEMORY', 'false').lower() not in ('true', 'yes', '1'):
+        return {}
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    max_messages = int(os.environ.get('MESSAGE_CACHE', 0))
+    if max_messages <= 0: #discord.py treats zero as its default of 1000
+        max_messages = None
+    return {'intents' : intents, 'member_cache_flags' : discord.MemberCacheFlags.none(),
+            'max_messages' : max_messages, 'chunk_guilds_at_startup' : False}
 
 if __name__ == '__main__':
-    bot = commands.Bot(command_prefix='!')
-    initialize_commands(bot)
+    bot = commands.Bot(command_prefix='!', **bot_options())
+    stage = time.perf_counter()
+    bot.load_extension('bot_commands')
+    timings.append(('commands', time.perf_counter() - stage))
+    stage = time.perf_counter()
     
     @bot.event
     async def on_ready(): #on_ready runs when the bot has connected.
+        if len(timings) == 2: #on_ready runs again after reconnecting
+            timings.append(('connecting', time.perf_counter() - stage))
+            timings.append(('total', time.perf_counter() - start))
+            print('Startup: ' + ', '.join(['{} {:.2f}s'.format(name, seconds) for name, seconds in timings]))
         print('Bot initialized as {}, ID: {}.'.format(bot.user, bot.user.id))        
 
+    @bot.command(brief='Reloads the bot\'s commands without reconnecting.', hidden=True)
+    @commands.is_owner()
+    async def reload(ctx, extension='bot_commands'):
+        '''Reloads a command extension, picking up changes to its code without
+        restarting the bot. Only the bot's owner may use this.
+        '''
+        try:
+            bot.reload_extension(extension)
+        except commands.ExtensionError as e:
+            await ctx.send("Unable to reload {}: {}".format(extension, str(e)))
+            return
+        await ctx.send("Reloaded {}.".format(extension))
+
     bot.run(os.environ.get('DISCORD_API_KEY'))
\ No newline at end of file
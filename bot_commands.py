@@ -6,11 +6,32 @@ Created on Jun 16, 2021
 Methods
 -------
 get_sheet
-    Loads a sheet from the database.
+    Loads the sheet of a user's active character from the database, or
+    only the fields a command needs.
+get_sheets
+    Loads the sheets of several users' active characters from the database.
+active_sheet_id
+    Returns the id of the sheet of a user's active character
+find_character
+    Returns the id of the sheet of one of a user's characters by name
+new_sheet_id
+    Returns a new id for a user's second or later character
 gen_sheet
-    Identifies the correct gameline for a loaded sheet and returns the proper class.
+    Looks up the gameline of a loaded sheet in the splat registry and returns
+    an instance of its class.
 check_sheet
     Validates a creation string's JSON
+apply_damage, apply_heal
+    Applies or heals damage of a given type on a loaded sheet
+mutate_sheet
+    Applies a change to a sheet and saves it, retrying if another command
+    saved the sheet first
+table_args
+    Checks and converts the arguments of a server wide update
+resident_memory
+    Returns the memory currently used by the bot process
+setup, teardown
+    Called by discord.py when this module is loaded or unloaded as an extension
     
 Classes
 -------
@@ -24,26 +45,97 @@ Creation
     Discord.py Cog for Character Creation commands
 Other
     Discord.py Cog for miscellaneous other character sheet commands
+Storyteller
+    Discord.py Cog for changing every character on a server at once
+Slash
+    Discord.py Cog answering slash commands and their autocomplete
 '''
-import pymongo, os, json
-from time import sleep
-from char_sheet import mortal
+import json, os, sys, traceback, asyncio, random
+from char_sheet import mortal, save_damage, always_loaded, skill_index, attribute_index
+from splats import get_class
+from storage import get_storage, SheetConflict, SheetsNotMigrated
+from breaker import StorageUnavailable
+from roll_history import history
+from journal import journal
+from activity import activity
+from scheduler import scheduler, run_operation
+from combat_tracker import Combatant, get_scene, start_scene, end_scene
+from name_index import NameIndex, SheetNames
+from interactions import Interaction, register, option, integer_option, application_command, autocomplete, choice_length
 from discord.ext import commands
-from dotenv import load_dotenv
-load_dotenv()
+from discord.errors import HTTPException
+from dispatcher import reply, bulk, dispatcher
 
+max_retries = 3
+max_npcs = 20 #the most NPCs added by one !combat npc
+conflict = "Your sheet is being changed by several commands at once. Please try again."
+not_migrated = "The character sheets on this server are stored in an old format. The bot's host needs to run migrate.py before they can be used."
+#the fields loaded by commands that do not need the whole sheet
+wp_fields = ['attributes', 'willpower']
+wound_fields = ['attributes', 'merits', 'bashing', 'lethal', 'aggravated']
+beat_fields = ['beats', 'experience']
+condition_fields = ['conditions']
+score_fields = {'beats' : ['conditions', 'beats', 'experience', 'aspirations'], 'wounds' : wound_fields}
+damage_types = {'b' : 'bashing', 'l' : 'lethal', 'a' : 'aggravated'}
 no_sheet = "You do not have a character sheet! To create a sheet manually, please begin with !name \n To generate a sheet, please see !create"
 
-def get_sheet(server_id, user_id):
-        mongo_client = pymongo.MongoClient(os.environ.get('DB_HOST'), int(os.environ.get('DB_PORT')))
-        db = mongo_client[os.environ.get('DB_NAME')]
-        collection = db[str(server_id)]
-        info = collection.find_one({'user id' : user_id})
+def resident_memory():
+    '''Returns the resident memory of this process in bytes, or its peak
+    where the current figure is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_sheet(server_id, user_id, fields=None):
+        activity.record(server_id, user_id)
+        if fields != None:
+            fields = list(fields) + always_loaded
+        info = get_storage().find(server_id, user_id, fields)
+        if info != None and info.get('active') != None: #playing another of their characters. a deleted one falls back to the first
+            info = get_storage().find(server_id, info['active'], fields) or info
         return info
+
+def get_sheets(server_id, user_ids):
+        sheets = get_storage().find_many(server_id, user_ids)
+        playing = [x['active'] for x in sheets if x.get('active') != None]
+        if len(playing) == 0:
+            return sheets
+        others = dict([(x['user id'], x) for x in get_storage().find_many(server_id, playing)])
+        return [others.get(x.get('active'), x) for x in sheets]
+
+def active_sheet_id(server_id, user_id):
+    info = get_storage().find(server_id, user_id)
+    if info != None and info.get('active') != None:
+        return info['active']
+    return user_id
+
+def find_character(server_id, owner, name):
+    '''Returns the sheet id of the character of owner's that name most
+    likely means, or None. A word from the middle of a name, such as "two"
+    for "Ghoul Two", is enough if only one name contains it.
+    '''
+    characters = get_storage().characters(server_id, owner)
+    index = NameIndex([x['name'] for x in characters])
+    matches = index.complete(name)
+    name = index.resolve(name)
+    if name == None and len(matches) == 1:
+        name = matches[0]
+    for character in characters:
+        if character['name'] == name:
+            return character['user id']
+    return None
+
+def new_sheet_id():
+    return -random.randint(1, 2 ** 53) #negative, so never the id of a discord user
         
-def gen_sheet(server_id, info):
-        if info['splat'] == 'mortal':
-            return mortal(server_id, info)
+def gen_sheet(server_id, info, fields=None):
+        sheet_class = get_class(info.get('splat', 'mortal'))
+        if sheet_class != None:
+            return sheet_class(server_id, info, fields)
         else:
             print("INVALID SPLAT TYPE:")
             print("SERVER: {}".format(str(server_id)))
@@ -51,7 +143,10 @@ def gen_sheet(server_id, info):
             
 def check_sheet(strangedict):
     checker = ['name', 'attributes', 'skills']
-    attributes = ['intelligence', 'wits', 'resolve', 'strength', 'dexterity', 'stamina', 'presence', 'manipulation', 'composure']
+    sheet_class = get_class(strangedict.get('splat', 'mortal'))
+    if sheet_class == None:
+        return False
+    attributes = sheet_class.schema.attributes
     test = []
     for check in checker:
         if check in strangedict.keys():
@@ -73,6 +168,70 @@ def check_sheet(strangedict):
         return True #I know this is backwards but whatever
     else:
         return False
+
+def apply_damage(char, value, damagetype):
+    if damagetype == 'b':
+        return char.add_bashing(value)
+    elif damagetype == 'l':
+        return char.add_lethal(value)
+    elif damagetype == 'a':
+        return char.add_agg(value)
+    return ""
+
+def apply_heal(char, value, damagetype):
+    if damagetype == 'b':
+        return char.bheal(value)
+    elif damagetype == 'l':
+        return char.lheal(value)
+    elif damagetype == 'a':
+        return char.aheal(value)
+    return ""
+
+def mutate_sheet(server_id, user_id, action, fields=None):
+    '''Loads a sheet, applies action to it and saves it once. If another
+    command saved the sheet in the meantime, the save is refused and the
+    action is applied again to a freshly loaded sheet, up to max_retries
+    times. Returns whatever action returns, or None if there is no sheet.
+    Raises SheetConflict if every attempt was refused, so that nothing the
+    action returned is shown for a change that was not saved. Commands
+    leave it to on_command_error, which replies with conflict.
+    If fields are given, only those are loaded and saved.
+    '''
+    for _ in range(max_retries):
+        char = get_sheet(server_id, user_id, fields)
+        if char == None:
+            return None
+        char = gen_sheet(server_id, char, fields)
+        char.deferred = True
+        result = action(char)
+        char.deferred = False
+        if not char.dirty:
+            return result
+        try:
+            char.save_sheet()
+            return result
+        except SheetConflict:
+            pass
+    raise SheetConflict()
+
+def table_args(operation, args):
+    '''Returns the arguments for a server wide update in the form the
+    scheduler stores them, or None if they are not valid.
+    '''
+    try:
+        if operation == 'beats' and len(args) == 1 and int(args[0]) > 0:
+            return [int(args[0])]
+        elif operation == 'clearcon' and len(args) > 0:
+            return [" ".join(args).lower()]
+        elif operation == 'heal' and len(args) in [1, 2] and int(args[0]) > 0:
+            damagetype = 'b'
+            if len(args) == 2:
+                damagetype = args[1].lower()
+            if damagetype in damage_types:
+                return [int(args[0]), damage_types[damagetype]]
+    except ValueError:
+        pass
+    return None
         
 class CommonActions(commands.Cog, name='01. Common Actions'):
     def __init__(self, bot):
@@ -103,6 +262,14 @@ class CommonActions(commands.Cog, name='01. Common Actions'):
                 applies rote quality to the roll
             wp
                 applies +3 to the dice pool. does NOT alter your willpower
+            x<number>
+                rolls the same pool that many times, e.g. x5
+            detail
+                lists every die rolled, even for large pools. otherwise pools
+                of more than 20 dice only show how many of each face came up
+            
+        Several different pools may be rolled at once by ending each with a
+        semicolon. All of the results are posted as a single message.
             
         Valid examples include:
         !roll Athletics (running) strength 8again rote
@@ -113,14 +280,215 @@ class CommonActions(commands.Cog, name='01. Common Actions'):
             This will roll a chance die.
         !roll Jimbo pushes his stamina to the limit as he attempts to (sprint) away from the monster. It has been years since he engaged in any real athletics, but at this point, all he can do is run! wp
             This will roll Athletics (Sprint) + Stamina, with the +3 willpower bonus
+        !roll x6 brawl strength; x6 firearms dexterity
+            This will roll Brawl + Strength six times and Firearms + Dexterity six times
         '''
         char = get_sheet(ctx.message.guild.id, ctx.author.id)
         if char != None:
             char = gen_sheet(ctx.message.guild.id, char)
             response = char.roll_dice(args)
-            await ctx.send(response)
+            for outcome in char.rolls:
+                history.record(ctx.message.guild.id, ctx.author.id, char.name, outcome)
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
+
+    @commands.command(brief='Rolls an extended action in one go.')
+    async def extended(self, ctx, target, *args):
+        '''Rolls an extended action, repeating the roll until the target number
+        of successes is reached or the attempts run out. The first argument is
+        the number of successes needed, followed by the usual !roll arguments.
+        
+        Additional Arguments:
+            tries<number>
+                the maximum number of rolls. defaults to the size of the dice pool
+            penalty<number>
+                removes that many more dice from each roll after the first
+            odds
+                also reports the chance of completing the action
+        
+        Example:
+        !extended 10 academics intelligence tries5 penalty1 odds
+            Rolls Academics + Intelligence up to 5 times, losing a die each roll,
+            until 10 successes have been gathered.
+        '''
+        char = get_sheet(ctx.message.guild.id, ctx.author.id)
+        if char != None:
+            char = gen_sheet(ctx.message.guild.id, char)
+            response = await ctx.bot.loop.run_in_executor(None, char.extended_roll, int(target), args) #estimating the odds can take a while
+            for outcome in char.rolls:
+                history.record(ctx.message.guild.id, ctx.author.id, char.name, outcome)
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
+
+    @commands.command(brief='Rolls a saved macro.')
+    async def r(self, ctx, name, *args):
+        '''Rolls a macro saved with !macro save. Any further arguments, such
+        as wp or a modifier, are added to the macro's own for this roll only.
+        
+        Example:
+        !r sprint
+        !r sprint wp -2
+        '''
+        def roll_macro(char): #rolling may recompile and save the macro
+            return char.roll_macro(name, args), char.name, char.rolls
+        result = mutate_sheet(ctx.message.guild.id, ctx.author.id, roll_macro)
+        if result != None:
+            response, character, rolls = result
+            for outcome in rolls:
+                history.record(ctx.message.guild.id, ctx.author.id, character, outcome)
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
+
+    @commands.command(name='as', brief='Rolls as another of your characters.')
+    async def roll_as(self, ctx, name, *args):
+        '''Rolls for one of your characters without switching to them. The first
+        argument is the character's name, in quotes if it is several words,
+        and the rest are as for !roll, e.g. !as "Ghoul Two" brawl strength
+        '''
+        sheet_id = find_character(ctx.message.guild.id, ctx.author.id, name)
+        if sheet_id == None:
+            await reply(ctx, "You have no character called {}. !character lists your characters.".format(name))
+            return
+        char = get_storage().find(ctx.message.guild.id, sheet_id)
+        if char == None: #deleted since it was listed
+            await reply(ctx, no_sheet)
+            return
+        char = gen_sheet(ctx.message.guild.id, char)
+        response = char.roll_dice(args)
+        for outcome in char.rolls:
+            history.record(ctx.message.guild.id, ctx.author.id, char.name, outcome)
+        await reply(ctx, "**{}**: {}".format(char.name, response))
+
+    @commands.group(brief='Saves, removes and lists roll macros.', invoke_without_command=True)
+    async def macro(self, ctx):
+        '''Macros save a roll under a short name, to be rolled later with !r.
+        On its own, this command lists your macros.
+        
+        Subcommands:
+            save <name> <roll arguments>
+                saves a roll, e.g. !macro save sprint Athletics (running) strength 8again rote
+            delete <name>
+                removes a macro
+        '''
+        char = get_sheet(ctx.message.guild.id, ctx.author.id)
+        if char != None:
+            char = gen_sheet(ctx.message.guild.id, char)
+            await reply(ctx, char.displ_macros())
+        else:
+            await reply(ctx, no_sheet)
+
+    @macro.command(name='save')
+    async def macro_save(self, ctx, name, *args):
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.save_macro(name, args))
+        if response != None:
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
+
+    @macro.command(name='delete')
+    async def macro_delete(self, ctx, name):
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.del_macro(name))
+        if response != None:
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        get_storage().start(self.bot.loop)
+        history.start(self.bot.loop)
+        journal.start(self.bot.loop)
+        activity.start(self.bot.loop)
+        scheduler.start(self.bot.loop)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        '''Tells players when a command failed because the database is down,
+        or because their sheet kept being changed by other commands. Any
+        other error is printed, as the default handler would have done.
+        '''
+        original = getattr(error, 'original', error)
+        if isinstance(original, StorageUnavailable):
+            await reply(ctx, "The character database is not responding right now. Sheets already in use can still be rolled, but yours could not be loaded. Please try again shortly.")
+            return
+        if isinstance(original, SheetConflict):
+            await reply(ctx, conflict)
+            return
+        if isinstance(original, SheetsNotMigrated):
+            print(str(original), file=sys.stderr)
+            await reply(ctx, not_migrated)
+            return
+        if getattr(ctx, 'error_handled', False): #a cog's own error handler has answered it
+            return
+        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+    @commands.command(brief='Displays recent rolls and roll statistics.')
+    async def history(self, ctx, scope='me', hours=None):
+        '''Displays the most recent rolls you have made on this server.
+        Optionally, one of the following may be entered after history:
+            me - your own recent rolls (the default)
+            server - the recent rolls of everyone on this server
+            stats - average successes and exceptional success rate for each
+            of your characters
+            sheet - the most recent changes made to your character sheet
+        A number of hours may be given after that to only consider rolls made
+        within that time, e.g. !history stats 24
+        '''
+        scope = scope.lower()
+        if hours != None:
+            hours = int(hours)
+        guild_id = ctx.message.guild.id
+        if scope == 'sheet':
+            entries = await self.bot.loop.run_in_executor(None, journal.recent, guild_id, active_sheet_id(guild_id, ctx.author.id))
+            if len(entries) == 0:
+                await reply(ctx, "No changes have been recorded for your sheet.")
+                return
+            response = "__**Recent Changes**__\n"
+            for entry in entries:
+                changes = []
+                for change in entry['changes']:
+                    if change['field'] == '*' and change['old'] == None:
+                        changes.append("sheet created")
+                    elif change['field'] == '*':
+                        changes.append("sheet cleared")
+                    else:
+                        changes.append("{}: {} -> {}".format(change['field'].title(), str(change['old'])[:40], str(change['new'])[:40]))
+                response += "`{}` {}\n".format(entry['timestamp'].strftime('%Y-%m-%d %H:%M'), "; ".join(changes))
+            await reply(ctx, response)
+            return
+        if scope == 'stats':
+            results = await self.bot.loop.run_in_executor(None, history.stats, guild_id, ctx.author.id, hours)
+            if len(results) == 0:
+                await reply(ctx, "No rolls have been recorded for you yet.")
+                return
+            response = "__**Roll Statistics**__\n"
+            for x in results:
+                response += "**{}:** {} rolls, {:.2f} average successes, {:.0%} exceptional\n".format(x['character'], str(x['rolls']), x['average'], x['exceptional rate'])
+            await reply(ctx, response)
+            return
+        if scope == 'server':
+            results = await self.bot.loop.run_in_executor(None, history.recent, guild_id, None, hours)
+        else:
+            results = await self.bot.loop.run_in_executor(None, history.recent, guild_id, ctx.author.id, hours)
+        if len(results) == 0:
+            await reply(ctx, "No rolls have been recorded yet.")
+            return
+        response = "__**Recent Rolls**__\n"
+        for x in results:
+            if x['type'] == 'chance':
+                pool = 'a chance die'
+            else:
+                pool = "{} dice".format(str(x['pool']))
+                if x['type'] != 'normal':
+                    pool += " ({})".format(x['type'])
+            if x['rote']:
+                pool += ", rote"
+            response += "`{}` {}: {}, **{} successes** and {} explosions\n".format(x['timestamp'].strftime('%Y-%m-%d %H:%M'), x['character'], pool, str(x['successes']), str(x['explosions']))
+        await reply(ctx, response)
 
     @commands.command(brief='Displays the character sheet. Contains optional arguments.')
     async def score(self, ctx, arg=None):
@@ -134,45 +502,40 @@ class CommonActions(commands.Cog, name='01. Common Actions'):
             advantages - displays only derived advantages, willpower and health
             wounds - just the character's wound track
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
+        if arg != None:
+            arg = arg.lower()
+        fields = score_fields.get(arg)
+        char = get_sheet(ctx.message.guild.id, ctx.author.id, fields)
         if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            if arg != None:
-                arg = arg.lower()
+            char = gen_sheet(ctx.message.guild.id, char, fields)
             if arg == 'header':
-                await ctx.send(char.displ_head())
+                await reply(ctx, char.displ_head())
             elif arg == 'skills':
-                await ctx.send(char.displ_skills())
+                await reply(ctx, char.displ_skills())
             elif arg == 'merits':
-                await ctx.send(char.displ_merits())
+                await reply(ctx, char.displ_merits())
             elif arg == 'beats':
-                await ctx.send(char.displ_beats())
+                await reply(ctx, char.displ_beats())
             elif arg == 'advantages':
-                await ctx.send(char.displ_advant())
+                await reply(ctx, char.displ_advant())
             elif arg == 'wounds':
-                await ctx.send("{}'s Wounds:\n".format(char.name) + char.wound_track())
+                await reply(ctx, "{}'s Wounds:\n".format(char.name) + char.wound_track())
             elif arg == None:
-                await ctx.send(char.displ_head())
-                sleep(1)
-                await ctx.send(char.displ_skills())
-                sleep(1)
-                await ctx.send(char.displ_merits())
-                sleep(1)
-                await ctx.send(char.displ_beats())
-                sleep(1)
-                await ctx.send(char.displ_advant())
-        else:
-            await ctx.send(no_sheet)
+                await reply(ctx, char.displ_head(), bulk)
+                await reply(ctx, char.displ_skills(), bulk)
+                await reply(ctx, char.displ_merits(), bulk)
+                await reply(ctx, char.displ_beats(), bulk)
+                await reply(ctx, char.displ_advant(), bulk)
+        else:
+            await reply(ctx, no_sheet)
             
     @commands.command(brief='Sets the current willpower for the character.')
     async def wp(self, ctx, value):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_wp(int(value))
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_wp(int(value)), wp_fields)
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
 class Experience(commands.Cog, name='02. Beats and Experience'):
     def __init__(self, bot):
@@ -183,70 +546,70 @@ class Experience(commands.Cog, name='02. Beats and Experience'):
         '''Accepts one argument: The name of the condition. Multiword condition
         names should be enwrapped in quotes ("Soul Loss" not just Soul Loss)
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.add_con(condition)
-            await ctx.send(response)       
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.add_con(condition), condition_fields)
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
 
     @commands.command(brief='Removes a condition from the character')
     async def delcon(self, ctx, condition):
         '''Accepts one argument: The name of the condition. Multiword condition
         names should be wrapped in quotes ("Soul Loss" not just Soul Loss)
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.del_con(condition)
-            await ctx.send(response)      
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.del_con(condition), condition_fields)
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
 
     @commands.command(brief='Adds beats to the character. Automatically converts to xp.')
     async def beats(self, ctx, val):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.add_beats(int(val))
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.add_beats(int(val)), beat_fields)
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
              
     @commands.command(brief='Removes experience from the character.')
     async def spendxp(self, ctx, val):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.del_exp(int(val))
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.del_exp(int(val)), beat_fields)
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
 
     @commands.command(brief='Adds an aspiration to the character. Must be wrapped in quotes.')
     async def aspireto(self, ctx, aspiration):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.add_aspir(aspiration)
-            await ctx.send(response)  
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.add_aspir(aspiration))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Removes an aspiration from the character. Does not award beats.')
     async def fulfill(self, ctx, aspiration):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.del_aspir(aspiration)
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.del_aspir(aspiration))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
 class Combat(commands.Cog, name='03. Combat'):
     def __init__(self, bot):
         self.bot = bot
+
+    def scene_sheet(self, ctx):
+        '''Returns the author's sheet if it is held by a combat scene in this
+        channel, so that damage is applied to that copy and saved with the
+        rest of the scene.
+        '''
+        scene = get_scene(ctx.channel.id)
+        if scene != None:
+            combatant = scene.find_player(ctx.author.id)
+            if combatant != None:
+                return combatant.sheet
+        return None
         
     @commands.command(brief='Applies damage to the character')
     async def damage(self, ctx, value, damagetype='b'):
@@ -257,20 +620,16 @@ class Combat(commands.Cog, name='03. Combat'):
         '''
         value = int(value)
         damagetype = damagetype.lower()
-        response = ""
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
+        action = lambda char: apply_damage(char, value, damagetype) + "\n" + char.wound_track()
+        char = self.scene_sheet(ctx)
         if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            if damagetype == 'b':
-                response = char.add_bashing(value)
-            elif damagetype == 'l':
-                response = char.add_lethal(value)
-            elif damagetype == 'a':
-                response = char.add_agg(value)
-            response += "\n" + char.wound_track()
-            await ctx.send(response)
-        else:
-            await ctx.send(no_sheet)
+            response = action(char)
+        else:
+            response = mutate_sheet(ctx.message.guild.id, ctx.author.id, action, wound_fields)
+        if response != None:
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Heals damage from the character')
     async def heal(self, ctx, value=0, damagetype='b'):
@@ -281,21 +640,188 @@ class Combat(commands.Cog, name='03. Combat'):
         '''
         value = int(value)
         damagetype = damagetype.lower()
-        response = ""
+        action = lambda char: apply_heal(char, value, damagetype) + "\n" + char.wound_track()
+        char = self.scene_sheet(ctx)
+        if char != None:
+            response = action(char)
+        else:
+            response = mutate_sheet(ctx.message.guild.id, ctx.author.id, action, wound_fields)
+        if response != None:
+            await reply(ctx, response)
+        else:
+            await reply(ctx, no_sheet)
+
+    @commands.command(brief='Displays the health and willpower of every character on the server.')
+    async def party(self, ctx):
+        '''Displays the health, willpower and conditions of every character on
+        this server, fetched together in a single query. Damage taken in a
+        combat scene in this channel is included before it is saved.
+        '''
+        summary = await ctx.bot.loop.run_in_executor(None, get_storage().party_summary, ctx.message.guild.id)
+        if len(summary) == 0:
+            await reply(ctx, "There are no characters on this server.")
+            return
+        scene = get_scene(ctx.channel.id)
+        held = {}
+        if scene != None:
+            held = dict([(x.user_id, x) for x in scene.dirty_sheets()])
+        lines = ["__**Party**__"]
+        for x in summary:
+            char = held.get(x['user id'])
+            if char != None:
+                x.update({'bashing' : char.bashing, 'lethal' : char.lethal, 'aggravated' : char.aggravated})
+            track = "A" * x['aggravated'] + "L" * x['lethal'] + "B" * x['bashing']
+            track += "_" * max(x['max health'] - len(track), 0)
+            line = "**{}** `{}` WP {}/{}".format(x['name'], track, str(x['willpower']), str(x['max wp']))
+            if len(x['conditions']) > 0:
+                line += " - " + ", ".join(x['conditions'])
+            lines.append(line)
+        await reply(ctx, "\n".join(lines), bulk)
+
+    @commands.group(brief='Runs a combat scene with initiative tracking.', invoke_without_command=True)
+    async def combat(self, ctx):
+        '''Tracks initiative for a fight in this channel. Sheets of the players
+        involved are held for the length of the scene, and any damage they take
+        is saved when the scene ends.
+        
+        Subcommands:
+            start [@players...]
+                starts a scene, rolling initiative for you and anyone mentioned
+            join
+                joins a scene that is already running
+            npc <name> <initiative modifier> [count]
+                adds one or more NPCs, up to 20 at a time, e.g. !combat npc Ghoul 5 12
+            next
+                moves to the next turn
+            delay <initiative>
+                delays the current turn to a lower initiative
+            order
+                displays the initiative order
+            hit <name> <value> [b/l/a]
+                applies damage to a player in the scene by character name
+            remove <name>
+                removes a participant from the scene
+            end
+                ends the scene, saving any damage taken
+        '''
+        scene = get_scene(ctx.channel.id)
+        if scene != None:
+            await reply(ctx, scene.display_order())
+        else:
+            await reply(ctx, "There is no combat scene in this channel. Start one with !combat start")
+
+    @combat.command(name='start')
+    async def combat_start(self, ctx):
+        if get_scene(ctx.channel.id) != None:
+            await reply(ctx, "A combat scene is already running in this channel.")
+            return
+        scene = start_scene(ctx.message.guild.id, ctx.channel.id)
+        user_ids = set([ctx.author.id] + [x.id for x in ctx.message.mentions])
+        for info in get_sheets(ctx.message.guild.id, user_ids):
+            char = gen_sheet(ctx.message.guild.id, info)
+            scene.add(Combatant(char.name, char.get_initiative(), char))
+        await reply(ctx, scene.display_order())
+
+    @combat.command(name='join')
+    async def combat_join(self, ctx):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        if scene.find_player(ctx.author.id) != None:
+            await reply(ctx, "You are already in this scene.")
+            return
         char = get_sheet(ctx.message.guild.id, ctx.author.id)
         if char != None:
             char = gen_sheet(ctx.message.guild.id, char)
-            if damagetype == 'b':
-                response = char.bheal(value)
-            elif damagetype == 'l':
-                response = char.lheal(value)
-            elif damagetype == 'a':
-                response = char.aheal(value)
-            response += "\n" + char.wound_track()
-            await ctx.send(response)
-        else:
-            await ctx.send(no_sheet)
-        
+            combatant = scene.add(Combatant(char.name, char.get_initiative(), char))
+            await reply(ctx, "{} joins the fight with initiative {}.".format(combatant.name, str(combatant.initiative)))
+        else:
+            await reply(ctx, no_sheet)
+
+    @combat.command(name='npc')
+    async def combat_npc(self, ctx, name, modifier, number=1):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        if int(number) < 1 or int(number) > max_npcs:
+            await reply(ctx, "NPCs can be added between 1 and {} at a time.".format(str(max_npcs)))
+            return
+        for _ in range(int(number)):
+            scene.add(Combatant(name, int(modifier)))
+        await reply(ctx, scene.display_order())
+
+    @combat.command(name='next')
+    async def combat_next(self, ctx):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        combatant = scene.next_turn()
+        if combatant == None:
+            await reply(ctx, "There is no one in this fight.")
+        else:
+            await reply(ctx, "Round {}: it is {}'s turn.".format(str(scene.round), combatant.name))
+
+    @combat.command(name='delay')
+    async def combat_delay(self, ctx, initiative):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        delayed = scene.current
+        combatant = scene.delay(int(initiative))
+        if combatant == None:
+            await reply(ctx, "Only the current turn may be delayed, and only to a lower initiative.")
+        else:
+            await reply(ctx, "{} delays to initiative {}. It is {}'s turn.".format(delayed.name, str(delayed.initiative), combatant.name))
+
+    @combat.command(name='order')
+    async def combat_order(self, ctx):
+        await self.combat(ctx)
+
+    @combat.command(name='hit')
+    async def combat_hit(self, ctx, name, value, damagetype='b'):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        combatant = scene.find(name)
+        if combatant == None or combatant.sheet == None:
+            await reply(ctx, "There is no player named {} in this scene.".format(name))
+            return
+        char = combatant.sheet
+        response = apply_damage(char, int(value), damagetype.lower())
+        response += "\n" + char.wound_track()
+        await reply(ctx, response)
+
+    @combat.command(name='remove')
+    async def combat_remove(self, ctx, name):
+        scene = get_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        combatant = scene.remove(name)
+        if combatant == None:
+            await reply(ctx, "There is no one named {} in this scene.".format(name))
+            return
+        if combatant.sheet != None:
+            combatant.sheet.deferred = False
+            if combatant.sheet.dirty:
+                save_damage(scene.guild_id, [combatant.sheet])
+        await reply(ctx, "{} has left the fight.".format(combatant.name))
+
+    @combat.command(name='end')
+    async def combat_end(self, ctx):
+        scene = end_scene(ctx.channel.id)
+        if scene == None:
+            await reply(ctx, "There is no combat scene in this channel.")
+            return
+        sheets = scene.dirty_sheets()
+        save_damage(scene.guild_id, sheets)
+        await reply(ctx, "The fight is over after {} rounds. Saved damage for {} characters.".format(str(scene.round), str(len(sheets))))
+
 class Creation(commands.Cog, name="04. Character Creation"):
     def __init__(self, bot):
         self.bot = bot
@@ -305,30 +831,98 @@ class Creation(commands.Cog, name="04. Character Creation"):
         '''Alters the name of your character. If you do not yet have a character
         sheet, one will be generated for you.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_name(name)
-            await ctx.send(response)
+        sheet_id = active_sheet_id(ctx.message.guild.id, ctx.author.id)
+        for character in get_storage().characters(ctx.message.guild.id, ctx.author.id):
+            if character['name'].casefold() == name.casefold() and character['user id'] != sheet_id:
+                await reply(ctx, "You already have a character called {}.".format(character['name']))
+                return
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_name(name))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send("Generating new character, {}".format(name))
+            await reply(ctx, "Generating new character, {}".format(name))
             char = mortal(ctx.message.guild.id, {'user id' : ctx.author.id})
             response = char.set_name(name)
-            await ctx.send(response)
-        
+            await reply(ctx, response)
+
+    @commands.group(brief='Lists, creates and switches between your characters.', invoke_without_command=True)
+    async def character(self, ctx):
+        '''Lists your characters on this server. Every command acts on your
+        active character, marked with a star.
+
+        Subcommands:
+            new <name>
+                creates a character and makes it your active character
+            switch <name>
+                makes another of your characters the active one
+
+        !as <name> rolls for one of your characters without switching to it.
+        To delete a character, switch to it and use !clear. Your first
+        character can only be cleared once it is your only one.
+        '''
+        characters = get_storage().characters(ctx.message.guild.id, ctx.author.id)
+        if len(characters) == 0:
+            await reply(ctx, no_sheet)
+            return
+        sheet_id = active_sheet_id(ctx.message.guild.id, ctx.author.id)
+        lines = ["__**Your Characters**__"]
+        for character in characters:
+            if character['user id'] == sheet_id:
+                lines.append("\u2605 **{}**".format(character['name']))
+            else:
+                lines.append(character['name'])
+        await reply(ctx, "\n".join(lines))
+
+    @character.command(name='new')
+    async def character_new(self, ctx, *, name):
+        characters = get_storage().characters(ctx.message.guild.id, ctx.author.id)
+        if name.casefold() in [x['name'].casefold() for x in characters]:
+            await reply(ctx, "You already have a character called {}.".format(name))
+            return
+        if len(characters) == 0: #a player's first character is kept under their own id
+            char = mortal(ctx.message.guild.id, {'user id' : ctx.author.id})
+            await reply(ctx, char.set_name(name))
+            return
+        first = get_storage().find(ctx.message.guild.id, ctx.author.id, ['owner'])
+        if first != None and 'owner' not in first: #saved before owners were stored, so not yet covered by the unique index
+            get_storage().update_fields(ctx.message.guild.id, [(ctx.author.id, {'owner' : ctx.author.id})])
+        for _ in range(max_retries):
+            char = mortal(ctx.message.guild.id, {'user id' : new_sheet_id(), 'owner' : ctx.author.id})
+            try:
+                response = char.set_name(name)
+                break
+            except SheetConflict: #the name was taken meanwhile, or, very unlikely, the id
+                response = None
+        if response == None:
+            await reply(ctx, conflict)
+            return
+        get_storage().update_fields(ctx.message.guild.id, [(ctx.author.id, {'active' : char.user_id})])
+        await reply(ctx, "{} You are now playing {}.".format(response, char.name))
+
+    @character.command(name='switch')
+    async def character_switch(self, ctx, *, name):
+        sheet_id = find_character(ctx.message.guild.id, ctx.author.id, name)
+        if sheet_id == None:
+            await reply(ctx, "You have no character called {}. !character lists your characters.".format(name))
+            return
+        active = None
+        if sheet_id != ctx.author.id:
+            active = sheet_id
+        get_storage().update_fields(ctx.message.guild.id, [(ctx.author.id, {'active' : active})])
+        char = get_sheet(ctx.message.guild.id, ctx.author.id, ['name'])
+        await reply(ctx, "You are now playing {}.".format(char['name']))
+
     @commands.command(brief='Sets an attribute score')
     async def attribute(self, ctx, attribute, score):
         '''Sets an attribute score for your character.
         Takes 2 arguments, separated by spaces. The first should be
         the chosen attribute, followed by the value you wish to set it to.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_attrib(attribute, int(score))
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_attrib(attribute, int(score)))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
     
     @commands.command(brief='Sets a skill level')
     async def skill(self, ctx, skill, score):
@@ -338,13 +932,11 @@ class Creation(commands.Cog, name="04. Character Creation"):
         Takes 2 arguments, separates by spaces. The first should be the chosen
         skill, followed by the value you wish to set it to.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_skill(skill, int(score))
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_skill(skill, int(score)))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Adds a skill specialty')
     async def addspecialty(self, ctx, skill, specialty):
@@ -352,13 +944,11 @@ class Creation(commands.Cog, name="04. Character Creation"):
         separated by spaces. The first is the skill, the second is the specialty.
         Multi-word specialties must be enclosed in quotes.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.add_specialty(skill, specialty)
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.add_specialty(skill, specialty))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
 
     @commands.command(brief='Removes a skill specialty')
     async def delspecialty(self, ctx, skill, specialty):
@@ -366,13 +956,11 @@ class Creation(commands.Cog, name="04. Character Creation"):
         separated by spaces. The first is the skill, the second is the specialty.
         Multi-word specialties must be enclosed in quotes.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.del_specialty(skill, specialty)
-            await ctx.send(response)
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.del_specialty(skill, specialty))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Sets a merit level')
     async def merit(self, ctx, selection, value):
@@ -385,34 +973,27 @@ class Creation(commands.Cog, name="04. Character Creation"):
         they must be phrased as "Defensive Combat: <skill>" where <skill> is 
         either Weaponry or Brawl.
         '''
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_merit(selection, int(value))
-            await ctx.send(response)   
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_merit(selection, int(value)))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Sets the Integrity score for the character.')
     async def integrity(self, ctx, value):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.mod_integ(int(value))
-            await ctx.send(response)    
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.mod_integ(int(value)))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
         
     @commands.command(brief='Sets the virtue and vice of the character.')
     async def virtvice(self, ctx, virtue, vice):
-        char = get_sheet(ctx.message.guild.id, ctx.author.id)
-        if char != None:
-            char = gen_sheet(ctx.message.guild.id, char)
-            response = char.set_virtue(virtue) + "\n"
-            response += char.set_vice(vice)
-            await ctx.send(response) 
+        response = mutate_sheet(ctx.message.guild.id, ctx.author.id, lambda char: char.set_virtue(virtue) + "\n" + char.set_vice(vice))
+        if response != None:
+            await reply(ctx, response)
         else:
-            await ctx.send(no_sheet)
+            await reply(ctx, no_sheet)
             
     @commands.command(brief='Creates a character using the string provided by an online widget.')
     async def create(self, ctx, *, createstring):
@@ -431,32 +1012,372 @@ class Creation(commands.Cog, name="04. Character Creation"):
             if check_sheet(info):
                 info['user id'] = ctx.author.id
                 char = gen_sheet(ctx.message.guild.id, info)
+                char.deferred = True #saved once below, rather than once per stat
                 for attrib in info['attributes']:
                     char.set_attrib(attrib, int(info['attributes'][attrib]))
                 for skill in info['skills']:
                     char.set_skill(skill, int(info['skills'][skill][0]))
                 char.set_wp(char.max_wp())
                 response = "{} has been created!".format(char.name)
+                char.deferred = False
                 char.save_sheet()
-                await ctx.send(response)
+                await reply(ctx, response)
             else:
-                await ctx.send('Invalid generator.')
+                await reply(ctx, 'Invalid generator.')
         else:
-            await ctx.send("But you already have a character!")
+            await reply(ctx, "But you already have a character!")
 
 class Other(commands.Cog, name='05. Other'):        
-    @commands.command(brief='Deletes the character sheet. CANNOT BE UNDONE.')
+    @commands.command(brief='Deletes the character sheet. Can be reverted with !undo.')
     async def clear(self, ctx, confirmation=None):
         if confirmation != 'clearcharacter':
-            await ctx.send('This command will delete your character. Please be aware that this action cannot be undone.\nIf you are absolutely certain that you would like to delete your character, please input `!clear clearcharacter` in all lower case.')
+            await reply(ctx, 'This command will delete your character. It can be restored with `!undo` for a limited time afterwards.\nIf you are absolutely certain that you would like to delete your character, please input `!clear clearcharacter` in all lower case.')
         else:
             char = get_sheet(ctx.message.guild.id, ctx.author.id)
-            if char != None:
+            if char != None and char['user id'] == ctx.author.id and len(get_storage().characters(ctx.message.guild.id, ctx.author.id)) > 1:
+                await reply(ctx, "Your first character holds which of your characters you are playing, so it can only be cleared once it is your only one. Switch to and clear your other characters first.")
+            elif char != None:
                 char = gen_sheet(ctx.message.guild.id, char)
                 response = char.clear_sheet()
-                await ctx.send(response)    
+                await reply(ctx, response)    
+            else:
+                await reply(ctx, "You do not have a sheet to clear.")
+
+    @commands.command(brief='Displays how busy the bot currently is.')
+    async def status(self, ctx):
+        '''Displays the number of responses waiting to be sent, how many
+        have been combined into shared messages, how much memory the bot
+        is using, and whether the database is answering.
+        '''
+        stats = dispatcher.stats()
+        guilds = len(ctx.bot.guilds)
+        members = sum([len(x.members) for x in ctx.bot.guilds])
+        memory = resident_memory()
+        response = "__**Status**__\n"
+        response += "Responses queued: {} across {} channels (deepest {}, most ever {})\n".format(str(stats['queued']), str(stats['channels']), str(stats['deepest']), str(stats['max depth']))
+        response += "Responses: {}, sent as {} messages, {} combined\n".format(str(stats['responses']), str(stats['sent']), str(stats['coalesced']))
+        response += "Memory: {:.1f} MB resident, {:.1f} KB per server across {} servers\n".format(memory / 1048576, memory / 1024 / max(guilds, 1), str(guilds))
+        response += "Cached: {} members, {} users, {} messages\n".format(str(members), str(len(ctx.bot.users)), str(len(ctx.bot.cached_messages)))
+        cache = get_storage().cache
+        response += "Sheets cached: {} of {}, {} hits, {} misses, {} loaded at startup\n".format(str(len(cache.entries)), str(cache.size), str(cache.hits), str(cache.misses), str(activity.warmed))
+        database = get_storage().stats()
+        response += "Database: {} ({} failures, opened {} times, {} calls refused)\n".format(database['state'], str(database['failures']), str(database['opened']), str(database['rejected']))
+        response += "Writes spooled: {} waiting, {} replayed, {} dropped\n".format(str(database['waiting']), str(database['replayed']), str(database['dropped']))
+        await reply(ctx, response)
+
+    @commands.command(brief='Reverts the most recent change to your character sheet.')
+    async def undo(self, ctx):
+        '''Reverts the most recent change made to your character sheet. May be
+        used repeatedly to step further back. A cleared sheet is restored, and
+        undoing the creation of a sheet deletes it. Use !history sheet to see
+        what will be undone.
+        '''
+        sheet_id = active_sheet_id(ctx.message.guild.id, ctx.author.id)
+        if sheet_id == ctx.author.id and len(get_storage().characters(ctx.message.guild.id, ctx.author.id)) > 1:
+            recent = await ctx.bot.loop.run_in_executor(None, journal.recent, ctx.message.guild.id, sheet_id, 1)
+            if len(recent) > 0 and recent[0]['changes'][0]['field'] == '*' and recent[0]['changes'][0]['old'] == None:
+                await reply(ctx, "Undoing that would delete your first character, which holds which of your characters you are playing. Switch to and clear your other characters first.")
+                return
+        try:
+            entry = await ctx.bot.loop.run_in_executor(None, journal.undo, ctx.message.guild.id, sheet_id)
+        except SheetConflict:
+            await reply(ctx, conflict)
+            return
+        if entry == None:
+            await reply(ctx, "There is nothing to undo.")
+            return
+        fields = []
+        for change in entry['changes']:
+            if change['field'] == '*' and change['old'] == None:
+                fields.append("the creation of your sheet")
+            elif change['field'] == '*':
+                fields.append("the clearing of your sheet")
             else:
-                await ctx.send("You do not have a sheet to clear.")
+                fields.append(change['field'])
+        await reply(ctx, "Undone: {}.".format(", ".join(fields)))
+
+class Storyteller(commands.Cog, name='06. Storyteller'):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await reply(ctx, "Only those who can manage the server may change every character at once.")
+            ctx.error_handled = True #anything else is left to on_command_error
+
+    async def run_table(self, ctx, operation, args, done):
+        args = table_args(operation, args)
+        if args == None:
+            await reply(ctx, "Invalid arguments. See !help table.")
+            return
+        changed = await ctx.bot.loop.run_in_executor(None, run_operation, ctx.message.guild.id, operation, args)
+        await reply(ctx, done.format(*args) + " {} characters changed.".format(str(changed)))
+
+    @commands.group(brief='Changes every character on the server at once.', invoke_without_command=True)
+    @commands.has_permissions(manage_guild=True)
+    async def table(self, ctx):
+        '''Changes every character on this server with a single update, for
+        the end of a session or scene. On its own, lists the updates scheduled
+        to repeat. Needs the Manage Server permission.
+        
+        Subcommands:
+            beats <number>
+                awards beats to every character, converting them to experience
+            clearcon <condition>
+                removes a condition from every character
+            heal <amount> [b|l|a]
+                heals damage of one type from every character, bashing by default
+            every <hours> <beats|clearcon|heal> <arguments>
+                repeats one of the above every so many hours, e.g. !table every 168 beats 1
+            cancel <number>
+                stops a repeating update, numbered as listed
+        '''
+        jobs = await ctx.bot.loop.run_in_executor(None, scheduler.jobs, ctx.message.guild.id)
+        if len(jobs) == 0:
+            await reply(ctx, "No updates are scheduled for this server.")
+            return
+        response = "__**Scheduled Updates**__\n"
+        for i, job in enumerate(jobs):
+            response += "{}. {} {} every {} hours, next at {} UTC\n".format(str(i+1), job['operation'], " ".join([str(x) for x in job['args']]), "{:g}".format(job['every']), job['next run'].strftime('%Y-%m-%d %H:%M'))
+        await reply(ctx, response)
+
+    @table.command(name='beats')
+    async def table_beats(self, ctx, *args):
+        await self.run_table(ctx, 'beats', args, "Everyone has earned {} beats.")
+
+    @table.command(name='clearcon')
+    async def table_clearcon(self, ctx, *args):
+        await self.run_table(ctx, 'clearcon', args, "{} has been removed from everyone.")
+
+    @table.command(name='heal')
+    async def table_heal(self, ctx, *args):
+        await self.run_table(ctx, 'heal', args, "Everyone has been healed of {} {} damage.")
+
+    @table.command(name='every')
+    async def table_every(self, ctx, hours, operation, *args):
+        operation = operation.lower()
+        args = table_args(operation, args)
+        try:
+            hours = float(hours)
+        except ValueError:
+            hours = 0
+        if args == None or hours < 1:
+            await reply(ctx, "Invalid arguments. Updates may repeat at most once an hour. See !help table.")
+            return
+        job = await ctx.bot.loop.run_in_executor(None, scheduler.schedule, ctx.message.guild.id, operation, args, hours)
+        await reply(ctx, "Scheduled {} {} every {:g} hours, first at {} UTC.".format(operation, " ".join([str(x) for x in args]), hours, job['next run'].strftime('%Y-%m-%d %H:%M')))
+
+    @table.command(name='cancel')
+    async def table_cancel(self, ctx, number: int):
+        job = await ctx.bot.loop.run_in_executor(None, scheduler.cancel, ctx.message.guild.id, number)
+        if job == None:
+            await reply(ctx, "There is no scheduled update with that number.")
+        else:
+            await reply(ctx, "Cancelled {} {}.".format(job['operation'], " ".join([str(x) for x in job['args']])))
+
+class Slash(commands.Cog, name='07. Slash Commands'):
+    '''
+    Answers the slash command versions of the most used commands, which are
+    registered with discord when the bot connects. They do the same as the
+    ! commands, run off the event loop, and are deferred if not done within
+    defer_after seconds. /score is always deferred.
+
+    Autocomplete is answered from memory only: attributes and skills from
+    the schema, and a player's merits, conditions and specialties from their
+    cached sheet. If the sheet is not cached, it is loaded in the background
+    for the next keystroke, rather than making discord wait on the database.
+    '''
+    defer_after = 2
+    roll_options = ['rote', '9again', '8again', 'noagain', 'wp', 'detail']
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.registered = False
+        self.names = SheetNames(int(os.environ.get('CACHE_SIZE', 1000)))
+        self.loading = set()
+        self.handlers = {'roll' : self.roll, 'score' : self.score, 'wp' : self.wp, 'beats' : self.beats,
+                         'attribute' : self.attribute, 'skill' : self.skill, 'merit' : self.merit,
+                         'addspecialty' : self.addspecialty, 'delspecialty' : self.delspecialty,
+                         'addcon' : self.addcon, 'delcon' : self.delcon}
+
+    def definitions(self):
+        skill = option('skill', 'The skill', autocomplete=True)
+        return [{'name' : 'roll', 'description' : 'Rolls dice, like !roll', 'options' : [option('pool', 'Attributes, skills, (specialties), modifiers and options', required=False, autocomplete=True)]},
+                {'name' : 'score', 'description' : 'Displays your character sheet, or one page of it', 'options' : [option('page', 'The page to show', required=False, choices=['header', 'skills', 'merits', 'beats', 'advantages', 'wounds'])]},
+                {'name' : 'wp', 'description' : 'Sets your current willpower', 'options' : [option('value', 'Your willpower', integer_option)]},
+                {'name' : 'beats', 'description' : 'Adds beats, converting every five to experience', 'options' : [option('value', 'The beats to add', integer_option)]},
+                {'name' : 'attribute', 'description' : 'Sets an attribute', 'options' : [option('attribute', 'The attribute', autocomplete=True), option('score', 'Its dots', integer_option)]},
+                {'name' : 'skill', 'description' : 'Sets a skill', 'options' : [skill, option('score', 'Its dots', integer_option)]},
+                {'name' : 'merit', 'description' : 'Sets a merit, removing it at 0', 'options' : [option('merit', 'The merit', autocomplete=True), option('value', 'Its dots', integer_option)]},
+                {'name' : 'addspecialty', 'description' : 'Adds a skill specialty', 'options' : [skill, option('specialty', 'The specialty')]},
+                {'name' : 'delspecialty', 'description' : 'Removes a skill specialty', 'options' : [skill, option('specialty', 'The specialty', autocomplete=True)]},
+                {'name' : 'addcon', 'description' : 'Adds a condition', 'options' : [option('condition', 'The condition')]},
+                {'name' : 'delcon', 'description' : 'Removes a condition', 'options' : [option('condition', 'The condition', autocomplete=True)]}]
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.registered:
+            return
+        try:
+            info = await self.bot.application_info()
+            await register(self.bot.http, info.id, self.definitions(), os.environ.get('SLASH_GUILD'))
+            self.registered = True
+        except HTTPException as e:
+            print("Unable to register slash commands: {}".format(str(e)))
+
+    @commands.Cog.listener()
+    async def on_socket_response(self, msg):
+        if msg.get('t') != 'INTERACTION_CREATE':
+            return
+        interaction = Interaction(msg['d'])
+        try:
+            if interaction.kind == autocomplete:
+                await interaction.suggest(self.bot.http, self.complete(interaction))
+            elif interaction.kind == application_command and interaction.name in self.handlers:
+                await self.run(interaction)
+        except HTTPException as e: #most likely answered too late
+            print("Unable to answer /{}: {}".format(interaction.name, str(e)))
+
+    async def run(self, interaction):
+        http = self.bot.http
+        if interaction.guild_id == None:
+            await interaction.respond(http, "Character sheets belong to a server, so these commands only work in one.", private=True)
+            return
+        task = self.bot.loop.run_in_executor(None, self.answer, interaction)
+        if interaction.name != 'score':
+            done, _ = await asyncio.wait([task], timeout=self.defer_after)
+            if task in done:
+                await interaction.respond(http, task.result())
+                return
+        await interaction.defer(http)
+        await interaction.edit(http, await task)
+
+    def answer(self, interaction):
+        try:
+            return self.handlers[interaction.name](interaction)
+        except StorageUnavailable:
+            return "The character database is not responding right now. Please try again shortly."
+        except SheetConflict:
+            return conflict
+        except SheetsNotMigrated:
+            return not_migrated
+        except Exception:
+            traceback.print_exc()
+            return "Something went wrong with that command."
+
+    def mutation(self, interaction, action, fields=None):
+        response = mutate_sheet(interaction.guild_id, interaction.user_id, action, fields)
+        if response == None:
+            return no_sheet
+        return response
+
+    def roll(self, interaction):
+        char = get_sheet(interaction.guild_id, interaction.user_id)
+        if char == None:
+            return no_sheet
+        char = gen_sheet(interaction.guild_id, char)
+        response = char.roll_dice(str(interaction.options.get('pool') or '').split())
+        for outcome in char.rolls:
+            history.record(interaction.guild_id, interaction.user_id, char.name, outcome)
+        return response
+
+    def score(self, interaction):
+        page = interaction.options.get('page')
+        fields = score_fields.get(page)
+        char = get_sheet(interaction.guild_id, interaction.user_id, fields)
+        if char == None:
+            return no_sheet
+        char = gen_sheet(interaction.guild_id, char, fields)
+        pages = {'header' : char.displ_head, 'skills' : char.displ_skills, 'merits' : char.displ_merits,
+                 'beats' : char.displ_beats, 'advantages' : char.displ_advant}
+        if page == 'wounds':
+            return "{}'s Wounds:\n".format(char.name) + char.wound_track()
+        if page in pages:
+            return pages[page]()
+        return "\n".join([pages[x]() for x in ['header', 'skills', 'merits', 'beats', 'advantages']])
+
+    def wp(self, interaction):
+        return self.mutation(interaction, lambda char: char.set_wp(interaction.options['value']), wp_fields)
+
+    def beats(self, interaction):
+        return self.mutation(interaction, lambda char: char.add_beats(interaction.options['value']), beat_fields)
+
+    def attribute(self, interaction):
+        return self.mutation(interaction, lambda char: char.set_attrib(interaction.options['attribute'], interaction.options['score']))
+
+    def skill(self, interaction):
+        return self.mutation(interaction, lambda char: char.set_skill(interaction.options['skill'], interaction.options['score']))
+
+    def merit(self, interaction):
+        return self.mutation(interaction, lambda char: char.set_merit(interaction.options['merit'], interaction.options['value']))
+
+    def addspecialty(self, interaction):
+        return self.mutation(interaction, lambda char: char.add_specialty(interaction.options['skill'], interaction.options['specialty']))
+
+    def delspecialty(self, interaction):
+        return self.mutation(interaction, lambda char: char.del_specialty(interaction.options['skill'], interaction.options['specialty']))
+
+    def addcon(self, interaction):
+        return self.mutation(interaction, lambda char: char.add_con(interaction.options['condition']), condition_fields)
+
+    def delcon(self, interaction):
+        return self.mutation(interaction, lambda char: char.del_con(interaction.options['condition']), condition_fields)
+
+    def sheet_names(self, interaction):
+        '''Returns the name indexes for the caller's cached sheet, or None if
+        it is not cached, in which case it is loaded in the background.
+        '''
+        cache = get_storage().cache
+        key = (str(interaction.guild_id), interaction.user_id)
+        version = cache.version(*key)
+        if version != None:
+            active = (cache.get(key[0], key[1], ['active']) or {}).get('active')
+            if active != None: #playing another of their characters
+                key = (key[0], active)
+                version = cache.version(*key)
+        if version == None:
+            if interaction.guild_id != None and key not in self.loading:
+                self.loading.add(key)
+                task = self.bot.loop.run_in_executor(None, get_storage().find, *key)
+                task.add_done_callback(lambda _: self.loading.discard(key))
+            return None
+        return self.names.get(key, version, lambda: cache.get(*key))
+
+    def complete(self, interaction):
+        query = str(interaction.options.get(interaction.focused) or '')
+        if interaction.focused == 'attribute':
+            return attribute_index.complete(query)
+        if interaction.focused == 'skill':
+            return skill_index.complete(query)
+        if interaction.focused == 'pool':
+            return self.complete_pool(interaction, query)
+        names = self.sheet_names(interaction)
+        if names == None:
+            return []
+        if interaction.focused == 'merit':
+            return names['merits'].complete(query)
+        if interaction.focused == 'condition':
+            return names['conditions'].complete(query)
+        if interaction.focused == 'specialty':
+            skill = skill_index.resolve(interaction.options.get('skill') or '')
+            if skill in names['specialties']:
+                return names['specialties'][skill].complete(query)
+        return []
+
+    def complete_pool(self, interaction, query):
+        '''Completes the last word of a roll, keeping what comes before it.'''
+        words = query.split(' ')
+        last = words[-1]
+        before = query[:len(query) - len(last)]
+        if last.startswith('('):
+            names = self.sheet_names(interaction)
+            if names == None:
+                return []
+            specialties = NameIndex([y for x in names['specialties'].values() for y in x.names.values()])
+            candidates = ['(' + x + ')' for x in specialties.complete(last[1:])]
+        else:
+            candidates = attribute_index.complete(last) + skill_index.complete(last) + NameIndex(self.roll_options).complete(last)
+        return [before + x for x in candidates if len(before + x) <= choice_length]
 
 def initialize_commands(bot):
     print('Initializing Common Actions')
@@ -468,4 +1389,25 @@ def initialize_commands(bot):
     print('Initializing Character Creation')
     bot.add_cog(Creation(bot))
     print('Initializing Other')
-    bot.add_cog(Other(bot))
\ No newline at end of file
+    bot.add_cog(Other(bot))
+    print('Initializing Storyteller')
+    bot.add_cog(Storyteller(bot))
+    print('Initializing Slash Commands')
+    bot.add_cog(Slash(bot))
+
+def setup(bot):
+    initialize_commands(bot)
+    if bot.is_ready(): #reloaded while connected, so on_ready will not run again
+        get_storage().start(bot.loop)
+        history.start(bot.loop)
+        journal.start(bot.loop)
+        activity.start(bot.loop)
+        scheduler.start(bot.loop)
+
+def teardown(bot):
+    try: #write out anything buffered before the module is replaced
+        history.flush()
+        journal.flush()
+        activity.flush()
+    except Exception as e:
+        print("Unable to flush before unloading: {}".format(str(e)))
\ No newline at end of file
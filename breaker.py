@@ -0,0 +1,223 @@
+'''
+Created on Oct 19, 2026
+Keeps the bot responsive when its database stalls. Every storage call goes
+through a CircuitBreaker. After a few calls in a row fail with a timeout or
+lost connection, the breaker opens, and calls are refused at once with
+StorageUnavailable instead of each waiting for the database to time out.
+After a while a single call is let through to test the database, and the
+breaker closes again if it succeeds.
+
+While the database is unavailable, CachedStorage serves sheets from its
+cache and holds writes in a WriteSpool, which is replayed in order once the
+database recovers.
+
+Classes
+-------
+StorageUnavailable
+    Raised when the database cannot be reached, or the breaker is open
+CircuitBreaker
+    Counts failures of the calls made through it, and refuses calls while
+    open
+WriteSpool
+    A bounded queue of writes, kept in a local file
+'''
+import json, os, threading, time
+from collections import deque
+
+class StorageUnavailable(Exception):
+    '''Raised instead of waiting on a database that is not answering.'''
+    pass
+
+class CircuitBreaker():
+    '''
+    Guards calls to a database. Closed, calls go through and consecutive
+    failures are counted. Open, calls are refused until reset_after seconds
+    have passed, then the breaker is half open and lets one trial call
+    through, which closes it if it succeeds and opens it again if not.
+
+    Attributes
+    ----------
+    errors : tuple
+        the exception types that mean the database is unavailable. any other
+        exception is the database answering, and counts as a success
+    outage : function
+        optional. given an exception of one of those types, returns whether
+        it really means the database is unavailable, for exception types
+        also raised by mistakes such as a malformed query
+    threshold : int
+        the number of consecutive failures that opens the breaker
+    reset_after : float
+        the number of seconds the breaker stays open before a trial call
+    state : str
+        closed, open or half open
+
+    Methods
+    -------
+    call
+        Calls a function through the breaker
+    stats
+        Returns the breaker's state and counters
+    '''
+
+    def __init__(self, errors=(), threshold=3, reset_after=10, outage=None):
+        self.errors = tuple(errors)
+        self.outage = outage
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.counts = {'calls' : 0, 'failures' : 0, 'rejected' : 0, 'opened' : 0}
+
+    def set_state(self, state):
+        if state != self.state:
+            print("Database circuit breaker {}".format(state))
+        self.state = state
+
+    def allow(self):
+        with self.lock:
+            self.counts['calls'] += 1
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_after:
+                self.set_state('half open')
+                return True
+            if self.state == 'closed':
+                return True
+            self.counts['rejected'] += 1 #open, or half open with a trial call already under way
+            return False
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.set_state('closed')
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.counts['failures'] += 1
+            if self.state == 'half open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.counts['opened'] += 1
+                self.opened_at = time.monotonic()
+                self.set_state('open')
+
+    def call(self, function, *args, **kwargs):
+        '''Calls function, raising StorageUnavailable if the breaker is open or
+        the call fails with one of the breaker's errors.
+        '''
+        if not self.allow():
+            raise StorageUnavailable('the database is unavailable')
+        try:
+            result = function(*args, **kwargs)
+        except self.errors as e:
+            if self.outage is not None and not self.outage(e):
+                self.succeeded()
+                raise
+            self.failed()
+            raise StorageUnavailable(str(e)) from e
+        except Exception:
+            self.succeeded()
+            raise
+        self.succeeded()
+        return result
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['state'] = self.state
+            stats['consecutive failures'] = self.failures
+            return stats
+
+class WriteSpool():
+    '''
+    Holds writes made while the database is unavailable, oldest first. Each
+    write is appended to a file as a line of JSON, so that spooled writes
+    survive a restart, and the file is rewritten as writes are replayed.
+
+    Attributes
+    ----------
+    path : str
+        the spool file, or None to keep the spool only in memory
+    limit : int
+        the most writes held. once full, further writes are refused with
+        StorageUnavailable rather than growing without limit
+
+    Methods
+    -------
+    append
+        Adds a write to the end of the spool
+    peek
+        Returns the oldest write
+    pop
+        Removes the oldest write
+    set_aside
+        Removes the oldest write, keeping it in a separate file of failed
+        writes
+    save
+        Rewrites the spool file with the writes still held
+    stats
+        Returns the number of writes waiting, replayed and dropped
+    '''
+
+    def __init__(self, path=None, limit=1000):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.entries = deque()
+        self.counts = {'spooled' : 0, 'replayed' : 0, 'dropped' : 0}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.entries.extend([json.loads(x) for x in f if x.strip() != ''])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, method, args):
+        entry = {'method' : method, 'args' : list(args)}
+        with self.lock:
+            if len(self.entries) >= self.limit:
+                raise StorageUnavailable('the database is unavailable and the write spool is full')
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            self.entries.append(entry)
+            self.counts['spooled'] += 1
+
+    def peek(self):
+        with self.lock:
+            if len(self.entries) == 0:
+                return None
+            return self.entries[0]
+
+    def pop(self, replayed=True):
+        with self.lock:
+            self.entries.popleft()
+            self.counts['replayed' if replayed else 'dropped'] += 1
+
+    def set_aside(self):
+        '''Removes the oldest write, which the database refused for a reason
+        other than being unavailable, and appends it to the spool's .failed
+        file so that it can be looked at or replayed by hand.
+        '''
+        with self.lock:
+            entry = self.entries.popleft()
+            self.counts['dropped'] += 1
+            if self.path is not None:
+                with open(self.path + '.failed', 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(temporary, self.path)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['waiting'] = len(self.entries)
+            return stats
\ No newline at end of file
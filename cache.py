@@ -0,0 +1,284 @@
+'''
+Created on Oct 19, 2026
+An in-process cache of stored character sheets, and the invalidation bus
+that keeps the caches of several bot processes (shards or replicas) in step.
+
+Whenever a process saves or deletes a sheet it publishes a (guild, user,
+version) event on the bus. Every other process evicts its cached copy of
+that sheet when the event arrives, so the next command reads it fresh. An
+event without a user evicts every sheet of the guild.
+
+The bus transport is chosen by the CACHE_BUS variable in the .env file:
+
+    none - (the default) no bus. only safe when a single process is running
+    local - an in-memory bus shared by everything in this process, for tests
+    socket - unix datagram sockets in the directory named by CACHE_BUS_PATH,
+             for processes running on the same machine
+    mongo - a capped collection in the bot's MongoDB, followed with a change
+            stream where the server supports them, or a tailable cursor
+            where it does not
+
+Methods
+-------
+get_bus
+    Returns the configured invalidation bus, creating it on first use
+
+Classes
+-------
+SheetCache
+    A bounded, least recently used cache of stored sheets
+LocalTransport
+    Delivers events to subscribers in this process
+SocketTransport
+    Delivers events between processes on one machine over unix sockets
+MongoTransport
+    Delivers events between processes through the bot's MongoDB
+InvalidationBus
+    Publishes events for local changes and applies events from elsewhere
+'''
+import os, json, socket, threading, time, uuid
+from collections import OrderedDict
+from copy import deepcopy
+
+class SheetCache():
+    '''
+    A bounded cache of stored sheets, keyed by server and user id. Copies
+    are handed out, since sheet instances modify the dictionaries they are
+    built from.
+
+    Methods
+    -------
+    get
+        Returns a copy of a cached sheet, or of only some of its fields, or None
+    put
+        Caches a sheet along with its version. with keep_newer, a copy
+        already cached with a later version is kept instead, so that a slow
+        read cannot replace a sheet written meanwhile
+    version
+        Returns the version of a cached sheet without copying it, or None
+    evict
+        Removes a sheet from the cache, unless the cached copy is newer
+        than the given version. removes it regardless if no version is given
+    evict_server
+        Removes every sheet of a server from the cache
+    clear
+        Empties the cache
+    '''
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, server_id, user_id, fields=None):
+        key = (str(server_id), user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        if fields is not None:
+            return deepcopy(dict([(x, entry[1][x]) for x in fields if x in entry[1]]))
+        return deepcopy(entry[1])
+
+    def put(self, server_id, user_id, doc, version, keep_newer=False):
+        if self.size <= 0:
+            return
+        key = (str(server_id), user_id)
+        doc = deepcopy(doc)
+        with self.lock:
+            entry = self.entries.get(key)
+            if keep_newer and entry is not None and entry[0] is not None and entry[0] > version:
+                return
+            self.entries[key] = (version, doc)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def version(self, server_id, user_id):
+        with self.lock:
+            entry = self.entries.get((str(server_id), user_id))
+        if entry is None:
+            return None
+        return entry[0]
+
+    def evict(self, server_id, user_id, version=None):
+        key = (str(server_id), user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (version is None or entry[0] <= version):
+                del self.entries[key]
+
+    def evict_server(self, server_id):
+        server_id = str(server_id)
+        with self.lock:
+            for key in [x for x in self.entries if x[0] == server_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class LocalTransport():
+    '''
+    Delivers events straight to every subscriber in this process. Each
+    subscriber stands in for a separate bot process, which makes this
+    transport useful for testing invalidation without running several.
+    '''
+
+    def __init__(self):
+        self.subscribers = []
+
+    def publish(self, event):
+        for callback in list(self.subscribers):
+            callback(dict(event))
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+class SocketTransport():
+    '''
+    Delivers events between processes on the same machine. Each process
+    binds a unix datagram socket in a shared directory, and publishing sends
+    the event to every other socket found there.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.address = os.path.join(path, '{}.sock'.format(str(os.getpid())))
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def publish(self, event):
+        data = json.dumps(event).encode()
+        for name in os.listdir(self.path):
+            address = os.path.join(self.path, name)
+            if address == self.address or not name.endswith('.sock'):
+                continue
+            try:
+                self.sender.sendto(data, address)
+            except ConnectionRefusedError: #left behind by a process that has exited
+                os.remove(address)
+            except OSError:
+                pass
+
+    def subscribe(self, callback):
+        def listen():
+            while True:
+                data = self.sock.recv(65536)
+                try:
+                    callback(json.loads(data.decode()))
+                except Exception as e:
+                    print("Invalid cache event: {}".format(str(e)))
+        threading.Thread(target=listen, name='cache bus', daemon=True).start()
+
+class MongoTransport():
+    '''
+    Delivers events between processes through a capped collection in the
+    bot's MongoDB. Change streams need a replica set, so a tailable cursor
+    is used on standalone servers.
+    '''
+
+    def __init__(self, db, size=1048576):
+        import pymongo
+        self.pymongo = pymongo
+        if 'cache events' not in db.list_collection_names():
+            try:
+                db.create_collection('cache events', capped=True, size=size)
+            except pymongo.errors.CollectionInvalid: #created by another process in the meantime
+                pass
+        self.collection = db['cache events']
+
+    def publish(self, event):
+        self.collection.insert_one(dict(event))
+
+    def subscribe(self, callback):
+        def listen():
+            try:
+                with self.collection.watch([{'$match' : {'operationType' : 'insert'}}]) as stream:
+                    for change in stream:
+                        callback(change['fullDocument'])
+            except self.pymongo.errors.OperationFailure: #not a replica set
+                self.tail(callback)
+        threading.Thread(target=listen, name='cache bus', daemon=True).start()
+
+    def tail(self, callback):
+        last = self.collection.find_one(sort=[('$natural', self.pymongo.DESCENDING)])
+        query = {}
+        if last is not None:
+            query = {'_id' : {'$gt' : last['_id']}}
+        while True:
+            cursor = self.collection.find(query, cursor_type=self.pymongo.CursorType.TAILABLE_AWAIT)
+            for event in cursor:
+                query = {'_id' : {'$gt' : event['_id']}}
+                callback(event)
+            time.sleep(1)
+
+class InvalidationBus():
+    '''
+    Publishes an event whenever this process saves or deletes a sheet, and
+    evicts sheets from this process's cache when other processes do.
+
+    Attributes
+    ----------
+    cache : SheetCache
+        the cache kept in step by this bus
+    transport
+        one of the transport classes, or None for no bus
+    origin : str
+        identifies this process, so it can ignore its own events
+    '''
+
+    def __init__(self, cache, transport=None):
+        self.cache = cache
+        self.transport = transport
+        self.origin = uuid.uuid4().hex
+        self.received = 0
+        if transport is not None:
+            transport.subscribe(self.receive)
+
+    def publish(self, server_id, user_id, version):
+        if self.transport is None:
+            return
+        try:
+            self.transport.publish({'guild' : str(server_id), 'user' : user_id, 'version' : version, 'origin' : self.origin})
+        except Exception as e:
+            print("Unable to publish cache event: {}".format(str(e)))
+
+    def receive(self, event):
+        if event.get('origin') == self.origin:
+            return
+        self.received += 1
+        if event['user'] is None: #a server wide update
+            self.cache.evict_server(event['guild'])
+        else:
+            self.cache.evict(event['guild'], event['user'], event.get('version'))
+
+bus = None
+
+def get_bus(db=None):
+    '''Returns the invalidation bus. db is the mongo database, needed only by
+    the mongo transport.
+    '''
+    global bus
+    if bus is None:
+        cache = SheetCache(int(os.environ.get('CACHE_SIZE', 1000)))
+        kind = os.environ.get('CACHE_BUS', 'none').lower()
+        transport = None
+        if kind == 'local':
+            transport = LocalTransport()
+        elif kind == 'socket':
+            transport = SocketTransport(os.environ.get('CACHE_BUS_PATH', '/tmp/godmachine-bus'))
+        elif kind == 'mongo' and db is not None:
+            transport = MongoTransport(db)
+        bus = InvalidationBus(cache, transport)
+    return bus
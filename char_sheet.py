@@ -5,14 +5,68 @@ Chronicles of Darkness character sheet
 
 @author: Fred
 '''
-import pymongo, os, random
-from dotenv import load_dotenv
-load_dotenv()
+import random, copy
+from storage import get_storage
+from journal import journal
+from name_index import NameIndex
+from splats import compile_schema
 
 men_skills = ['academics', 'computer', 'crafts', 'investigation', 'medicine', 'occult', 'politics', 'science']
 phy_skills = ['athletics', 'brawl', 'drive', 'firearms', 'larceny', 'stealth', 'survival', 'weaponry']
 soc_skills = ['animals', 'empathy', 'expression', 'intimidation', 'persuasion', 'socialize', 'streetwise', 'subterfuge']
 skill_list = men_skills+phy_skills+soc_skills
+attribute_list = ['intelligence', 'wits', 'resolve', 'strength', 'dexterity', 'stamina', 'presence', 'manipulation', 'composure']
+mortal_schema = compile_schema('mortal',
+                               attributes={'mental' : attribute_list[0:3], 'physical' : attribute_list[3:6], 'social' : attribute_list[6:9]},
+                               skills={'mental' : men_skills, 'physical' : phy_skills, 'social' : soc_skills},
+                               unskilled={'mental' : -3, 'physical' : -1, 'social' : -1},
+                               derived={'max wp' : (['resolve', 'composure'], 0), 'max health' : (['stamina'], 0),
+                                        'initiative' : (['dexterity', 'composure'], 0), 'speed' : (['strength', 'dexterity'], 0)})
+skill_index = NameIndex(skill_list)
+attribute_index = NameIndex(attribute_list)
+faces_list = range(1, 11)
+max_batch = 40
+max_pool = 100 #the most dice in a single roll, so that no roll holds up the bot
+too_many_dice = "Cannot roll more than {} dice at once.".format(str(max_pool))
+odds_dice = 4000000 #the most dice rolled, before explosions, to estimate the odds of an extended action
+min_simulations = 100 #fewer simulations than this are too rough to report
+compact_above = 20 #pools of more dice are shown as face counts unless detail is asked for
+page_length = 1800 #the text allowed for the faces of a single roll, leaving room for the rest of the message
+detail_pages = 5 #the most messages a detailed roll may fill
+sheet_fields = ['user id', 'splat', 'name', 'attributes', 'skills', 'merits', 'conditions', 'beats', 'experience',
+                'aspirations', 'integrity', 'willpower', 'virtue', 'vice', 'bashing', 'lethal', 'aggravated', 'macros', 'version']
+always_loaded = ['user id', 'splat', 'name', 'version', 'active'] #loaded even when a command asks for only some fields
+
+class SheetNotLoaded(AttributeError):
+    '''Raised when a field is used on a sheet that was loaded without it.'''
+    pass
+
+def get_explode_on(roll_type):
+    '''Returns the lowest face that explodes for a given roll type.'''
+    if roll_type == 'chance' or roll_type == 'noagain':
+        return 11
+    elif roll_type == '9again':
+        return 9
+    elif roll_type == '8again':
+        return 8
+    return 10
+
+def save_damage(server_id, sheets):
+    '''Writes the damage counters of several sheets from the same server with
+    a single bulk_write. Used to flush sheets held by a combat scene.
+    '''
+    updates = []
+    for sheet in sheets:
+        fields = {'bashing' : sheet.bashing, 'lethal' : sheet.lethal, 'aggravated' : sheet.aggravated}
+        changes = []
+        for field in fields:
+            if fields[field] != sheet.snapshot.get(field):
+                changes.append({'field' : field, 'old' : sheet.snapshot.get(field), 'new' : fields[field]})
+                sheet.snapshot[field] = fields[field]
+        updates.append((sheet.user_id, fields))
+        journal.record(server_id, sheet.user_id, changes)
+        sheet.dirty = False
+    get_storage().update_fields(server_id, updates)
 
 class mortal():
     '''
@@ -21,13 +75,18 @@ class mortal():
     
     Attributes
     -----------
+    schema : Schema
+        the stats of the gameline, shared by every sheet of the class
     server_id : int
         the discord server id for the originating server. serves as the
         collection name for the mongo db on which characters are stored.
     user_id : int
         the discord user id for the owner of this character sheet. serves
         to identify and search for the character in a given collection, selected
-        by the server_id
+        by the server_id. a player's characters after their first are stored
+        under a negative id of their own instead
+    owner : int
+        the discord user id of the player the character belongs to
     splat : str
         the gameline the character is from
     name : str
@@ -65,13 +124,42 @@ class mortal():
         the amount of lethal damage the character has received
     aggravated : int
         the amount of aggravated damage the character has received
+    macros : dic
+        a dictionary of saved rolls, keyed by macro name. each holds the roll
+        arguments, the dicepool compiled from them, and the skill and attribute
+        values the dicepool was compiled with
+    rolls : list
+        the pool, type, successes and explosions of each roll made by the most
+        recent roll_dice or roll_macro call. not saved to the database
+    version : int
+        the number of times the sheet has been saved. a save only succeeds if
+        the stored sheet still has the version this one was loaded with
+    snapshot : dic
+        the sheet as it was when loaded or last saved. save_sheet compares
+        against it to find the fields that changed
+    deferred : bool
+        when True, save_sheet only marks the sheet as dirty instead of writing
+        it. used by combat scenes, which write damage in bulk at scene end
+    dirty : bool
+        True if a save was skipped while the sheet was deferred
+    loaded : set
+        the fields the sheet was loaded with, or None if it was loaded whole.
+        using any other field raises SheetNotLoaded, and only these fields
+        are saved
+    indexes : dic
+        NameIndex instances for the sheet's conditions, aspirations, merits
+        and specialties, built when first needed and kept up to date after
         
     Methods
     -------
     find_sheet
-        Connects to the bot's MongoDB and returns the stored character sheet
+        Connects to the bot's storage and returns the stored character sheet
+    name_index
+        Returns the index used to look up a kind of name on the sheet
     save_sheet
-        Connects to the bot's MongoDB and updates the stored character sheet
+        Writes the fields of the character sheet that have changed since it
+        was loaded to the bot's storage, and records them in the journal,
+        unless saves are deferred
     unload
         Generates a dictionary based on the sheet's attributes, for storage
         in the bot's MongoDB
@@ -117,14 +205,36 @@ class mortal():
     set_vice
         sets the character's vice
     clear_sheet
-        deletes a sheet
+        deletes a sheet, keeping a copy in the journal so it can be undone
     parse_rollargs
         parses a list of arguments used to define a roll
     build_dicepool
         generates a dicepool of the correct size from a list of arguments
     roll_dice
         rolls dice, providing successes and explosions as defined by the output
-        of parse_rollargs and build_dicepool
+        of parse_rollargs and build_dicepool. outcomes are kept in rolls
+    resolve_roll
+        rolls a built dicepool and formats the result, summarising the faces
+        rolled when listing each die would be too long
+    split_pools
+        splits roll arguments into separate dicepools at semicolons
+    resolve_batch
+        rolls several dicepools, several times each, into one block of text
+    extended_roll
+        rolls an extended action until it succeeds or runs out of attempts
+    completion_odds
+        estimates the chance of an extended action succeeding
+    roll_batch
+        rolls a dicepool many times at once, returning successes and explosions
+    roll_pool
+        rolls the dice for a built dicepool one die at a time, yielding the
+        faces rolled for each
+    save_macro, del_macro
+        saves or removes a named roll, compiled into a dicepool
+    roll_macro
+        rolls a saved macro, recompiling it only if the stats it uses changed
+    displ_macros
+        Returns a formatted list of the character's macros
     max_health
         returns an integer representing the character's maximum derived health pool
     add_bashing
@@ -140,8 +250,9 @@ class mortal():
         reduces the character's damage by a given amount. restores to 0 if they
         go into the negatives
     '''
+    schema = mortal_schema
 
-    def __init__(self, server_id, info):
+    def __init__(self, server_id, info, fields=None):
         '''
         Initializing a sheet instance takes a discord server id and user id
         and collects that information from a mongo db, which is then used
@@ -155,14 +266,16 @@ class mortal():
         user_id : int
             a discord user id, which acts as a unique identifier for every
             character saved to a given collection in the database
+        fields : list
+            the fields info was loaded with, if the whole sheet was not
         '''
+        self.snapshot = copy.deepcopy(info)
         self.server_id = str(server_id)
         self.user_id = info.get("user id", 0)
+        self.owner = info.get("owner", self.user_id)
         self.splat = info.get("splat", "mortal")
         self.name = info.get("name", "Unnamed Character")
-        default_attributes = {'intelligence' : 1, 'wits' : 1, 'resolve' : 1,
-                              'strength' : 1, 'dexterity' : 1, 'stamina' : 1,
-                              'presence' : 1, 'manipulation' : 1, 'composure' : 1}
+        default_attributes = dict(self.schema.defaults)
         self.attributes = info.get("attributes", default_attributes)
         self.skills = info.get("skills", {})
         self.merits = info.get('merits', {})
@@ -177,14 +290,72 @@ class mortal():
         self.bashing = info.get('bashing', 0)
         self.lethal = info.get('lethal', 0)
         self.aggravated = info.get('aggravated', 0)
+        self.macros = info.get('macros', {})
+        self.version = info.get('version', 0)
+        self.rolls = []
+        self.deferred = False
+        self.dirty = False
+        self.indexes = {}
+        self.loaded = None
+        if fields != None:
+            self.loaded = set(fields) | set(always_loaded)
+            for field in sheet_fields:
+                if field not in self.loaded:
+                    delattr(self, field.replace(' ', '_'))
+
+    def __getattr__(self, name):
+        if self.__dict__.get('loaded') != None and name.replace('_', ' ') in sheet_fields:
+            raise SheetNotLoaded("{} was not loaded for this command".format(name))
+        raise AttributeError(name)
+    
+    def name_index(self, kind):
+        '''Returns the index of the sheet's conditions, aspirations or merits,
+        or of the specialties of a skill, building it the first time it is
+        asked for.
+        '''
+        if kind not in self.indexes:
+            if kind == 'conditions':
+                names = self.conditions
+            elif kind == 'aspirations':
+                names = self.aspirations
+            elif kind == 'merits':
+                names = self.merits
+            else:
+                names = self.skills.get(kind, [0])[1:]
+            self.indexes[kind] = NameIndex(names)
+        return self.indexes[kind]
     
     def save_sheet(self):
-        mongo_client = pymongo.MongoClient(os.environ.get('DB_HOST'), int(os.environ.get('DB_PORT')))
-        db = mongo_client[os.environ.get('DB_NAME')]
-        collection = db[self.server_id]
-        collection.replace_one({'user id' : self.user_id}, self.unload(), upsert=True)
+        if self.deferred: #the sheet is held by something that will save it later, such as a combat scene
+            self.dirty = True
+            return
+        doc = self.unload()
+        changes = {}
+        deltas = []
+        for field in doc:
+            if field == 'version':
+                continue
+            if field not in self.snapshot or doc[field] != self.snapshot[field]:
+                changes[field] = doc[field]
+                deltas.append({'field' : field, 'old' : self.snapshot.get(field), 'new' : doc[field]})
+        self.dirty = False
+        if len(changes) == 0:
+            return
+        doc['version'] = self.version + 1
+        changes['version'] = doc['version']
+        insert = doc
+        if self.loaded != None: #a partial sheet must never create a stored sheet
+            insert = None
+        #raises SheetConflict if the sheet has been saved by someone else since it was loaded
+        if get_storage().patch(self.server_id, self.user_id, changes, insert, self.version): #undoing the creation of a sheet deletes it
+            deltas = [{'field' : '*', 'old' : None, 'new' : None}]
+        self.version = doc['version']
+        journal.record(self.server_id, self.user_id, deltas)
+        self.snapshot = copy.deepcopy(doc)
         
     def unload(self):
+        if self.loaded != None:
+            return dict([(x, getattr(self, x.replace(' ', '_'))) for x in sheet_fields if x in self.loaded])
         result = {}
         result['user id'] = self.user_id
         result['splat'] = self.splat
@@ -203,6 +374,9 @@ class mortal():
         result['bashing'] = self.bashing
         result['lethal'] = self.lethal
         result['aggravated'] = self.aggravated
+        result['macros'] = self.macros
+        result['version'] = self.version
+        result['owner'] = self.owner #stored on every sheet, so that the unique index on owner and name covers the first too
         
         return result
     
@@ -212,7 +386,7 @@ class mortal():
         return "{}'s new name has been saved!".format(self.name)
     
     def set_attrib(self, attribute, user_input):
-        attribute = attribute.lower()
+        attribute = attribute_index.resolve(attribute) or attribute.lower()
         if attribute in self.attributes:
             if user_input > 0:
                 self.attributes[attribute] = user_input
@@ -224,9 +398,9 @@ class mortal():
             return "Invalid attribute selected: {}".format(attribute.title())
         
     def set_skill(self, skill, user_input):
-        skill = skill.lower()
-        if skill not in skill_list:
-            return "Skill does not exist. Valid skills are: {}".format(', '.join(skill_list))
+        skill = skill_index.resolve(skill)
+        if skill == None:
+            return "Skill does not exist. Valid skills are: {}".format(', '.join(self.schema.skills))
         if skill in self.skills: #First we check to see if the character already knows the skill. We don't want to erase specialties by accident.
             if user_input > 0 or len(self.skills[skill]) > 1: #If it's greater than 0 or it has a specialty, we set the new skill level
                 if user_input < 0:
@@ -248,28 +422,29 @@ class mortal():
                 return "Skill levels must be greater than 0."
             
     def add_specialty(self, skill, specialty):
-        skill = skill.lower()
+        skill = skill_index.resolve(skill)
         specialty = specialty.lower()
-        if skill not in skill_list:
-            return "Skill does not exist. Valid skills are: {}".format(', '.join(skill_list))
+        if skill == None:
+            return "Skill does not exist. Valid skills are: {}".format(', '.join(self.schema.skills))
         if skill in self.skills:
-            existing = self.skills[skill]
-            if specialty in existing:
+            if specialty in self.name_index(skill):
                 return "{} already has that specialty.".format(self.name)
             self.skills[skill].append(specialty)
         else:
             self.skills[skill] = []
             self.skills[skill].append(0)
             self.skills[skill].append(specialty)
+        self.name_index(skill).add(specialty)
         self.save_sheet()
         return "{} now has the specialty {} in {}.".format(self.name, specialty.title(), skill.title())
     
     def del_specialty(self, skill, specialty):
-        skill = skill.lower()
-        specialty = specialty.lower()
+        skill = skill_index.resolve(skill) or skill.lower()
         if skill in self.skills:
-            if specialty in self.skills[skill]:
-                self.skills[skill].pop(self.skills[skill].index(specialty))
+            specialty = self.name_index(skill).resolve(specialty)
+            if specialty != None:
+                self.skills[skill].pop(self.skills[skill].index(specialty, 1))
+                self.name_index(skill).remove(specialty)
                 self.save_sheet()
                 return "{} has been removed.".format(specialty.title())
             else:
@@ -279,6 +454,8 @@ class mortal():
         
     def set_merit(self, merit, user_input):
         merit = merit.lower()
+        if user_input <= 0: #a new merit may be close to an existing one, so only removals are matched loosely
+            merit = self.name_index('merits').resolve(merit) or merit
         if merit in self.merits:
             if user_input > 0:
                 self.merits[merit] = user_input
@@ -286,11 +463,13 @@ class mortal():
                 return "{} is now {}.".format(merit.title(), str(self.merits[merit]))
             else:
                 del self.merits[merit]
+                self.name_index('merits').remove(merit)
                 self.save_sheet()
                 return "{} has been removed.".format(merit.title())
         else:
             if user_input > 0:
                 self.merits[merit] = user_input
+                self.name_index('merits').add(merit)
                 self.save_sheet()
                 return "{} is now {}.".format(merit.title(), str(self.merits[merit]))
             else:
@@ -298,14 +477,18 @@ class mortal():
             
     def add_con(self, condition):
         condition = condition.lower()
+        if condition in self.name_index('conditions'):
+            return "{} is already afflicted with {}.".format(self.name, condition.title())
         self.conditions.append(condition)
+        self.name_index('conditions').add(condition)
         self.save_sheet()
         return "{} is now afflicted with {}!".format(self.name, condition.title())
     
     def del_con(self, condition):
-        condition = condition.lower()
-        if condition in self.conditions:
-            self.conditions.pop(self.conditions.index(condition))
+        condition = self.name_index('conditions').resolve(condition)
+        if condition != None:
+            self.conditions = [x for x in self.conditions if x.casefold() != condition.casefold()] #along with any duplicates from older sheets
+            self.name_index('conditions').remove(condition)
             self.save_sheet()
             return "{} has been removed.".format(condition.title())
         else:
@@ -335,20 +518,25 @@ class mortal():
             return "Cannot spend more experience than you have!"
         
     def add_aspir(self, aspir):
+        if aspir in self.name_index('aspirations'):
+            return "{} already has that aspiration.".format(self.name)
         self.aspirations.append(aspir)
+        self.name_index('aspirations').add(aspir)
         self.save_sheet()
         return "{} now has the aspiration {}".format(self.name, aspir)
     
     def del_aspir(self, aspir):
-        if aspir in self.aspirations:
-            self.aspirations.pop(self.aspirations.index(aspir))
+        aspir = self.name_index('aspirations').resolve(aspir)
+        if aspir != None:
+            self.aspirations = [x for x in self.aspirations if x.casefold() != aspir.casefold()]
+            self.name_index('aspirations').remove(aspir)
             self.save_sheet()
-            return "Aspiration removed."
+            return "Aspiration removed: {}".format(aspir)
         else:
-            return "{} does not have that aspiration. Please be certain that all capitalization, spelling and punctuation is 1:1.".format(self.name)
+            return "{} does not have that aspiration.".format(self.name)
         
     def max_wp(self):
-        return self.attributes['resolve'] + self.attributes['composure']
+        return self.schema.derive('max wp', self.attributes)
     
     def mod_integ(self, value):
         if value >= 0:
@@ -386,16 +574,12 @@ class mortal():
         '''Returns a block of text containing the character's skills and specialties
         in a more readable format.
         '''
-        mental = {}
-        physical = {}
-        social = {}
+        categories = {'mental' : {}, 'physical' : {}, 'social' : {}}
         for x in self.skills:
-            if x in men_skills:
-                mental[x] = self.skills[x]
-            elif x in phy_skills:
-                physical[x] = self.skills[x]
-            elif x in soc_skills:
-                social[x] = self.skills[x]
+            category = self.schema.skill_category.get(x)
+            if category != None:
+                categories[category][x] = self.skills[x]
+        mental, physical, social = categories['mental'], categories['physical'], categories['social']
         result = "__**Skills**__\n"
         result += "**Mental Skills**\n"
         for x in mental:
@@ -453,7 +637,7 @@ class mortal():
         return results
         
     def get_initiative(self):
-        result = self.attributes['dexterity'] + self.attributes['composure']
+        result = self.schema.derive('initiative', self.attributes)
         if 'fast reflexes' in self.merits:
             result += self.merits['fast reflexes']
         return result
@@ -481,7 +665,7 @@ class mortal():
         return result
     
     def get_speed(self):
-        return self.attributes['strength']+self.attributes['dexterity']+self.get_size()
+        return self.schema.derive('speed', self.attributes)+self.get_size()
     
     def set_virtue(self, value):
         self.virtue = value
@@ -494,19 +678,17 @@ class mortal():
         return "Vice has been set to {}".format(self.vice.title())
     
     def clear_sheet(self):
-        mongo_client = pymongo.MongoClient(os.environ.get('DB_HOST'), int(os.environ.get('DB_PORT')))
-        db = mongo_client[os.environ.get('DB_NAME')]
-        collection = db[self.server_id]
-        collection.delete_one({'user id' : self.user_id})
+        get_storage().delete(self.server_id, self.user_id)
+        journal.record(self.server_id, self.user_id, [{'field' : '*', 'old' : self.unload(), 'new' : None}])
         return "Character {} has been deleted.".format(self.name)
     
     def parse_rollargs(self, arglist=[]):
-        result = {'type' : 'normal', 'skills' : [], 'attributes' : [], 'rote' : False, 'specialty' : [], 'math' : []}
+        result = {'type' : 'normal', 'skills' : [], 'attributes' : [], 'rote' : False, 'specialty' : [], 'math' : [], 'times' : 1}
         if len(arglist) != 0:
             for x in arglist:
                 if type(x) == str:
                     x = x.lower()
-                if x in skill_list:
+                if x in self.schema.skill_category:
                     result['skills'].append(x)
                 elif x in self.attributes:
                     result['attributes'].append(x)
@@ -514,6 +696,10 @@ class mortal():
                     result['type'] = x
                 elif x == 'rote':
                     result['rote'] = True
+                elif x == 'detail':
+                    result['detail'] = True
+                elif x[0] == "x" and x[1:].isnumeric() and int(x[1:]) > 0:
+                    result['times'] = int(x[1:])
                 elif x[0] == "(" and x[-1] == ")":
                     result['specialty'].append(x.strip('()'))
                 elif x[0] == "+" or x[0] == "-":
@@ -527,26 +713,20 @@ class mortal():
     def build_dicepool(self, argdic):
         pool = 0
         if argdic['type'] == 'chance':
-            pool = 1
-            return pool
+            argdic['pool'] = 1
+            return argdic
         for skill in argdic['skills']:
             if skill in self.skills: #if they have the skill
                 if self.skills[skill][0] > 0: #If it is trained
                     pool += self.skills[skill][0]
                 else: #if it is untrained
-                    if skill in men_skills:
-                        pool -= 3
-                    elif skill in phy_skills or skill in soc_skills:
-                        pool -= 1
+                    pool += self.schema.unskilled[skill]
                 if len(self.skills[skill]) > 1:
                     for spec in self.skills[skill][1:]:
                         if spec in argdic['specialty']:
                             pool += 1
             else:
-                if skill in men_skills:
-                    pool -= 3
-                elif skill in phy_skills or skill in soc_skills:
-                    pool -= 1
+                pool += self.schema.unskilled[skill]
         for attrib in argdic['attributes']:
             pool += self.attributes[attrib]
         for num in argdic['math']:
@@ -561,51 +741,240 @@ class mortal():
         return argdic
     
     def roll_dice(self, arglist):
-        rules = self.parse_rollargs(arglist)
-        rules = self.build_dicepool(rules)
-        roll_results = []
+        self.rolls = []
+        rules = [self.build_dicepool(self.parse_rollargs(x)) for x in self.split_pools(arglist)]
+        if len(rules) == 1 and rules[0]['times'] == 1:
+            return self.resolve_roll(rules[0])
+        return self.resolve_batch(rules)
+    
+    def split_pools(self, arglist):
+        '''Splits roll arguments into separate dicepools wherever an argument
+        ends with a semicolon.
+        '''
+        pools = [[]]
+        for x in arglist:
+            if type(x) == str and x.endswith(';'):
+                x = x.rstrip(';')
+                if x != '':
+                    pools[-1].append(x)
+                pools.append([])
+            else:
+                pools[-1].append(x)
+        pools = [x for x in pools if len(x) > 0]
+        if len(pools) == 0:
+            pools = [[]]
+        return pools
+    
+    def resolve_batch(self, rule_list):
+        '''Rolls several built dicepools, each as many times as its rules ask,
+        and returns the results as a single compact block of text.
+        '''
+        total = sum([x.get('times', 1) for x in rule_list])
+        if total > max_batch:
+            return "Cannot make more than {} rolls at once.".format(str(max_batch))
+        if max([x['pool'] for x in rule_list]) > max_pool:
+            return too_many_dice
+        result = ""
+        all_successes = []
+        for rules in rule_list:
+            times = rules.get('times', 1)
+            outcomes = self.roll_batch(rules, times)
+            if rules['type'] == 'chance':
+                result += "__**{} x a chance die**__\n".format(str(times))
+            elif rules['type'] == 'normal':
+                result += "__**{} x {} dice**__\n".format(str(times), str(rules['pool']))
+            else:
+                result += "__**{} x {} dice, {}**__\n".format(str(times), str(rules['pool']), rules['type'])
+            for i, (successes, explosions) in enumerate(outcomes):
+                self.rolls.append({'pool' : rules['pool'], 'type' : rules['type'], 'rote' : rules['rote'],
+                                   'successes' : successes, 'explosions' : explosions})
+                all_successes.append(successes)
+                if explosions > 0:
+                    result += "#{}: **{}** ({} explosions)\n".format(str(i+1), str(successes), str(explosions))
+                else:
+                    result += "#{}: **{}**\n".format(str(i+1), str(successes))
+        if total > 1:
+            failures = len([x for x in all_successes if x == 0])
+            exceptional = len([x for x in all_successes if x >= 5])
+            result += "**Total:** {} successes, {:.2f} average, {} exceptional, {} failed".format(str(sum(all_successes)), sum(all_successes) / total, str(exceptional), str(failures))
+        return result
+    
+    def extended_roll(self, target, arglist):
+        '''Rolls an extended action: the same dicepool is rolled until the
+        target number of successes is reached or the attempts run out.
+        
+        Besides the usual roll arguments, accepts:
+            tries<N>
+                the maximum number of rolls. defaults to the size of the pool
+            penalty<N>
+                removes N more dice from each successive roll
+            odds
+                estimates the chance of completing the action by simulating it
+        '''
+        self.rolls = []
+        tries = None
+        penalty = 0
+        odds = False
+        rollargs = []
+        for x in arglist:
+            arg = str(x).lower()
+            if arg.startswith('tries') and arg[5:].isnumeric():
+                tries = int(arg[5:])
+            elif arg.startswith('penalty') and arg[7:].isnumeric():
+                penalty = int(arg[7:])
+            elif arg == 'odds':
+                odds = True
+            else:
+                rollargs.append(x)
+        if target <= 0:
+            return "An extended action needs a target of at least 1 success."
+        if tries == None:
+            tries = self.build_dicepool(self.parse_rollargs(rollargs))['pool']
+        tries = max(1, min(tries, max_batch))
+        rule_list = []
+        for attempt in range(tries):
+            rule_list.append(self.build_dicepool(self.parse_rollargs(rollargs + ['-' + str(attempt * penalty)])))
+        if rule_list[0]['pool'] > max_pool: #penalties only shrink the later rolls
+            return too_many_dice
+        
+        total = 0
+        results = []
+        for rules in rule_list:
+            successes, explosions = self.roll_batch(rules, 1)[0]
+            self.rolls.append({'pool' : rules['pool'], 'type' : rules['type'], 'rote' : rules['rote'],
+                               'successes' : successes, 'explosions' : explosions})
+            total += successes
+            results.append(str(successes))
+            if total >= target:
+                break
+        if rule_list[0]['type'] == 'chance':
+            pool = 'a chance die'
+        else:
+            pool = "{} dice".format(str(rule_list[0]['pool']))
+        result = "__**Extended action:**__ {} successes needed, up to {} rolls of {}".format(str(target), str(tries), pool)
+        if penalty > 0:
+            result += ", -{} per roll".format(str(penalty))
+        result += "\nRolls: {}\n".format(", ".join(results))
+        if total >= target:
+            result += "**Completed after {} rolls** with {} successes.".format(str(len(results)), str(total))
+        else:
+            result += "**Not completed.** {} of {} successes after {} rolls.".format(str(total), str(target), str(len(results)))
+        if odds:
+            chance = self.completion_odds(rule_list, target)
+            if chance == None:
+                result += "\nThe dice pool is too large to estimate the chance of completing."
+            else:
+                result += "\nChance of completing: {:.0%}".format(chance)
+        return result
+    
+    def completion_odds(self, rule_list, target, simulations=2000):
+        '''Estimates the chance of reaching a number of successes within a
+        list of built dicepools by rolling the whole sequence many times.
+        Large pools are simulated fewer times, so that no more than odds_dice
+        dice are rolled. Returns None if that leaves too few simulations.
+        '''
+        dice = sum([x['pool'] for x in rule_list])
+        simulations = min(simulations, odds_dice // max(1, dice))
+        if simulations < min_simulations:
+            return None
+        totals = [0] * simulations
+        for rules in rule_list:
+            for i, (successes, _) in enumerate(self.roll_batch(rules, simulations)):
+                totals[i] += successes
+        return len([x for x in totals if x >= target]) / simulations
+    
+    def roll_batch(self, rules, times):
+        '''Rolls a built dicepool several times at once, returning a list of
+        (successes, explosions) for each roll. Rather than rolling die by die,
+        every die of every roll is rolled in one draw, then every rote reroll,
+        then every explosion, and so on until no dice explode.
+        '''
+        explode_on = get_explode_on(rules['type'])
+        successes = [0] * times
+        explosions = [0] * times
+        owners = [i for i in range(times) for _ in range(rules['pool'])]
+        faces = random.choices(faces_list, k=len(owners))
+        if rules['rote'] == True:
+            failed = [i for i in range(len(faces)) if faces[i] < 8]
+            for i, face in zip(failed, random.choices(faces_list, k=len(failed))):
+                faces[i] = face
+        if rules['type'] == 'chance':
+            for owner, face in zip(owners, faces):
+                if face == 10:
+                    successes[owner] += 1
+            return list(zip(successes, explosions))
+        while len(owners) > 0:
+            exploding = []
+            for owner, face in zip(owners, faces):
+                if face >= 8:
+                    successes[owner] += 1
+                if face >= explode_on:
+                    explosions[owner] += 1
+                    exploding.append(owner)
+            owners = exploding
+            faces = random.choices(faces_list, k=len(owners))
+        return list(zip(successes, explosions))
+    
+    
+    def resolve_roll(self, rules):
+        '''Rolls a built dicepool, adds the outcome to rolls and returns the
+        formatted result.
+        
+        The faces of each die are listed for small pools. Larger pools, and
+        any roll whose listing would not fit in a message, show how many of
+        each face came up instead. With the detail argument every die is
+        listed, over several messages if need be, up to detail_pages. Dice are
+        rolled and tallied one at a time, so the text kept never exceeds what
+        will be sent.
+        '''
+        if rules['pool'] > max_pool:
+            return too_many_dice
+        detail = rules.get('detail', False)
+        budget = page_length
+        if detail:
+            budget = page_length * detail_pages
+        listing = []
+        length = 0
+        if rules['pool'] > compact_above and not detail:
+            listing = None
+        omitted = 0
+        counts = [0] * 11
         successes = 0
         explosions = 0
-        explode_on = 10
-        
-        if rules['type'] == 'chance' or rules['type'] == 'noagain':
-            explode_on = 11
-        elif rules['type'] == '9again':
-            explode_on = 9
-        elif rules['type'] == '8again':
-            explode_on = 8
-            
-        for _ in range(rules['pool']):
-            roll_list = []
-            roll = random.randint(1,10)
-            roll_list.append(roll)
-            if rules['rote'] == True and roll < 8:
-                roll = random.randint(1,10)
-                roll_list.append(roll)
-            if roll >= 8 and rules['type'] != 'chance':
-                successes += 1
-                while roll >= explode_on:
-                    explosions += 1
-                    roll = random.randint(1,10)
-                    roll_list.append(roll)
-                    if roll >= 8:
-                        successes += 1
-            elif rules['type'] == 'chance' and roll == 10:
-                successes += 1
-            if len(roll_list) == 1:
-                roll_results.append(str(roll_list[0]))
+        for chain in self.roll_pool(rules):
+            for face in chain:
+                counts[face] += 1
+            kept = 0
+            if rules['rote'] == True and chain[0] < 8: #the first face was rerolled and does not count
+                kept = 1
+            if rules['type'] == 'chance':
+                successes += int(chain[kept] == 10)
             else:
-                outcome = str(roll_list[0])
-                roll_list = roll_list[1:]
-                if len(roll_list) > 1:
-                    string_ints = [str(i) for i in roll_list]
-                    roll_list = ", ".join(string_ints)
-                else:
-                    roll_list = str(roll_list[0])
-                outcome += "("+roll_list+")"
-                roll_results.append(outcome)
-                
-        roll_results = ", ".join(roll_results)
+                successes += len([x for x in chain[kept:] if x >= 8])
+                explosions += len(chain) - kept - 1
+            if listing == None:
+                continue
+            text = str(chain[0])
+            if len(chain) > 1:
+                text += "(" + ", ".join([str(x) for x in chain[1:]]) + ")"
+            if length + len(text) + 2 > budget:
+                if not detail: #too long to list, so fall back to the face counts
+                    listing = None
+                    continue
+                omitted += 1
+                continue
+            listing.append(text)
+            length += len(text) + 2
+        self.rolls.append({'pool' : rules['pool'], 'type' : rules['type'], 'rote' : rules['rote'],
+                           'successes' : successes, 'explosions' : explosions})
+        if listing != None:
+            roll_results = ", ".join(listing)
+            if detail and length > page_length: #lets the dispatcher split the listing between lines
+                roll_results = ",\n".join([", ".join(listing[i:i+20]) for i in range(0, len(listing), 20)])
+            if omitted > 0:
+                roll_results += "\n...and {} more dice".format(str(omitted))
+        else:
+            roll_results = "Faces rolled: " + ", ".join(["{} x{}".format(str(x), str(counts[x])) for x in range(10, 0, -1) if counts[x] > 0])
         if rules['pool'] > 1:
             dice_word = 'dice'
         else:
@@ -614,8 +983,88 @@ class mortal():
             rules['pool'] = 'a chance'
         return "You rolled {} {}!\n**{} successes** and {} explosions\n{}".format(str(rules['pool']), dice_word, str(successes), str(explosions), roll_results)
     
+    def macro_inputs(self, rules):
+        '''Returns the current value of every skill and attribute a set of roll
+        rules refers to. A compiled macro is only valid while these match.
+        '''
+        inputs = {}
+        for skill in rules['skills']:
+            if skill in self.skills:
+                inputs['skill ' + skill] = list(self.skills[skill])
+            else:
+                inputs['skill ' + skill] = None
+        for attrib in rules['attributes']:
+            inputs['attribute ' + attrib] = self.attributes[attrib]
+        return inputs
+    
+    def compile_macro(self, arglist):
+        rules = self.build_dicepool(self.parse_rollargs(arglist))
+        return {'args' : list(arglist), 'rules' : rules, 'inputs' : self.macro_inputs(rules)}
+    
+    def save_macro(self, name, arglist):
+        name = name.lower()
+        if len(arglist) == 0:
+            return "A macro needs something to roll."
+        self.macros[name] = self.compile_macro(arglist)
+        self.save_sheet()
+        return "{} saved the macro {}: {}".format(self.name, name, " ".join(arglist))
+    
+    def del_macro(self, name):
+        name = name.lower()
+        if name in self.macros:
+            del self.macros[name]
+            self.save_sheet()
+            return "Macro {} has been removed.".format(name)
+        else:
+            return "{} does not have a macro named {}.".format(self.name, name)
+    
+    def roll_macro(self, name, arglist=[]):
+        '''Rolls a saved macro. The compiled dicepool is used as is unless a
+        skill or attribute it refers to has changed since it was compiled, in
+        which case it is compiled again and saved. Any additional arguments
+        are rolled through the usual parser along with the macro's own.
+        '''
+        name = name.lower()
+        self.rolls = []
+        if name not in self.macros:
+            return "{} does not have a macro named {}.".format(self.name, name)
+        macro = self.macros[name]
+        if len(arglist) > 0:
+            return self.roll_dice(macro['args'] + list(arglist))
+        if macro['inputs'] != self.macro_inputs(macro['rules']):
+            macro = self.compile_macro(macro['args'])
+            self.macros[name] = macro
+            self.save_sheet()
+        if macro['rules'].get('times', 1) > 1:
+            return self.resolve_batch([macro['rules']])
+        return self.resolve_roll(dict(macro['rules']))
+    
+    def displ_macros(self):
+        result = "__**Macros**__\n"
+        for x in self.macros:
+            result += "**{}:** {}\n".format(x, " ".join(self.macros[x]['args']))
+        return result
+    
+    def roll_pool(self, rules):
+        '''Rolls the dice described by a built dicepool, yielding one list per
+        die: the face first rolled, then its rote reroll if it had one, then
+        any explosions.
+        '''
+        explode_on = get_explode_on(rules['type'])
+        for _ in range(rules['pool']):
+            roll = random.randint(1,10)
+            chain = [roll]
+            if rules['rote'] == True and roll < 8:
+                roll = random.randint(1,10)
+                chain.append(roll)
+            if rules['type'] != 'chance':
+                while roll >= explode_on:
+                    roll = random.randint(1,10)
+                    chain.append(roll)
+            yield chain
+    
     def max_health(self):
-        return int(self.get_size()+self.attributes['stamina'])
+        return int(self.get_size()+self.schema.derive('max health', self.attributes))
     
     def add_bashing(self, val):
         response = ""
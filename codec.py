@@ -0,0 +1,131 @@
+'''
+Created on Oct 19, 2026
+Converts character sheets between the documents the rest of the bot works
+with and the compact form they are stored in. Stored sheets use short keys,
+keep attributes as an array in a fixed order, and split skills into an
+array of ratings and an array of specialties, which makes them much smaller
+to store, index and send over the wire.
+
+The order of attributes and skills is part of the stored format, so it is
+fixed here rather than taken from the splat schemas, and may only ever be
+added to. Anything the codec does not know about is stored as it is.
+
+Stored sheets carry their codec version under '_s'. The backend stamps each
+stored sheet with the time it was last written, under 't', which backup.py
+uses to find the sheets changed since its last run. Sheets without one were
+written before the codec existed, and decode leaves them as they are. The
+SQLite backend finds them by its own key columns and converts each on its
+next write. The Mongo backend looks sheets up by their stored user id,
+which old sheets lack, so it refuses to serve a server holding any, raising
+SheetsNotMigrated, until migrate.py has converted them.
+
+Methods
+-------
+encode
+    Converts a sheet, or some fields of one, to its stored form
+decode
+    Converts a stored sheet back
+key
+    Returns the stored key of a field, for use in queries
+stored_fields
+    Returns the stored keys needed to load a list of fields
+attribute_position
+    Returns the position of an attribute in the stored array
+'''
+
+codec_version = 1
+schema_key = '_s'
+keys = {'user id' : 'u', 'splat' : 'sp', 'name' : 'n', 'attributes' : 'a', 'merits' : 'm', 'conditions' : 'c',
+        'beats' : 'b', 'experience' : 'x', 'aspirations' : 'as', 'integrity' : 'i', 'willpower' : 'wp',
+        'virtue' : 'vi', 'vice' : 'vc', 'bashing' : 'hb', 'lethal' : 'hl', 'aggravated' : 'ha', 'macros' : 'mc',
+        'version' : 'r', 'modified' : 't', 'owner' : 'o', 'active' : 'ac'}
+names = dict([(keys[x], x) for x in keys])
+attribute_order = ('intelligence', 'wits', 'resolve', 'strength', 'dexterity', 'stamina', 'presence', 'manipulation', 'composure')
+skill_order = ('academics', 'computer', 'crafts', 'investigation', 'medicine', 'occult', 'politics', 'science',
+               'athletics', 'brawl', 'drive', 'firearms', 'larceny', 'stealth', 'survival', 'weaponry',
+               'animals', 'empathy', 'expression', 'intimidation', 'persuasion', 'socialize', 'streetwise', 'subterfuge')
+attribute_positions = dict([(x, i) for i, x in enumerate(attribute_order)])
+skill_positions = dict([(x, i) for i, x in enumerate(skill_order)])
+
+def key(field):
+    return keys.get(field, field)
+
+def attribute_position(attribute):
+    return attribute_positions[attribute]
+
+def stored_fields(fields):
+    result = []
+    for field in fields:
+        if field == 'attributes':
+            result += ['a', 'ae']
+        elif field == 'skills':
+            result += ['kr', 'ks', 'ke']
+        else:
+            result.append(key(field))
+    return result
+
+def encode(doc, partial=False):
+    '''Returns the stored form of a sheet. With partial, only the fields given
+    are converted and the codec version is left out, for updating some
+    fields of a stored sheet.
+    '''
+    stored = {}
+    for field in doc:
+        value = doc[field]
+        if field == 'attributes':
+            stored['a'] = [value.get(x) for x in attribute_order]
+            extra = dict([(x, value[x]) for x in value if x not in attribute_positions]) #attributes of other splats
+            if partial or len(extra) > 0: #a partial update must clear any that were removed
+                stored['ae'] = extra
+        elif field == 'skills':
+            ratings = [None] * len(skill_order)
+            specialties = [[] for _ in skill_order]
+            extra = {}
+            for skill in value:
+                if skill in skill_positions:
+                    ratings[skill_positions[skill]] = value[skill][0]
+                    specialties[skill_positions[skill]] = list(value[skill][1:])
+                else:
+                    extra[skill] = value[skill]
+            while len(specialties) > 0 and len(specialties[-1]) == 0:
+                specialties.pop()
+            stored['kr'] = ratings
+            if partial or len(specialties) > 0:
+                stored['ks'] = specialties
+            if partial or len(extra) > 0:
+                stored['ke'] = extra
+        else:
+            stored[key(field)] = value
+    if not partial:
+        stored[schema_key] = codec_version
+    return stored
+
+def decode(stored):
+    '''Returns the sheet a stored document holds. Documents written before
+    the codec existed are returned unchanged.
+    '''
+    if stored is None or schema_key not in stored:
+        return stored
+    doc = {}
+    for field in stored:
+        value = stored[field]
+        if field == schema_key or field in ['ae', 'ks', 'ke']:
+            continue
+        elif field == 'a':
+            attributes = dict([(x, y) for x, y in zip(attribute_order, value) if y is not None])
+            attributes.update(stored.get('ae', {}))
+            doc['attributes'] = attributes
+        elif field == 'kr':
+            specialties = stored.get('ks', [])
+            skills = {}
+            for i, rating in enumerate(value):
+                if rating is not None:
+                    skill = [rating]
+                    if i < len(specialties):
+                        skill += specialties[i]
+                    skills[skill_order[i]] = skill
+            skills.update(stored.get('ke', {}))
+            doc['skills'] = skills
+        else:
+            doc[names.get(field, field)] = value
+    return doc
\ No newline at end of file
@@ -0,0 +1,189 @@
+'''
+Created on Oct 19, 2026
+Keeps track of combat scenes, one per discord channel. A scene holds the
+initiative order of every participant and the character sheets of the
+players involved, so that damage taken during the fight does not need to
+load and save a sheet every time. Damage is written in bulk when the scene
+ends.
+
+Turn order for the current round is kept in a heap, so late joiners and
+delayed actions are inserted in O(log n) rather than re-sorting the whole
+order.
+
+Methods
+-------
+get_scene
+    Returns the scene running in a channel, if there is one
+start_scene
+    Starts a new scene in a channel
+end_scene
+    Removes a channel's scene, returning it
+
+Classes
+-------
+Combatant
+    A single participant in a combat scene
+CombatScene
+    The initiative order and cached sheets of a single fight
+'''
+import heapq, random
+from itertools import count
+
+scenes = {}
+
+class Combatant():
+    '''
+    A single participant in a combat scene. Players carry their character
+    sheet, NPCs do not.
+
+    Attributes
+    ----------
+    name : str
+        the name displayed in the initiative order
+    modifier : int
+        the initiative modifier the initiative roll was made with
+    initiative : int
+        the current initiative. changed when a combatant delays
+    sheet : mortal
+        the character sheet of a player, or None for an NPC
+    stamp : int
+        identifies the combatant's current entry in the turn heap. entries
+        with an older stamp are discarded when they reach the top
+    '''
+
+    def __init__(self, name, modifier, sheet=None):
+        self.name = name
+        self.modifier = modifier
+        self.initiative = modifier + random.randint(1,10)
+        self.sheet = sheet
+        self.stamp = 0
+
+class CombatScene():
+    '''
+    The initiative order of a single fight.
+
+    Attributes
+    ----------
+    guild_id : int
+        the discord server the scene is running in
+    channel_id : int
+        the discord channel the scene is running in
+    combatants : dic
+        every participant, keyed by lowercase name
+    pending : list
+        a heap of the participants yet to act this round
+    round : int
+        the current round, 0 before the first turn
+    current : Combatant
+        the participant whose turn it is
+
+    Methods
+    -------
+    add
+        Adds a participant, slotting them into the current round if their
+        initiative has not yet passed
+    remove
+        Removes a participant from the scene
+    find
+        Returns a participant by name
+    find_player
+        Returns the participant holding a given user's sheet
+    next_turn
+        Advances to the next participant, starting a new round as needed
+    delay
+        Moves the current participant to a lower initiative
+    display_order
+        Returns a formatted initiative order for posting to the discord
+    dirty_sheets
+        Returns the cached sheets that have taken unsaved damage
+    '''
+
+    def __init__(self, guild_id, channel_id):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.combatants = {}
+        self.pending = []
+        self.round = 0
+        self.current = None
+        self.counter = count()
+
+    def entry(self, combatant):
+        combatant.stamp = next(self.counter)
+        return (-combatant.initiative, -combatant.modifier, combatant.stamp, combatant.name.lower())
+
+    def add(self, combatant):
+        name = combatant.name
+        number = 2
+        while combatant.name.lower() in self.combatants: #duplicate NPC names are numbered
+            combatant.name = "{} {}".format(name, str(number))
+            number += 1
+        self.combatants[combatant.name.lower()] = combatant
+        if combatant.sheet != None:
+            combatant.sheet.deferred = True
+        if self.round > 0 and (self.current == None or combatant.initiative < self.current.initiative):
+            heapq.heappush(self.pending, self.entry(combatant))
+        return combatant
+
+    def remove(self, name):
+        combatant = self.combatants.pop(name.lower(), None)
+        if combatant != None and self.current is combatant:
+            self.current = None
+        return combatant
+
+    def find(self, name):
+        return self.combatants.get(name.lower())
+
+    def find_player(self, user_id):
+        for combatant in self.combatants.values():
+            if combatant.sheet != None and combatant.sheet.owner == user_id:
+                return combatant
+        return None
+
+    def next_turn(self):
+        if len(self.combatants) == 0:
+            return None
+        while True:
+            if len(self.pending) == 0:
+                self.round += 1
+                self.pending = [self.entry(x) for x in self.combatants.values()]
+                heapq.heapify(self.pending)
+            _, _, stamp, key = heapq.heappop(self.pending)
+            combatant = self.combatants.get(key)
+            if combatant != None and combatant.stamp == stamp: #stale entries belong to removed or delayed combatants
+                self.current = combatant
+                return combatant
+
+    def delay(self, initiative):
+        '''Moves the current participant to a lower initiative for the rest of
+        the scene, and advances to whoever is next.
+        '''
+        combatant = self.current
+        if combatant == None or initiative >= combatant.initiative:
+            return None
+        combatant.initiative = initiative
+        heapq.heappush(self.pending, self.entry(combatant))
+        self.current = None
+        return self.next_turn()
+
+    def display_order(self):
+        result = "__**Initiative, Round {}**__\n".format(str(self.round))
+        ordered = sorted(self.combatants.values(), key=lambda x: (-x.initiative, -x.modifier))
+        for x in ordered:
+            if x is self.current:
+                result += "**> {}\t{}**\n".format(str(x.initiative), x.name)
+            else:
+                result += "{}\t{}\n".format(str(x.initiative), x.name)
+        return result
+
+    def dirty_sheets(self):
+        return [x.sheet for x in self.combatants.values() if x.sheet != None and x.sheet.dirty]
+
+def get_scene(channel_id):
+    return scenes.get(channel_id)
+
+def start_scene(guild_id, channel_id):
+    scenes[channel_id] = CombatScene(guild_id, channel_id)
+    return scenes[channel_id]
+
+def end_scene(channel_id):
+    return scenes.pop(channel_id, None)
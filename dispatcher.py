@@ -0,0 +1,172 @@
+'''
+Created on Oct 19, 2026
+Queues the bot's responses per channel rather than sending them straight
+away. Each channel with pending responses has a worker that sends them in
+order of priority, keeping within discord's per channel rate limit on its
+own instead of running into it. Responses that pile up while the worker
+waits are combined into a single message where they fit, so a busy channel
+receives fewer, larger messages.
+
+Short interactive replies, like rolls, are sent ahead of bulk output, like
+full character sheets.
+
+Methods
+-------
+reply
+    Queues a response to the channel a command came from
+split_message
+    Splits text into pieces that each fit in a single discord message
+
+Classes
+-------
+Dispatcher
+    Holds the per channel queues and their workers
+'''
+import asyncio, time
+from collections import deque
+from itertools import count
+
+interactive = 0
+bulk = 1
+message_limit = 2000
+
+def split_message(content, limit=message_limit):
+    '''Splits text into pieces no longer than limit, breaking between lines
+    where possible.
+    '''
+    if len(content) <= limit:
+        return [content]
+    pieces = []
+    current = ""
+    for line in content.split("\n"):
+        while len(line) > limit: #a single line too long for a message
+            if current != "":
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:limit])
+            line = line[limit:]
+        if current == "":
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            pieces.append(current)
+            current = line
+    if current != "":
+        pieces.append(current)
+    return pieces
+
+class Dispatcher():
+    '''
+    Holds a priority queue of pending responses for each channel, and a
+    worker task per queue that sends them.
+
+    Attributes
+    ----------
+    burst : int
+        the number of messages a channel may be sent within per seconds
+    per : float
+        the length of the rate limit window, in seconds
+    idle : int
+        the number of seconds a worker waits for more responses before exiting
+    sent : int
+        the number of messages sent
+    responses : int
+        the number of responses queued
+    coalesced : int
+        the number of responses that were combined into another message
+
+    Methods
+    -------
+    send
+        Queues a response for a channel, starting its worker if needed
+    stats
+        Returns queue depths and counters for reporting
+    '''
+
+    def __init__(self, burst=5, per=5.0, idle=60):
+        self.burst = burst
+        self.per = per
+        self.idle = idle
+        self.queues = {}
+        self.counter = count()
+        self.sent = 0
+        self.responses = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def send(self, channel, content, author=None, priority=interactive):
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = asyncio.PriorityQueue()
+            self.queues[channel.id] = queue
+            asyncio.get_event_loop().create_task(self.work(channel, queue))
+        for piece in split_message(content):
+            queue.put_nowait((priority, next(self.counter), piece, author))
+        self.responses += 1
+        self.max_depth = max(self.max_depth, queue.qsize())
+
+    async def work(self, channel, queue):
+        try:
+            await self.drain(channel, queue)
+        finally: #whether idle or failed, a later send starts a new queue and worker
+            if self.queues.get(channel.id) is queue:
+                del self.queues[channel.id]
+
+    async def drain(self, channel, queue):
+        sent_at = deque()
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), self.idle)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    return
+                continue
+            while len(sent_at) >= self.burst: #wait out the rate limit, letting more responses gather
+                wait = sent_at[0] + self.per - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                sent_at.popleft()
+            items = [item]
+            length = self.labelled_length(item)
+            while not queue.empty():
+                following = queue.get_nowait()
+                if length + self.labelled_length(following) > message_limit:
+                    queue.put_nowait(following) #still sorts ahead of later responses, by its original (priority, counter)
+                    break
+                items.append(following)
+                length += self.labelled_length(following)
+            self.coalesced += len(items) - 1
+            try:
+                await channel.send(self.combine(items))
+            except Exception as e: #a failed message is dropped, the rest of the queue is still sent
+                print("Unable to send to channel {}: {}".format(str(channel.id), str(e)))
+            sent_at.append(time.monotonic())
+            self.sent += 1
+
+    def labelled_length(self, item):
+        '''The length of a response once combined, allowing for its label.'''
+        return len(item[2]) + len(str(item[3])) + 8
+
+    def combine(self, items):
+        '''Joins queued responses into one message. When they answer more
+        than one person, each is labelled with who it is for.
+        '''
+        authors = set([x[3] for x in items])
+        if len(items) == 1 or len(authors) == 1:
+            return "\n".join([x[2] for x in items])
+        return "\n\n".join(["**{}:** {}".format(x[3], x[2]) for x in items])
+
+    def stats(self):
+        depths = [x.qsize() for x in self.queues.values()]
+        return {'channels' : len(depths), 'queued' : sum(depths), 'deepest' : max(depths, default=0),
+                'max depth' : self.max_depth, 'responses' : self.responses, 'sent' : self.sent,
+                'coalesced' : self.coalesced}
+
+dispatcher = Dispatcher()
+
+async def reply(ctx, content, priority=interactive):
+    '''Queues a response to a command. Returns once it is queued, not once
+    it has been sent.
+    '''
+    dispatcher.send(ctx.channel, content, ctx.author.display_name, priority)
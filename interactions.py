@@ -0,0 +1,174 @@
+'''
+Created on Oct 19, 2026
+Application (slash) command support for discord.py 1.7, which predates it.
+Interactions arrive as raw INTERACTION_CREATE gateway events, seen through
+the on_socket_response event, and are answered through discord's HTTP API
+using the bot's own HTTP client, so they share its rate limiting.
+
+Discord must receive an answer to an interaction within 3 seconds. Quick
+commands are answered straight away, slow ones are deferred and the answer
+filled in once ready. Autocomplete requests are answered with up to 25
+suggestions.
+
+Methods
+-------
+option
+    Builds the definition of a slash command option
+register
+    Replaces the bot's slash commands with a list of definitions
+
+Classes
+-------
+Route
+    A discord.py Route against the version of the API with interactions
+Interaction
+    A single slash command or autocomplete request, and its responses
+'''
+from discord.http import Route as BaseRoute
+from dispatcher import split_message
+
+#interaction types
+application_command = 2
+autocomplete = 4
+
+#interaction callback types
+message = 4
+deferred_message = 5
+autocomplete_result = 8
+
+#option types
+string_option = 3
+integer_option = 4
+
+ephemeral = 64
+max_choices = 25
+choice_length = 100
+
+class Route(BaseRoute):
+    BASE = 'https://discord.com/api/v10'
+
+def option(name, description, kind=string_option, required=True, autocomplete=False, choices=None):
+    '''Returns the definition of an option. choices, if given, is a list of
+    the only values accepted.
+    '''
+    definition = {'name' : name, 'description' : description, 'type' : kind, 'required' : required}
+    if autocomplete:
+        definition['autocomplete'] = True
+    if choices != None:
+        definition['choices'] = [{'name' : x, 'value' : x} for x in choices]
+    return definition
+
+async def register(http, application_id, definitions, guild_id=None):
+    '''Overwrites the bot's commands with definitions, a list of dictionaries
+    with name, description and options. Commands registered for a single
+    guild are available at once, global ones may take a while to appear.
+    '''
+    if guild_id == None:
+        route = Route('PUT', '/applications/{application_id}/commands', application_id=application_id)
+    else:
+        route = Route('PUT', '/applications/{application_id}/guilds/{guild_id}/commands', application_id=application_id, guild_id=guild_id)
+    for definition in definitions:
+        definition.setdefault('type', 1)
+    return await http.request(route, json=definitions)
+
+class Interaction():
+    '''
+    A slash command or autocomplete request, parsed from the gateway event.
+
+    Attributes
+    ----------
+    kind : int
+        application_command or autocomplete
+    name : str
+        the name of the command
+    options : dic
+        the value given for each option
+    focused : str
+        for autocomplete, the name of the option being typed, or None
+    guild_id : int
+        the server the command was used in, or None in a direct message
+    user_id : int
+        the id of the user who used the command
+    display_name : str
+        the user's name on the server
+
+    Methods
+    -------
+    respond
+        Answers a command with a message
+    defer
+        Acknowledges a command, to be answered later with edit
+    edit
+        Fills in the answer to a deferred command
+    suggest
+        Answers an autocomplete request
+    '''
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.token = data['token']
+        self.application_id = data['application_id']
+        self.kind = data['type']
+        self.guild_id = None
+        if data.get('guild_id') != None:
+            self.guild_id = int(data['guild_id'])
+        member = data.get('member')
+        if member != None:
+            user = member['user']
+            self.display_name = member.get('nick') or user['username']
+        else:
+            user = data['user']
+            self.display_name = user['username']
+        self.user_id = int(user['id'])
+        command = data.get('data', {})
+        self.name = command.get('name')
+        self.options = {}
+        self.focused = None
+        for given in command.get('options', []):
+            self.options[given['name']] = given.get('value')
+            if given.get('focused'):
+                self.focused = given['name']
+
+    def callback(self, http, kind, data=None):
+        route = Route('POST', '/interactions/{interaction_id}/{token}/callback', interaction_id=self.id, token=self.token)
+        payload = {'type' : kind}
+        if data != None:
+            payload['data'] = data
+        return http.request(route, json=payload)
+
+    async def respond(self, http, content, private=False):
+        '''Answers with content, split over follow up messages if it is too
+        long for one. A private answer is only shown to the user.
+        '''
+        pieces = split_message(content)
+        data = {'content' : pieces[0]}
+        if private:
+            data['flags'] = ephemeral
+        await self.callback(http, message, data)
+        await self.follow_up(http, pieces[1:], private)
+
+    async def defer(self, http, private=False):
+        data = None
+        if private:
+            data = {'flags' : ephemeral}
+        await self.callback(http, deferred_message, data)
+
+    async def edit(self, http, content, private=False):
+        '''Replaces the "thinking" shown for a deferred command with content.'''
+        pieces = split_message(content)
+        route = Route('PATCH', '/webhooks/{application_id}/{token}/messages/@original', application_id=self.application_id, token=self.token)
+        await http.request(route, json={'content' : pieces[0]})
+        await self.follow_up(http, pieces[1:], private)
+
+    async def follow_up(self, http, pieces, private=False):
+        for piece in pieces:
+            data = {'content' : piece}
+            if private:
+                data['flags'] = ephemeral
+            route = Route('POST', '/webhooks/{application_id}/{token}', application_id=self.application_id, token=self.token)
+            await http.request(route, json=data)
+
+    async def suggest(self, http, names):
+        '''Answers an autocomplete request with up to 25 names.'''
+        choices = [{'name' : x[:choice_length], 'value' : x[:choice_length]} for x in names[:max_choices]]
+        await self.callback(http, autocomplete_result, {'choices' : choices})
\ No newline at end of file
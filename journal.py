@@ -0,0 +1,164 @@
+'''
+Created on Oct 19, 2026
+Keeps a journal of every change made to a character sheet, so that the
+changes can be reviewed with !history sheet and reverted with !undo.
+
+Each save records the fields that changed, with their old and new values,
+rather than a copy of the whole sheet. Like the roll history, entries are
+buffered in memory and written in batches by a background task, which also
+periodically compacts the journal by dropping undone entries and anything
+beyond a fixed depth per character.
+
+Two special entries use the field name '*': the creation of a sheet, which
+is undone by deleting it, and the clearing of a sheet, whose old value is
+the whole sheet so that it can be restored.
+
+An undo is a save like any other, and bumps the sheet's version, so that
+a copy of the sheet loaded before the undo cannot be saved over it.
+
+Classes
+-------
+Journal
+    Buffers sheet changes, writes them in batches and reverts them on request
+'''
+import asyncio
+from collections import deque
+from datetime import datetime
+from storage import get_storage, SheetConflict
+
+class Journal():
+    '''
+    Buffers sheet changes in memory and writes them to the storage backend in
+    batches.
+
+    Attributes
+    ----------
+    buffer : deque
+        journal entries waiting to be written
+    flush_interval : int
+        the number of seconds between flushes
+    compact_every : int
+        the number of flushes between compactions
+    depth : int
+        the number of entries kept per character by compaction
+    keep_days : int
+        the number of days an entry is kept before compaction drops it
+
+    Methods
+    -------
+    record
+        Adds the changes made by one save to the buffer
+    start
+        Starts the background flushing task on the given event loop
+    flush
+        Writes everything currently buffered in one batch
+    compact
+        Drops undone, old and excess entries
+    recent
+        Returns the most recent changes made to a character
+    undo
+        Reverts the most recent change made to a character
+    '''
+
+    def __init__(self, flush_interval=5, compact_every=720, max_buffer=10000, depth=50, keep_days=30):
+        self.buffer = deque(maxlen=max_buffer)
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.depth = depth
+        self.keep_days = keep_days
+        self.task = None
+
+    def record(self, server_id, user_id, changes):
+        '''Adds an entry to the buffer. changes is a list of dictionaries with a
+        field, its old value and its new value.
+        '''
+        if len(changes) == 0:
+            return
+        self.buffer.append({'guild id' : str(server_id), 'user id' : user_id, 'changes' : changes,
+                            'undone' : False, 'timestamp' : datetime.utcnow()})
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.flush_loop(loop))
+
+    async def flush_loop(self, loop):
+        flushes = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            flushes += 1
+            try:
+                await loop.run_in_executor(None, self.flush)
+                if flushes % self.compact_every == 0:
+                    await loop.run_in_executor(None, self.compact)
+            except Exception as e:
+                print("Unable to write sheet journal: {}".format(str(e)))
+
+    def flush(self):
+        batch = []
+        while self.buffer:
+            batch.append(self.buffer.popleft())
+        if len(batch) == 0:
+            return 0
+        try:
+            get_storage().insert_journal(batch)
+        except Exception:
+            self.buffer.extendleft(reversed(batch))
+            raise
+        return len(batch)
+
+    def compact(self):
+        self.flush()
+        get_storage().compact_journal(self.depth, self.keep_days)
+
+    def recent(self, server_id, user_id, limit=10):
+        self.flush()
+        return get_storage().journal_entries(str(server_id), user_id, limit)
+
+    def undo(self, server_id, user_id, attempts=3):
+        '''Reverts the most recent change that has not already been undone.
+        Returns the reverted entry, or None if there is nothing to undo.
+        Raises SheetConflict if the sheet keeps being saved by someone else
+        while the undo is being written.
+        '''
+        self.flush()
+        storage = get_storage()
+        entries = storage.journal_entries(str(server_id), user_id, 1)
+        if len(entries) == 0:
+            return None
+        entry = entries[0]
+        reverted = {}
+        for change in entry['changes']:
+            if change['field'] == '*' and change['old'] == None: #the sheet was created
+                storage.delete(server_id, user_id)
+            elif change['field'] == '*': #the sheet was cleared
+                restored = dict(change['old'])
+                restored['version'] = max(self.version(storage, server_id, user_id) or 0, restored.get('version', 0)) + 1
+                storage.save(server_id, user_id, restored)
+            elif change['old'] != None: #fields that did not exist before are left alone
+                reverted[change['field']] = change['old']
+        for attempt in range(attempts):
+            if len(reverted) == 0:
+                break
+            version = self.version(storage, server_id, user_id)
+            if version == None: #the sheet no longer exists
+                break
+            reverted['version'] = version + 1
+            try:
+                storage.patch(server_id, user_id, reverted, None, version)
+                break
+            except SheetConflict: #saved by someone else since its version was read, which evicts it from the cache
+                if attempt == attempts - 1:
+                    raise
+        storage.mark_undone(entry['id'])
+        return entry
+
+    def version(self, storage, server_id, user_id):
+        '''Returns the stored version of a sheet, or None if it does not
+        exist.
+        '''
+        stored = storage.find(server_id, user_id, ['version'])
+        if stored == None:
+            return None
+        return stored.get('version', 0)
+
+journal = Journal()
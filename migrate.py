@@ -0,0 +1,27 @@
+'''
+Created on Oct 19, 2026
+Rewrites character sheets stored before codec.py in its compact form. Run
+it once after upgrading, with the bot stopped, using the same .env file as
+the bot:
+
+    python migrate.py [--batch-size N]
+
+Sheets are read and rewritten in batches, so a database of any size is
+migrated without loading it all at once. Sheets that are already in the
+compact form are skipped, so the migration may safely be run again.
+'''
+import argparse
+from dotenv import load_dotenv
+load_dotenv()
+from storage import get_storage
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts stored character sheets to the compact format.')
+    parser.add_argument('--batch-size', type=int, default=500, help='the number of sheets rewritten at once')
+    options = parser.parse_args()
+    backend = get_storage().backend
+    total = 0
+    for server_id, count in backend.migrate(options.batch_size):
+        total += count
+        print('Server {}: {} sheets rewritten, {} in total'.format(server_id, str(count), str(total)))
+    print('Migration complete. {} sheets rewritten.'.format(str(total)))
\ No newline at end of file
@@ -0,0 +1,198 @@
+'''
+Created on Oct 19, 2026
+Resolves names typed by players, like skills, merits, conditions and
+aspirations, to the names actually on a sheet. Names are matched ignoring
+case, then by an unambiguous prefix, then by a small number of typos, so
+that "soul los" or "Athletcs" find what was meant instead of failing.
+
+The same indexes complete names as they are typed, for slash command
+autocomplete, which has to be answered from memory within discord's three
+second limit.
+
+Methods
+-------
+edit_distance
+    Returns the number of single character edits between two strings
+
+Classes
+-------
+NameIndex
+    A casefolded index of names, supporting exact, prefix and fuzzy lookups
+SheetNames
+    The names on each player's sheet, indexed per player
+'''
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from threading import Lock
+
+def edit_distance(first, second, limit):
+    '''Returns the Levenshtein distance between two strings, or limit + 1 as
+    soon as it is certain to be more than limit.
+    '''
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for i, a in enumerate(first, 1):
+        current = [i]
+        for j, b in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a != b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def bigrams(key):
+    return set([key[i:i+2] for i in range(len(key) - 1)])
+
+class NameIndex():
+    '''
+    An index of names, kept up to date as names are added and removed rather
+    than rebuilt for every lookup.
+
+    Attributes
+    ----------
+    names : dic
+        the original names, keyed by their casefolded form
+    keys : list
+        the casefolded names in sorted order, for prefix lookups
+    grams : dic
+        the casefolded names containing each pair of letters, for narrowing
+        down fuzzy lookups
+
+    Methods
+    -------
+    add
+        Adds a name to the index
+    remove
+        Removes a name from the index
+    resolve
+        Returns the indexed name a player most likely meant, or None
+    complete
+        Returns the indexed names a player may be typing
+    '''
+
+    def __init__(self, names=()):
+        self.names = {}
+        self.keys = []
+        self.grams = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return str(name).casefold() in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        key = str(name).casefold()
+        if key in self.names:
+            return
+        self.names[key] = name
+        insort(self.keys, key)
+        for gram in bigrams(key):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def remove(self, name):
+        key = str(name).casefold()
+        if key not in self.names:
+            return
+        del self.names[key]
+        self.keys.pop(bisect_left(self.keys, key))
+        for gram in bigrams(key):
+            self.grams[gram].discard(key)
+
+    def resolve(self, query, fuzzy=True):
+        '''Returns the indexed name matching query exactly, ignoring case.
+        Failing that, the only name starting with query, and failing that the
+        only closest name within a couple of typos. Returns None if there is
+        no match, or more than one equally good one.
+        '''
+        key = str(query).casefold().strip()
+        if key in self.names:
+            return self.names[key]
+        if key == '':
+            return None
+        start = bisect_left(self.keys, key)
+        end = bisect_left(self.keys, key + '\uffff')
+        if end - start == 1:
+            return self.names[self.keys[start]]
+        if end - start > 1 or not fuzzy or len(key) < 3: #short names are too easily mistaken for one another
+            return None
+        limit = 1
+        if len(key) > 5:
+            limit = 2
+        candidates = set()
+        for gram in bigrams(key):
+            candidates |= self.grams.get(gram, set())
+        best = None
+        best_distance = limit + 1
+        tied = False
+        for candidate in candidates:
+            distance = edit_distance(key, candidate, limit)
+            if distance < best_distance:
+                best, best_distance, tied = candidate, distance, False
+            elif distance == best_distance:
+                tied = True
+        if best == None or tied:
+            return None
+        return self.names[best]
+
+    def complete(self, query, limit=25):
+        '''Returns up to limit names starting with query, ignoring case, in
+        order, followed by names containing it elsewhere.
+        '''
+        key = str(query).casefold().strip()
+        start = bisect_left(self.keys, key)
+        end = min(bisect_left(self.keys, key + '\uffff'), start + limit)
+        result = [self.names[x] for x in self.keys[start:end]]
+        if key != '':
+            for candidate in self.keys:
+                if len(result) >= limit:
+                    break
+                if key in candidate and not candidate.startswith(key):
+                    result.append(self.names[candidate])
+        return result
+
+class SheetNames():
+    '''
+    Indexes of the merits, conditions, aspirations and specialties on each
+    player's sheet. A player's indexes are built from their cached sheet the
+    first time they are needed, and rebuilt only when the sheet's version
+    changes. The least recently used players are dropped beyond size.
+
+    Methods
+    -------
+    get
+        Returns the indexes for a player's sheet
+    '''
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version, load):
+        '''Returns a dictionary of NameIndex keyed by merits, conditions,
+        aspirations and specialties, the last holding one index per skill.
+        load is only called, to return the sheet, if the indexes held for key
+        are missing or older than version. Returns None if load does.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] == version:
+                self.entries.move_to_end(key)
+                return entry[1]
+        doc = load()
+        if doc == None:
+            return None
+        indexes = {'merits' : NameIndex(doc.get('merits', {})),
+                   'conditions' : NameIndex(doc.get('conditions', [])),
+                   'aspirations' : NameIndex(doc.get('aspirations', [])),
+                   'specialties' : dict([(x, NameIndex(y[1:])) for x, y in doc.get('skills', {}).items()])}
+        with self.lock:
+            self.entries[key] = (version, indexes)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return indexes
\ No newline at end of file
@@ -0,0 +1,129 @@
+'''
+Created on Oct 19, 2026
+Keeps a log of every roll made through the bot, so that players and
+storytellers are able to look back over them with !history.
+
+Rolls are never written to storage while the roll command is being
+handled. Each outcome is appended to an in-memory buffer, and a background
+task flushes that buffer with a single insert_many every few seconds, or
+sooner if the buffer fills up.
+
+Classes
+-------
+RollHistory
+    Buffers roll outcomes, writes them in batches and answers history queries
+'''
+import asyncio
+from collections import deque
+from datetime import datetime, timedelta
+from storage import get_storage
+
+class RollHistory():
+    '''
+    Buffers roll outcomes in memory and writes them to the storage backend in
+    batches. All records live in a single collection, shared between servers,
+    and are expired after a number of days.
+
+    Attributes
+    ----------
+    buffer : deque
+        roll records waiting to be written. bounded, so that a database outage
+        drops the oldest records rather than growing without limit
+    flush_interval : int
+        the number of seconds between flushes
+    batch_size : int
+        the number of buffered records that will trigger an early flush
+    keep_days : int
+        the number of days a record is kept before it expires
+
+    Methods
+    -------
+    record
+        Adds a roll outcome to the buffer. Never touches the database
+    start
+        Starts the background flushing task on the given event loop
+    flush
+        Writes everything currently buffered with one insert_many
+    recent
+        Returns the most recent rolls for a user or a server
+    stats
+        Returns per character aggregate statistics for a user
+    '''
+
+    def __init__(self, flush_interval=5, batch_size=100, max_buffer=10000, keep_days=30):
+        self.buffer = deque(maxlen=max_buffer)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.keep_days = keep_days
+        self.task = None
+        self.wakeup = None
+
+    def record(self, guild_id, user_id, character, outcome):
+        '''Adds a roll to the buffer. outcome is one of the entries in the rolls
+        list of a character sheet. This is called from the roll command, and so must
+        never block on the database.
+        '''
+        entry = {'guild id' : guild_id, 'user id' : user_id, 'character' : character,
+                 'pool' : outcome['pool'], 'type' : outcome['type'], 'rote' : outcome['rote'],
+                 'successes' : outcome['successes'], 'explosions' : outcome['explosions'],
+                 'timestamp' : datetime.utcnow()}
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self, loop):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.flush_loop(loop))
+
+    async def flush_loop(self, loop):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                print("Unable to flush roll history: {}".format(str(e)))
+
+    def flush(self):
+        '''Writes every buffered record with a single insert_many. Records that
+        could not be written are returned to the front of the buffer.
+        '''
+        batch = []
+        while self.buffer:
+            batch.append(self.buffer.popleft())
+        if len(batch) == 0:
+            return 0
+        try:
+            get_storage().insert_rolls(batch, self.keep_days)
+        except Exception:
+            self.buffer.extendleft(reversed(batch))
+            raise
+        return len(batch)
+
+    def recent(self, guild_id, user_id=None, hours=None, limit=10):
+        '''Returns the most recent rolls made in a server, newest first. If a
+        user id is given, only that user's rolls are returned. If hours is
+        given, only rolls made within that many hours are returned.
+        '''
+        self.flush()
+        since = None
+        if hours is not None:
+            since = datetime.utcnow() - timedelta(hours=hours)
+        return get_storage().recent_rolls(guild_id, user_id, since, limit, self.keep_days)
+
+    def stats(self, guild_id, user_id, hours=None):
+        '''Returns a list of dictionaries, one per character the user has rolled
+        for on this server, containing the number of rolls, average successes
+        and the rate of exceptional successes (5 or more successes).
+        '''
+        self.flush()
+        since = None
+        if hours is not None:
+            since = datetime.utcnow() - timedelta(hours=hours)
+        return get_storage().roll_stats(guild_id, user_id, since, self.keep_days)
+
+history = RollHistory()
@@ -0,0 +1,128 @@
+'''
+Created on Oct 19, 2026
+Runs updates that apply to every character on a server at once, like
+awarding end of session beats, clearing a condition from the whole table or
+healing everyone's bashing damage. Each runs as a single update of the
+server's sheets rather than a load and save per character, and evicts the
+server's sheets from every process's cache afterwards.
+
+Updates can also be scheduled to repeat, for example to award a beat every
+week. Scheduled jobs are kept by the storage backend, so they survive a
+restart, and are run by a background task. Every bot process sharing the
+database runs the task, so each run is first claimed by moving the job's
+next run forward, and only the process whose claim succeeds runs it.
+
+Methods
+-------
+run_operation
+    Runs a server wide update immediately
+
+Classes
+-------
+Scheduler
+    Runs scheduled server wide updates when they fall due
+'''
+import asyncio
+from datetime import datetime, timedelta
+from storage import get_storage
+
+#each operation takes the storage backend, a server id and its arguments, and returns the number of sheets changed
+operations = {'beats' : lambda storage, guild_id, args: storage.award_beats(guild_id, int(args[0])),
+              'clearcon' : lambda storage, guild_id, args: storage.remove_condition(guild_id, str(args[0]).lower()),
+              'heal' : lambda storage, guild_id, args: storage.heal_damage(guild_id, args[1], int(args[0]))}
+
+def run_operation(guild_id, operation, args):
+    return operations[operation](get_storage(), guild_id, args)
+
+class Scheduler():
+    '''
+    Runs scheduled server wide updates. The storage backend holds the jobs,
+    and a background task checks for any that are due once a minute.
+
+    Attributes
+    ----------
+    check_interval : int
+        the number of seconds between checks for due jobs
+    retry_delay : int
+        the number of minutes before a failed run is tried again. a run that
+        still fails when the job's next run falls due is given up
+
+    Methods
+    -------
+    start
+        Starts the background task on the given event loop
+    run_due
+        Claims and runs every job that is due, and schedules its next run
+    schedule
+        Adds a recurring job
+    jobs
+        Returns the jobs scheduled for a server
+    cancel
+        Removes a scheduled job
+    '''
+
+    def __init__(self, check_interval=60, retry_delay=15):
+        self.check_interval = check_interval
+        self.retry_delay = retry_delay
+        self.task = None
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.run_loop(loop))
+
+    async def run_loop(self, loop):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await loop.run_in_executor(None, self.run_due)
+            except Exception as e:
+                print("Unable to run scheduled jobs: {}".format(str(e)))
+
+    def run_due(self):
+        storage = get_storage()
+        now = datetime.utcnow()
+        ran = 0
+        for job in storage.scheduled_jobs():
+            if job['next run'] > now:
+                break #jobs come back in order of their next run
+            next_run = job['next run']
+            while next_run <= now: #skips any runs missed while the bot was down
+                next_run += timedelta(hours=job['every'])
+            retry = min(now + timedelta(minutes=self.retry_delay), next_run)
+            if not storage.claim_job(job['id'], job['next run'], retry):
+                continue #another process is running it
+            try:
+                run_operation(job['guild id'], job['operation'], job['args'])
+            except Exception as e:
+                if retry < next_run:
+                    print("Scheduled {} failed on server {}, retrying at {}: {}".format(job['operation'], job['guild id'], str(retry), str(e)))
+                else:
+                    print("Scheduled {} failed on server {} and was skipped: {}".format(job['operation'], job['guild id'], str(e)))
+                continue
+            storage.reschedule_job(job['id'], next_run)
+            ran += 1
+        return ran
+
+    def schedule(self, guild_id, operation, args, every):
+        '''Schedules an operation to run on a server every so many hours,
+        starting that many hours from now.
+        '''
+        job = {'guild id' : str(guild_id), 'operation' : operation, 'args' : list(args), 'every' : every,
+               'next run' : datetime.utcnow() + timedelta(hours=every)}
+        get_storage().insert_job(job)
+        return job
+
+    def jobs(self, guild_id):
+        return get_storage().scheduled_jobs(guild_id)
+
+    def cancel(self, guild_id, number):
+        '''Removes the job shown at a given position, counting from 1, by
+        jobs. Returns the removed job, or None.
+        '''
+        jobs = self.jobs(guild_id)
+        if number < 1 or number > len(jobs):
+            return None
+        get_storage().delete_job(jobs[number - 1]['id'])
+        return jobs[number - 1]
+
+scheduler = Scheduler()
\ No newline at end of file
@@ -0,0 +1,103 @@
+'''
+Created on Oct 19, 2026
+The registry of gamelines (splats) the bot can hold sheets for. Each splat
+names the module and class of its sheet, which are only imported the first
+time a sheet of that splat is loaded, so adding a gameline costs nothing at
+startup.
+
+Each sheet class carries a Schema compiled once when its module is
+imported. The schema holds the splat's attributes and skills, with their
+categories, defaults and unskilled penalties, in dictionaries so that
+parsing rolls, validating sheets and rendering them never scan a list.
+
+Methods
+-------
+register
+    Adds a splat to the registry
+get_class
+    Returns the sheet class for a splat, importing it if needed
+compile_schema
+    Builds the frozen Schema for a splat
+
+Classes
+-------
+Schema
+    The stats of a single splat
+'''
+from collections import namedtuple
+from importlib import import_module
+from types import MappingProxyType
+
+registry = {'mortal' : ('char_sheet', 'mortal')}
+classes = {}
+
+def register(splat, module, class_name):
+    '''Registers the sheet class for a splat by module and class name,
+    without importing it.
+    '''
+    registry[splat] = (module, class_name)
+    classes.pop(splat, None)
+
+def get_class(splat):
+    '''Returns the sheet class for a splat, or None if the splat is unknown.'''
+    if splat not in classes:
+        if splat not in registry:
+            return None
+        module, class_name = registry[splat]
+        classes[splat] = getattr(import_module(module), class_name)
+    return classes[splat]
+
+class Schema(namedtuple('Schema', ['splat', 'attributes', 'attribute_category', 'skills', 'skill_category',
+                                   'unskilled', 'defaults', 'derived'])):
+    '''
+    The stats of a single splat. Being a tuple of tuples, frozensets and
+    read only mappings, a schema cannot be changed once compiled.
+
+    Attributes
+    ----------
+    splat : str
+        the splat's name
+    attributes : tuple
+        every attribute, in display order
+    attribute_category : mappingproxy
+        the category (mental, physical or social) of each attribute
+    skills : tuple
+        every skill, in display order
+    skill_category : mappingproxy
+        the category of each skill
+    unskilled : mappingproxy
+        the dice pool modifier for rolling each skill without any dots
+    defaults : mappingproxy
+        the starting value of each attribute
+    derived : mappingproxy
+        for each derived stat, the attributes summed and a constant added
+
+    Methods
+    -------
+    derive
+        Works out a derived stat from a sheet's attributes
+    '''
+    __slots__ = ()
+
+    def derive(self, stat, attributes):
+        parts, constant = self.derived[stat]
+        return sum([attributes[x] for x in parts]) + constant
+
+def compile_schema(splat, attributes, skills, unskilled, derived, default=1):
+    '''Builds a Schema. attributes and skills are dictionaries of lists keyed
+    by category, unskilled holds the penalty for each skill category, and
+    derived maps each derived stat to a list of attributes and a constant.
+    '''
+    attribute_category = {}
+    for category in attributes:
+        for x in attributes[category]:
+            attribute_category[x] = category
+    skill_category = {}
+    for category in skills:
+        for x in skills[category]:
+            skill_category[x] = category
+    return Schema(splat, tuple(attribute_category), MappingProxyType(attribute_category),
+                  tuple(skill_category), MappingProxyType(skill_category),
+                  MappingProxyType(dict([(x, unskilled[skill_category[x]]) for x in skill_category])),
+                  MappingProxyType(dict([(x, default) for x in attribute_category])),
+                  MappingProxyType(dict([(x, (tuple(derived[x][0]), derived[x][1])) for x in derived])))
\ No newline at end of file
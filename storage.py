@@ -0,0 +1,1108 @@
+'''
+Created on Oct 19, 2026
+Storage backends for character sheets, the sheet journal and roll history. Every read and
+write the bot makes goes through the backend returned by get_storage, which
+is chosen by the DB_BACKEND variable in the .env file:
+
+    mongo - (the default) a MongoDB server, as described in the README
+    sqlite - a single local SQLite file, named by DB_PATH
+
+Sheets are stored per discord server and keyed by the owner's user id.
+A player's further characters are keyed by ids of their own. Every sheet
+carries its owner's user id, and no owner may have two characters on a
+server whose names differ only in case.
+They are stored in the compact form described in codec.py, and every
+backend encodes and decodes them, so the rest of the bot never sees it.
+Every write stamps the sheets it changes with the time, for backup.py.
+The backend is wrapped in a CachedStorage, which serves repeated reads of
+a sheet from memory and keeps other bot processes' caches up to date
+through the invalidation bus in cache.py.
+
+Every call to the backend goes through the circuit breaker in breaker.py,
+and backends are given short timeouts (DB_TIMEOUT seconds, 2 by default).
+If the database stops answering, cached sheets can still be read, and
+writes are spooled to SPOOL_PATH until it recovers.
+
+Methods
+-------
+get_storage
+    Returns the configured storage backend, creating it on first use
+
+Classes
+-------
+MongoStorage
+    Stores sheets in one MongoDB collection per server
+SQLiteStorage
+    Stores sheets in a local SQLite database running in WAL mode
+CachedStorage
+    Caches the sheets read from and written to another backend
+SheetConflict
+    Raised when a sheet was changed by someone else since it was read
+SheetsNotMigrated
+    Raised by MongoStorage for a server with sheets stored before the codec
+'''
+import os, json, sqlite3, threading, time, asyncio, copy
+from cache import get_bus
+from breaker import CircuitBreaker, WriteSpool, StorageUnavailable
+from codec import encode, decode, key, stored_fields, attribute_position, schema_key
+from datetime import datetime, timedelta
+
+pymongo = None #imported by MongoStorage when first needed, so that it never loads for SQLite
+
+history_name = 'roll history'
+journal_name = 'sheet journal'
+jobs_name = 'scheduled jobs'
+activity_name = 'player activity'
+damage_fields = ['bashing', 'lethal', 'aggravated']
+
+def stamped(stored):
+    '''Sets the modified time of a stored sheet, or of the changes to one.'''
+    stored[key('modified')] = time.time()
+    return stored
+
+def sql_path(field, within=''):
+    '''Returns the quoted JSON path of a field in a stored sheet, for SQLite
+    queries.
+    '''
+    return "'$.{}{}'".format(key(field), within)
+
+class SheetConflict(Exception):
+    '''Raised by patch when the stored sheet no longer has the version the
+    caller read, because another command saved it in the meantime.
+    '''
+    pass
+
+class SheetsNotMigrated(Exception):
+    '''Raised by MongoStorage for a server that still has sheets stored before
+    codec.py. Sheets are looked up by their stored user id key, which those
+    sheets lack, so the server is not served until migrate.py has run.
+    '''
+    pass
+
+class MongoStorage():
+    '''
+    Stores sheets in the bot's MongoDB, one collection per discord server.
+    Two clients are shared by every call. Reads and writes of single sheets,
+    which commands make on the event loop, give up after the database
+    timeout. Updates of a whole server, backups and the migration are only
+    ever run in an executor or a separate script, and go through a second
+    client that allows them several times as long.
+
+    Attributes
+    ----------
+    unavailable : tuple
+        the errors raised when the database cannot be reached in time
+
+    Methods
+    -------
+    ping
+        Checks that the database is answering
+    find
+        Returns the stored sheet for a user, or None. if a list of fields is
+        given, only those fields are fetched
+    find_many
+        Returns the stored sheets for several users in one query
+    save
+        Replaces the stored sheet for a user
+    patch
+        Sets only the given fields of a user's sheet, creating it if needed
+    update_fields
+        Sets some fields on several sheets in one bulk write
+    delete
+        Deletes the stored sheet for a user
+    characters
+        Returns the id and name of every character a user owns on a server
+    party_summary
+        Returns the health, willpower and conditions of every sheet on a
+        server in one query
+    award_beats, remove_condition, heal_damage
+        Change every sheet on a server in a single update
+    insert_job, scheduled_jobs, claim_job, reschedule_job, delete_job
+        Store the recurring jobs run by the scheduler
+    record_activity, recent_activity
+        Store when each player last used their sheet, for warming the cache
+    migrate
+        Rewrites sheets stored before the codec in its compact form
+    sheet_servers, sheet_users
+        Return the servers with sheets, and the users with a sheet on one
+    changed_sheets
+        Yields the stored sheets of a server changed since a given time
+    restore_sheets, prune_sheets
+        Write stored sheets back, and delete any not in a list of users
+    insert_rolls
+        Writes a batch of roll history records
+    recent_rolls
+        Returns the most recent roll history records
+    roll_stats
+        Returns per character statistics from the roll history
+    insert_journal
+        Writes a batch of sheet journal entries
+    journal_entries
+        Returns a character's most recent journal entries that are not undone
+    mark_undone
+        Flags a journal entry as undone
+    compact_journal
+        Drops undone entries, old entries and entries beyond a depth
+    '''
+
+    def __init__(self, host, port, name, timeout=2):
+        global pymongo
+        import pymongo
+        timeout = int(timeout * 1000)
+        self.client = pymongo.MongoClient(host, port, serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout,
+                                          socketTimeoutMS=timeout)
+        self.db = self.client[name]
+        #aggregations and updates of every sheet on a server are slow even when healthy, and one given up on
+        #would still finish on the server, so they are allowed longer
+        self.bulk_client = pymongo.MongoClient(host, port, serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout,
+                                               socketTimeoutMS=timeout * 5)
+        self.bulk_db = self.bulk_client[name]
+        self.unavailable = (pymongo.errors.ConnectionFailure, pymongo.errors.ExecutionTimeout, pymongo.errors.WTimeoutError)
+        self.history = None
+        self.journal = None
+        self.activity = None
+        self.indexed = set()
+
+    def collection(self, server_id):
+        collection = self.db[str(server_id)]
+        if collection.name not in self.indexed: #a conditional upsert must not be able to create a second sheet
+            #checked on every use until the server is migrated, so that it is served as soon as it has been
+            if collection.find_one({schema_key : {'$exists' : False}}, {'_id' : 1}) is not None:
+                raise SheetsNotMigrated('Server {} has sheets stored before the compact format. Run migrate.py.'.format(collection.name))
+            try:
+                collection.create_index(key('user id'), unique=True)
+                collection.create_index(key('modified'))
+                #sheets saved before owners were stored are left out until they are next saved
+                collection.create_index([(key('owner'), pymongo.ASCENDING), (key('name'), pymongo.ASCENDING)], unique=True, name='character_name',
+                                        partialFilterExpression={key('owner') : {'$exists' : True}}, collation={'locale' : 'en', 'strength' : 2})
+            except pymongo.errors.OperationFailure as e:
+                print("Unable to index collection {}: {}".format(collection.name, str(e)))
+            self.indexed.add(collection.name)
+        return collection
+
+    def bulk_collection(self, server_id):
+        return self.bulk_db[self.collection(server_id).name]
+
+    def ping(self):
+        self.client.admin.command('ping')
+
+    def find(self, server_id, user_id, fields=None):
+        projection = None
+        if fields is not None:
+            projection = dict([(x, 1) for x in stored_fields(fields) + [schema_key]])
+        return decode(self.collection(server_id).find_one({key('user id') : user_id}, projection))
+
+    def find_many(self, server_id, user_ids):
+        return [decode(x) for x in self.collection(server_id).find({key('user id') : {'$in' : list(user_ids)}})]
+
+    def save(self, server_id, user_id, doc):
+        self.collection(server_id).replace_one({key('user id') : user_id}, stamped(encode(doc)), upsert=True)
+
+    def patch(self, server_id, user_id, changes, doc=None, version=None):
+        '''Sets the changed fields of a sheet. If the whole sheet is given as
+        doc, the sheet is created from it when it does not exist yet. Returns
+        True if the sheet was created.
+        
+        If a version is given, the write only happens if the stored sheet
+        still has that version, and SheetConflict is raised otherwise.
+        Version 0 stands for a sheet that has never been saved with one.
+        '''
+        changes = stamped(encode(changes, partial=True))
+        update = {'$set' : changes}
+        if doc is not None:
+            insert = {}
+            doc = encode(doc)
+            for field in doc:
+                if field not in changes and field != key('user id'):
+                    insert[field] = doc[field]
+            if len(insert) > 0:
+                update['$setOnInsert'] = insert
+        query = {key('user id') : user_id}
+        if version == 0:
+            query[key('version')] = {'$exists' : False}
+        elif version is not None:
+            query[key('version')] = version
+        try:
+            result = self.collection(server_id).update_one(query, update, upsert=doc is not None)
+        except pymongo.errors.DuplicateKeyError: #the sheet exists, with another version
+            raise SheetConflict()
+        if version is not None and result.matched_count == 0 and result.upserted_id is None:
+            raise SheetConflict()
+        return result.upserted_id is not None
+
+    def update_fields(self, server_id, updates):
+        '''Takes a list of (user id, dictionary of fields) pairs and sets those
+        fields with a single bulk_write. The version of each sheet is bumped,
+        so that anyone holding an older copy cannot save over the change.
+        '''
+        requests = [pymongo.UpdateOne({key('user id') : user_id}, {'$set' : stamped(encode(fields, partial=True)), '$inc' : {key('version') : 1}})
+                    for user_id, fields in updates]
+        if len(requests) > 0:
+            self.collection(server_id).bulk_write(requests, ordered=False)
+
+    def delete(self, server_id, user_id):
+        self.collection(server_id).delete_one({key('user id') : user_id})
+
+    def characters(self, server_id, owner):
+        '''Returns the user's first sheet, keyed by their own id, and every
+        other sheet they own, through the user id and owner indexes.
+        '''
+        query = {'$or' : [{key('user id') : owner}, {key('owner') : owner}]}
+        cursor = self.collection(server_id).find(query, {'_id' : 0, key('user id') : 1, key('name') : 1})
+        return sorted([{'user id' : x[key('user id')], 'name' : x.get(key('name'), 'Unnamed Character')} for x in cursor], key=lambda x: x['name'])
+
+    def party_summary(self, server_id):
+        '''Projects only the fields needed to show a party's condition, and
+        works out maximum health and willpower within the aggregation.
+        '''
+        def has_merit(merit):
+            return {'$cond' : [{'$eq' : [{'$type' : '${}.{}'.format(key('merits'), merit)}, 'missing']}, 0, 1]}
+        def field(name, default):
+            return {'$ifNull' : ['$' + key(name), default]}
+        def attribute(name):
+            return {'$ifNull' : [{'$arrayElemAt' : ['$' + key('attributes'), attribute_position(name)]}, 1]}
+        pipeline = [{'$project' : {'_id' : 0, 'user id' : '$' + key('user id'), 'name' : field('name', 'Unnamed Character'),
+                                   'bashing' : field('bashing', 0), 'lethal' : field('lethal', 0),
+                                   'aggravated' : field('aggravated', 0), 'willpower' : '$' + key('willpower'),
+                                   'conditions' : field('conditions', []),
+                                   'max health' : {'$subtract' : [{'$add' : [5, attribute('stamina'), has_merit('giant')]},
+                                                                  has_merit('small-framed')]},
+                                   'max wp' : {'$add' : [attribute('resolve'), attribute('composure')]}}},
+                    {'$addFields' : {'willpower' : {'$ifNull' : ['$willpower', '$max wp']}}},
+                    {'$sort' : {'name' : pymongo.ASCENDING}}]
+        return list(self.bulk_collection(server_id).aggregate(pipeline))
+
+    def award_beats(self, server_id, beats):
+        '''Adds beats to every sheet on a server, turning each five into an
+        experience as add_beats does, with one pipeline update. Returns the
+        number of sheets changed.
+        '''
+        total = {'$add' : [{'$ifNull' : ['$' + key('beats'), 0]}, beats]}
+        update = [{'$set' : {key('beats') : {'$mod' : [total, 5]},
+                             key('experience') : {'$add' : [{'$ifNull' : ['$' + key('experience'), 0]}, {'$toInt' : {'$floor' : {'$divide' : [total, 5]}}}]},
+                             key('modified') : time.time(),
+                             key('version') : {'$add' : [{'$ifNull' : ['$' + key('version'), 0]}, 1]}}}]
+        return self.bulk_collection(server_id).update_many({}, update).modified_count
+
+    def remove_condition(self, server_id, condition):
+        result = self.bulk_collection(server_id).update_many({key('conditions') : condition},
+                                                                  {'$pull' : {key('conditions') : condition}, '$set' : stamped({}),
+                                                              '$inc' : {key('version') : 1}})
+        return result.modified_count
+
+    def heal_damage(self, server_id, field, amount):
+        '''Heals up to amount of one damage type, named by field, from every
+        sheet on a server that has taken any.
+        '''
+        field = key(field)
+        update = [{'$set' : {field : {'$max' : [{'$subtract' : ['$' + field, amount]}, 0]},
+                             key('modified') : time.time(),
+                             key('version') : {'$add' : [{'$ifNull' : ['$' + key('version'), 0]}, 1]}}}]
+        return self.bulk_collection(server_id).update_many({field : {'$gt' : 0}}, update).modified_count
+
+    def migrate(self, batch_size=500):
+        '''Rewrites every sheet stored before the codec, a batch at a time, and
+        moves each server's unique index to the new user id key. Yields the
+        server id and number of sheets rewritten after every batch.
+        '''
+        for name in self.db.list_collection_names():
+            if not name.isnumeric(): #only the sheet collections are named after servers
+                continue
+            collection = self.bulk_db[name]
+            if 'user id_1' in collection.index_information(): #every rewritten sheet loses the old key
+                collection.drop_index('user id_1')
+            batch = []
+            for doc in collection.find({schema_key : {'$exists' : False}}).batch_size(batch_size):
+                #only replaced if still in the old form, so that a sheet saved meanwhile is never written over
+                batch.append(pymongo.ReplaceOne({'_id' : doc['_id'], schema_key : {'$exists' : False}}, stamped(encode(dict([(x, doc[x]) for x in doc if x != '_id'])))))
+                if len(batch) >= batch_size:
+                    yield name, collection.bulk_write(batch, ordered=False).modified_count
+                    batch = []
+            if len(batch) > 0:
+                yield name, collection.bulk_write(batch, ordered=False).modified_count
+            self.indexed.discard(name)
+            self.collection(name)
+
+    def sheet_servers(self):
+        return [x for x in self.db.list_collection_names() if x.isnumeric()]
+
+    def sheet_users(self, server_id):
+        return self.bulk_collection(server_id).distinct(key('user id'))
+
+    def changed_sheets(self, server_id, since=None, batch_size=500):
+        '''Streams the stored form of every sheet on a server written after
+        since, a timestamp, or of every sheet if since is None.
+        '''
+        query = {}
+        if since is not None:
+            query[key('modified')] = {'$gt' : since}
+        for doc in self.bulk_collection(server_id).find(query, {'_id' : 0}).batch_size(batch_size):
+            yield doc
+
+    def restore_sheets(self, server_id, docs):
+        '''Writes back stored sheets exactly as they were backed up.'''
+        requests = [pymongo.ReplaceOne({key('user id') : x[key('user id')]}, x, upsert=True) for x in docs]
+        if len(requests) > 0:
+            self.bulk_collection(server_id).bulk_write(requests, ordered=False)
+
+    def prune_sheets(self, server_id, user_ids):
+        return self.bulk_collection(server_id).delete_many({key('user id') : {'$nin' : list(user_ids)}}).deleted_count
+
+    def insert_job(self, job):
+        self.db[jobs_name].insert_one(job)
+
+    def scheduled_jobs(self, guild_id=None):
+        query = {}
+        if guild_id is not None:
+            query['guild id'] = str(guild_id)
+        jobs = []
+        for job in self.db[jobs_name].find(query).sort('next run', pymongo.ASCENDING):
+            job['id'] = job.pop('_id')
+            jobs.append(job)
+        return jobs
+
+    def claim_job(self, job_id, due, next_run):
+        '''Moves a job's next run from due to next_run, unless another process
+        already has. Returns True if this call moved it.
+        '''
+        claimed = self.db[jobs_name].find_one_and_update({'_id' : job_id, 'next run' : due}, {'$set' : {'next run' : next_run}})
+        return claimed is not None
+
+    def reschedule_job(self, job_id, next_run):
+        self.db[jobs_name].update_one({'_id' : job_id}, {'$set' : {'next run' : next_run}})
+
+    def delete_job(self, job_id):
+        self.db[jobs_name].delete_one({'_id' : job_id})
+
+    def activity_collection(self, keep_days):
+        if self.activity is None:
+            activity = self.db[activity_name]
+            activity.create_index([('guild id', pymongo.ASCENDING), ('user id', pymongo.ASCENDING)], unique=True)
+            activity.create_index('last seen', expireAfterSeconds=keep_days * 86400)
+            self.activity = activity
+        return self.activity
+
+    def record_activity(self, players, keep_days):
+        '''Takes a list of (server id, user id, timestamp) and keeps the latest
+        time each player was seen, with one bulk write.
+        '''
+        requests = [pymongo.UpdateOne({'guild id' : x[0], 'user id' : x[1]}, {'$max' : {'last seen' : datetime.utcfromtimestamp(x[2])}}, upsert=True)
+                    for x in players]
+        if len(requests) > 0:
+            self.activity_collection(keep_days).bulk_write(requests, ordered=False)
+
+    def recent_activity(self, since, limit):
+        '''Returns (server id, user id) for up to limit players seen after
+        since, a timestamp, most recently seen first.
+        '''
+        query = {'last seen' : {'$gte' : datetime.utcfromtimestamp(since)}}
+        cursor = self.db[activity_name].find(query, {'_id' : 0}).sort('last seen', pymongo.DESCENDING).limit(limit)
+        return [(x['guild id'], x['user id']) for x in cursor]
+
+    def history_collection(self, keep_days):
+        if self.history is None:
+            history = self.db[history_name]
+            history.create_index([('user id', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING)])
+            history.create_index([('guild id', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING)])
+            history.create_index([('guild id', pymongo.ASCENDING), ('user id', pymongo.ASCENDING), ('character', pymongo.ASCENDING)])
+            history.create_index('timestamp', expireAfterSeconds=keep_days * 86400)
+            self.history = history
+        return self.history
+
+    def insert_rolls(self, records, keep_days):
+        self.history_collection(keep_days).insert_many(records, ordered=False)
+
+    def recent_rolls(self, guild_id, user_id, since, limit, keep_days):
+        query = {'guild id' : guild_id}
+        if user_id is not None:
+            query['user id'] = user_id
+        if since is not None:
+            query['timestamp'] = {'$gte' : since}
+        cursor = self.history_collection(keep_days).find(query, {'_id' : 0}).sort('timestamp', pymongo.DESCENDING).limit(limit)
+        return list(cursor)
+
+    def roll_stats(self, guild_id, user_id, since, keep_days):
+        match = {'guild id' : guild_id, 'user id' : user_id}
+        if since is not None:
+            match['timestamp'] = {'$gte' : since}
+        pipeline = [{'$match' : match},
+                    {'$group' : {'_id' : '$character',
+                                 'rolls' : {'$sum' : 1},
+                                 'average' : {'$avg' : '$successes'},
+                                 'exceptional' : {'$sum' : {'$cond' : [{'$gte' : ['$successes', 5]}, 1, 0]}}}},
+                    {'$project' : {'_id' : 0, 'character' : '$_id', 'rolls' : 1, 'average' : 1,
+                                   'exceptional rate' : {'$divide' : ['$exceptional', '$rolls']}}},
+                    {'$sort' : {'rolls' : pymongo.DESCENDING}}]
+        return list(self.history_collection(keep_days).aggregate(pipeline))
+
+    def journal_collection(self):
+        if self.journal is None:
+            journal = self.db[journal_name]
+            journal.create_index([('guild id', pymongo.ASCENDING), ('user id', pymongo.ASCENDING), ('undone', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING)])
+            journal.create_index('timestamp')
+            self.journal = journal
+        return self.journal
+
+    def insert_journal(self, entries):
+        self.journal_collection().insert_many(entries, ordered=False)
+
+    def journal_entries(self, server_id, user_id, limit):
+        query = {'guild id' : str(server_id), 'user id' : user_id, 'undone' : False}
+        cursor = self.journal_collection().find(query).sort('timestamp', pymongo.DESCENDING).limit(limit)
+        entries = []
+        for entry in cursor:
+            entry['id'] = entry.pop('_id')
+            entries.append(entry)
+        return entries
+
+    def mark_undone(self, entry_id):
+        self.journal_collection().update_one({'_id' : entry_id}, {'$set' : {'undone' : True}})
+
+    def compact_journal(self, depth, keep_days):
+        journal = self.journal_collection()
+        journal.delete_many({'$or' : [{'undone' : True}, {'timestamp' : {'$lt' : datetime.utcnow() - timedelta(days=keep_days)}}]})
+        pipeline = [{'$sort' : {'timestamp' : pymongo.DESCENDING}},
+                    {'$group' : {'_id' : {'guild' : '$guild id', 'user' : '$user id'}, 'ids' : {'$push' : '$_id'}, 'count' : {'$sum' : 1}}},
+                    {'$match' : {'count' : {'$gt' : depth}}},
+                    {'$project' : {'excess' : {'$slice' : ['$ids', depth, {'$subtract' : ['$count', depth]}]}}}]
+        for group in journal.aggregate(pipeline, allowDiskUse=True):
+            journal.delete_many({'_id' : {'$in' : group['excess']}})
+
+class SQLiteStorage():
+    '''
+    Stores sheets in a local SQLite file, for deployments that do not want
+    to run a MongoDB server. Sheets are kept as JSON in a table keyed by
+    server and user id. The database runs in WAL mode so reads are not
+    blocked by writes. The connection is shared between threads, guarded
+    by a lock.
+
+    Offers the same methods as MongoStorage.
+    '''
+
+    def __init__(self, path, timeout=2):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.unavailable = (sqlite3.OperationalError,) #raised when the database stays locked for longer than the timeout, among others
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sheets (guild TEXT NOT NULL, user INTEGER NOT NULL, doc TEXT NOT NULL, '
+                          'PRIMARY KEY (guild, user)) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS sheets_modified ON sheets (guild, json_extract(doc, {}))'.format(sql_path('modified')))
+        #sheets saved before owners were stored have none, and nulls never clash in a unique index
+        self.conn.execute('DROP INDEX IF EXISTS sheets_character') #matched names exactly
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS sheets_owner ON sheets (guild, json_extract(doc, {}), json_extract(doc, {}) COLLATE NOCASE)'.format(sql_path('owner'), sql_path('name')))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rolls (guild INTEGER NOT NULL, user INTEGER NOT NULL, character TEXT, '
+                          'pool INTEGER, type TEXT, rote INTEGER, successes INTEGER, explosions INTEGER, timestamp REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rolls_user ON rolls (guild, user, timestamp)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rolls_guild ON rolls (guild, timestamp)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rolls_time ON rolls (timestamp)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, guild TEXT NOT NULL, user INTEGER NOT NULL, '
+                          'changes TEXT NOT NULL, undone INTEGER NOT NULL, timestamp REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS journal_user ON journal (guild, user, undone, id)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, guild TEXT NOT NULL, operation TEXT NOT NULL, '
+                          'args TEXT NOT NULL, every REAL NOT NULL, next REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS activity (guild TEXT NOT NULL, user INTEGER NOT NULL, seen REAL NOT NULL, '
+                          'PRIMARY KEY (guild, user)) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS activity_seen ON activity (seen)')
+
+    def ping(self):
+        with self.lock:
+            self.conn.execute('SELECT 1')
+
+    def outage(self, error):
+        '''Tells a locked or unreadable database apart from the other
+        OperationalErrors, such as a malformed query or a missing table.
+        '''
+        message = str(error).lower()
+        return 'locked' in message or 'disk i/o' in message or 'unable to open' in message
+
+    def find(self, server_id, user_id, fields=None):
+        select = 'doc'
+        params = []
+        if fields is not None: #only the requested fields are extracted from the stored JSON
+            fields = stored_fields(fields) + [schema_key]
+            select = 'json_object({})'.format(', '.join(['?, json_extract(doc, ?)'] * len(fields)))
+            for field in fields:
+                params += [field, '$."{}"'.format(field)]
+        params += [str(server_id), user_id]
+        with self.lock:
+            row = self.conn.execute('SELECT {} FROM sheets WHERE guild = ? AND user = ?'.format(select), params).fetchone()
+        if row is None:
+            return None
+        doc = json.loads(row[0])
+        if fields is not None: #fields the sheet does not have come back as null
+            doc = dict([(x, doc[x]) for x in doc if doc[x] is not None])
+        return decode(doc)
+
+    def find_many(self, server_id, user_ids):
+        user_ids = list(user_ids)
+        if len(user_ids) == 0:
+            return []
+        marks = ', '.join(['?'] * len(user_ids))
+        with self.lock:
+            rows = self.conn.execute('SELECT doc FROM sheets WHERE guild = ? AND user IN ({})'.format(marks), [str(server_id)] + user_ids).fetchall()
+        return [decode(json.loads(x[0])) for x in rows]
+
+    def save(self, server_id, user_id, doc):
+        with self.lock:
+            #not INSERT OR REPLACE, which would delete another character with the same owner and name
+            self.conn.execute('INSERT INTO sheets (guild, user, doc) VALUES (?, ?, ?) ON CONFLICT (guild, user) DO UPDATE SET doc = excluded.doc', (str(server_id), user_id, json.dumps(stamped(encode(doc)))))
+
+    def stored(self, row):
+        '''Returns a stored sheet in its compact form, converting it first if
+        it was stored before the codec.
+        '''
+        stored = json.loads(row[0])
+        if schema_key not in stored:
+            stored = encode(stored)
+        return stored
+
+    def patch(self, server_id, user_id, changes, doc=None, version=None):
+        with self.lock:
+            row = self.conn.execute('SELECT doc FROM sheets WHERE guild = ? AND user = ?', (str(server_id), user_id)).fetchone()
+            if row is None:
+                if doc is None:
+                    if version is not None:
+                        raise SheetConflict()
+                    return False
+                try:
+                    self.conn.execute('INSERT INTO sheets (guild, user, doc) VALUES (?, ?, ?)', (str(server_id), user_id, json.dumps(stamped(encode(doc)))))
+                except sqlite3.IntegrityError: #another character of the same owner has this name
+                    raise SheetConflict()
+                return True
+            stored = self.stored(row)
+            if version is not None and stored.get(key('version'), 0) != version:
+                raise SheetConflict()
+            stored.update(stamped(encode(changes, partial=True)))
+            try:
+                self.conn.execute('UPDATE sheets SET doc = ? WHERE guild = ? AND user = ?', (json.dumps(stored), str(server_id), user_id))
+            except sqlite3.IntegrityError:
+                raise SheetConflict()
+            return False
+
+    def update_fields(self, server_id, updates):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                for user_id, fields in updates:
+                    row = self.conn.execute('SELECT doc FROM sheets WHERE guild = ? AND user = ?', (str(server_id), user_id)).fetchone()
+                    if row is None:
+                        continue
+                    doc = self.stored(row)
+                    doc.update(stamped(encode(fields, partial=True)))
+                    doc[key('version')] = doc.get(key('version'), 0) + 1
+                    self.conn.execute('UPDATE sheets SET doc = ? WHERE guild = ? AND user = ?', (json.dumps(doc), str(server_id), user_id))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def party_summary(self, server_id):
+        def attribute(name):
+            return "COALESCE(json_extract(doc, {}), 1)".format(sql_path('attributes', '[{}]'.format(str(attribute_position(name)))))
+        query = ("SELECT user, COALESCE(json_extract(doc, {name}), 'Unnamed Character'), "
+                 "COALESCE(json_extract(doc, {bashing}), 0), COALESCE(json_extract(doc, {lethal}), 0), "
+                 "COALESCE(json_extract(doc, {aggravated}), 0), json_extract(doc, {willpower}), "
+                 "COALESCE(json_extract(doc, {conditions}), '[]'), "
+                 "5 + {stamina} + (json_type(doc, {giant}) IS NOT NULL) - (json_type(doc, {small}) IS NOT NULL), "
+                 "{resolve} + {composure} "
+                 "FROM sheets WHERE guild = ? ORDER BY 2").format(name=sql_path('name'), bashing=sql_path('bashing'), lethal=sql_path('lethal'),
+                                                                 aggravated=sql_path('aggravated'), willpower=sql_path('willpower'),
+                                                                 conditions=sql_path('conditions'), giant=sql_path('merits', '.giant'),
+                                                                 small=sql_path('merits', '."small-framed"'), stamina=attribute('stamina'),
+                                                                 resolve=attribute('resolve'), composure=attribute('composure'))
+        with self.lock:
+            rows = self.conn.execute(query, (str(server_id),)).fetchall()
+        return [{'user id' : x[0], 'name' : x[1], 'bashing' : x[2], 'lethal' : x[3], 'aggravated' : x[4],
+                 'willpower' : x[8] if x[5] is None else x[5], 'conditions' : json.loads(x[6]),
+                 'max health' : x[7], 'max wp' : x[8]} for x in rows]
+
+    def award_beats(self, server_id, beats):
+        total = "(COALESCE(json_extract(doc, {}), 0) + ?)".format(sql_path('beats'))
+        query = ("UPDATE sheets SET doc = json_set(doc, {beats}, {total} % 5, "
+                 "{experience}, COALESCE(json_extract(doc, {experience}), 0) + {total} / 5, "
+                 "{version}, COALESCE(json_extract(doc, {version}), 0) + 1, {modified}, ?) WHERE guild = ?").format(total=total, beats=sql_path('beats'),
+                                                                                                                   experience=sql_path('experience'),
+                                                                                                                   version=sql_path('version'),
+                                                                                                                   modified=sql_path('modified'))
+        with self.lock:
+            return self.conn.execute(query, (beats, beats, time.time(), str(server_id))).rowcount
+
+    def remove_condition(self, server_id, condition):
+        query = ("UPDATE sheets SET doc = json_set(doc, {conditions}, "
+                 "json((SELECT json_group_array(value) FROM json_each(doc, {conditions}) WHERE value != ?)), "
+                 "{version}, COALESCE(json_extract(doc, {version}), 0) + 1, {modified}, ?) "
+                 "WHERE guild = ? AND EXISTS (SELECT 1 FROM json_each(doc, {conditions}) WHERE value = ?)").format(conditions=sql_path('conditions'),
+                                                                                                                  version=sql_path('version'),
+                                                                                                                  modified=sql_path('modified'))
+        with self.lock:
+            return self.conn.execute(query, (condition, time.time(), str(server_id), condition)).rowcount
+
+    def heal_damage(self, server_id, field, amount):
+        if field not in damage_fields: #the field is part of the query, so it must be one we know
+            raise ValueError(field)
+        query = ("UPDATE sheets SET doc = json_set(doc, {field}, MAX(json_extract(doc, {field}) - ?, 0), "
+                 "{version}, COALESCE(json_extract(doc, {version}), 0) + 1, {modified}, ?) "
+                 "WHERE guild = ? AND json_extract(doc, {field}) > 0").format(field=sql_path(field), version=sql_path('version'),
+                                                                              modified=sql_path('modified'))
+        with self.lock:
+            return self.conn.execute(query, (amount, time.time(), str(server_id))).rowcount
+
+    def migrate(self, batch_size=500):
+        '''Rewrites every sheet stored before the codec, a batch at a time,
+        each batch in its own transaction. Yields the server id and number of
+        sheets rewritten after every batch.
+        '''
+        last = ('', 0)
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT guild, user, doc FROM sheets WHERE (guild, user) > (?, ?) ORDER BY guild, user LIMIT ?',
+                                         (last[0], last[1], batch_size)).fetchall()
+            if len(rows) == 0:
+                return
+            last = (rows[-1][0], rows[-1][1])
+            batch = [(json.dumps(stamped(encode(json.loads(x[2])))), x[0], x[1]) for x in rows if schema_key not in json.loads(x[2])]
+            if len(batch) > 0:
+                with self.lock:
+                    self.conn.execute('BEGIN')
+                    #only rewritten if still in the old form, so that a sheet saved meanwhile is never written over
+                    cursor = self.conn.executemany('UPDATE sheets SET doc = ? WHERE guild = ? AND user = ? AND json_extract(doc, {}) IS NULL'.format(sql_path(schema_key)), batch)
+                    self.conn.execute('COMMIT')
+                yield last[0], cursor.rowcount
+
+    def sheet_servers(self):
+        with self.lock:
+            return [x[0] for x in self.conn.execute('SELECT DISTINCT guild FROM sheets').fetchall()]
+
+    def sheet_users(self, server_id):
+        with self.lock:
+            return [x[0] for x in self.conn.execute('SELECT user FROM sheets WHERE guild = ?', (str(server_id),)).fetchall()]
+
+    def changed_sheets(self, server_id, since=None, batch_size=500):
+        '''Finds the changed sheets through the modified time index, then
+        reads them a batch at a time, so the lock is never held for long.
+        '''
+        if since is None:
+            user_ids = self.sheet_users(server_id)
+        else:
+            with self.lock:
+                rows = self.conn.execute('SELECT user FROM sheets WHERE guild = ? AND json_extract(doc, {}) > ?'.format(sql_path('modified')),
+                                         (str(server_id), since)).fetchall()
+            user_ids = [x[0] for x in rows]
+        for i in range(0, len(user_ids), batch_size):
+            batch = user_ids[i:i + batch_size]
+            with self.lock:
+                rows = self.conn.execute('SELECT doc FROM sheets WHERE guild = ? AND user IN ({})'.format(', '.join(['?'] * len(batch))),
+                                         [str(server_id)] + batch).fetchall()
+            for row in rows:
+                yield json.loads(row[0])
+
+    def restore_sheets(self, server_id, docs):
+        rows = [(str(server_id), x[key('user id')], json.dumps(x)) for x in docs]
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT INTO sheets (guild, user, doc) VALUES (?, ?, ?) ON CONFLICT (guild, user) DO UPDATE SET doc = excluded.doc', rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def prune_sheets(self, server_id, user_ids):
+        keep = set(user_ids)
+        removed = [(str(server_id), x) for x in self.sheet_users(server_id) if x not in keep]
+        with self.lock:
+            self.conn.executemany('DELETE FROM sheets WHERE guild = ? AND user = ?', removed)
+        return len(removed)
+
+    def insert_job(self, job):
+        with self.lock:
+            self.conn.execute('INSERT INTO jobs (guild, operation, args, every, next) VALUES (?, ?, ?, ?, ?)',
+                              (job['guild id'], job['operation'], json.dumps(job['args']), job['every'], job['next run'].timestamp()))
+
+    def scheduled_jobs(self, guild_id=None):
+        query = 'SELECT id, guild, operation, args, every, next FROM jobs'
+        params = []
+        if guild_id is not None:
+            query += ' WHERE guild = ?'
+            params.append(str(guild_id))
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY next', params).fetchall()
+        return [{'id' : x[0], 'guild id' : x[1], 'operation' : x[2], 'args' : json.loads(x[3]), 'every' : x[4],
+                 'next run' : datetime.fromtimestamp(x[5])} for x in rows]
+
+    def claim_job(self, job_id, due, next_run):
+        with self.lock:
+            cursor = self.conn.execute('UPDATE jobs SET next = ? WHERE id = ? AND next = ?', (next_run.timestamp(), job_id, due.timestamp()))
+        return cursor.rowcount == 1
+
+    def reschedule_job(self, job_id, next_run):
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET next = ? WHERE id = ?', (next_run.timestamp(), job_id))
+
+    def delete_job(self, job_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def delete(self, server_id, user_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM sheets WHERE guild = ? AND user = ?', (str(server_id), user_id))
+
+    def characters(self, server_id, owner):
+        '''Looks up the user's first sheet by primary key and the rest through
+        the owner index, which the planner would otherwise pass over for a
+        scan of the server's sheets.
+        '''
+        name = "COALESCE(json_extract(doc, {}), 'Unnamed Character')".format(sql_path('name'))
+        query = ("SELECT user, {name} FROM sheets WHERE guild = ? AND user = ? UNION ALL "
+                 "SELECT user, {name} FROM sheets INDEXED BY sheets_owner WHERE guild = ? AND json_extract(doc, {owner}) = ? AND user != ? "
+                 "ORDER BY 2").format(name=name, owner=sql_path('owner'))
+        with self.lock:
+            rows = self.conn.execute(query, (str(server_id), owner, str(server_id), owner, owner)).fetchall()
+        return [{'user id' : x[0], 'name' : x[1]} for x in rows]
+
+    def record_activity(self, players, keep_days):
+        expired = time.time() - keep_days * 86400
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT INTO activity (guild, user, seen) VALUES (?, ?, ?) '
+                                      'ON CONFLICT (guild, user) DO UPDATE SET seen = MAX(seen, excluded.seen)', players)
+                self.conn.execute('DELETE FROM activity WHERE seen < ?', (expired,))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def recent_activity(self, since, limit):
+        with self.lock:
+            rows = self.conn.execute('SELECT guild, user FROM activity WHERE seen >= ? ORDER BY seen DESC LIMIT ?', (since, limit)).fetchall()
+        return [(x[0], x[1]) for x in rows]
+
+    def insert_rolls(self, records, keep_days):
+        rows = [(x['guild id'], x['user id'], x['character'], x['pool'], x['type'], int(x['rote']),
+                 x['successes'], x['explosions'], x['timestamp'].timestamp()) for x in records]
+        expired = (datetime.utcnow() - timedelta(days=keep_days)).timestamp()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT INTO rolls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.conn.execute('DELETE FROM rolls WHERE timestamp < ?', (expired,))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def recent_rolls(self, guild_id, user_id, since, limit, keep_days):
+        query = 'SELECT character, pool, type, rote, successes, explosions, timestamp FROM rolls WHERE guild = ?'
+        params = [guild_id]
+        if user_id is not None:
+            query += ' AND user = ?'
+            params.append(user_id)
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            params.append(since.timestamp())
+        query += ' ORDER BY timestamp DESC LIMIT ?'
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{'guild id' : guild_id, 'character' : x[0], 'pool' : x[1], 'type' : x[2], 'rote' : bool(x[3]),
+                 'successes' : x[4], 'explosions' : x[5], 'timestamp' : datetime.fromtimestamp(x[6])} for x in rows]
+
+    def roll_stats(self, guild_id, user_id, since, keep_days):
+        query = ('SELECT character, COUNT(*), AVG(successes), AVG(successes >= 5) FROM rolls '
+                 'WHERE guild = ? AND user = ?')
+        params = [guild_id, user_id]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            params.append(since.timestamp())
+        query += ' GROUP BY character ORDER BY COUNT(*) DESC'
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{'character' : x[0], 'rolls' : x[1], 'average' : x[2], 'exceptional rate' : x[3]} for x in rows]
+
+    def insert_journal(self, entries):
+        rows = [(x['guild id'], x['user id'], json.dumps(x['changes']), int(x['undone']), x['timestamp'].timestamp()) for x in entries]
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT INTO journal (guild, user, changes, undone, timestamp) VALUES (?, ?, ?, ?, ?)', rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def journal_entries(self, server_id, user_id, limit):
+        with self.lock:
+            rows = self.conn.execute('SELECT id, changes, timestamp FROM journal WHERE guild = ? AND user = ? AND undone = 0 '
+                                     'ORDER BY id DESC LIMIT ?', (str(server_id), user_id, limit)).fetchall()
+        return [{'id' : x[0], 'guild id' : str(server_id), 'user id' : user_id, 'changes' : json.loads(x[1]),
+                 'undone' : False, 'timestamp' : datetime.fromtimestamp(x[2])} for x in rows]
+
+    def mark_undone(self, entry_id):
+        with self.lock:
+            self.conn.execute('UPDATE journal SET undone = 1 WHERE id = ?', (entry_id,))
+
+    def compact_journal(self, depth, keep_days):
+        expired = (datetime.utcnow() - timedelta(days=keep_days)).timestamp()
+        with self.lock:
+            self.conn.execute('DELETE FROM journal WHERE undone = 1 OR timestamp < ?', (expired,))
+            self.conn.execute('DELETE FROM journal WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER '
+                              '(PARTITION BY guild, user ORDER BY id DESC) AS position FROM journal) WHERE position > ?)', (depth,))
+
+class CachedStorage():
+    '''
+    Wraps a storage backend with a SheetCache. Reads of a sheet are served
+    from the cache when possible. Every write to a sheet updates or evicts
+    the cached copy and publishes an event on the invalidation bus, so that
+    other processes drop their copies. Anything other than sheet reads and
+    writes is passed straight to the backend.
+
+    Every backend call goes through a circuit breaker. While the database is
+    unavailable, or earlier writes are still waiting to be replayed, writes
+    to single sheets are added to a spool and applied to the cached copy,
+    so that commands keep working on cached sheets. Reads that miss the
+    cache, and server wide updates, raise StorageUnavailable.
+
+    Methods
+    -------
+    start
+        Starts the background task that replays spooled writes
+    replay
+        Writes spooled writes to the backend, oldest first
+    stats
+        Returns the state of the breaker and the spool
+    '''
+
+    def __init__(self, backend, bus, spool_path=None, spool_size=1000):
+        self.backend = backend
+        self.bus = bus
+        self.cache = bus.cache
+        self.breaker = CircuitBreaker(backend.unavailable, outage=getattr(backend, 'outage', None))
+        self.spool = WriteSpool(spool_path, spool_size)
+        self.replaying = threading.Lock()
+        self.task = None
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.breaker.call(attribute, *args, **kwargs)
+
+    def guarded(self, method, *args, **kwargs):
+        return self.breaker.call(getattr(self.backend, method), *args, **kwargs)
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.recover_loop(loop))
+
+    async def recover_loop(self, loop):
+        while True:
+            await asyncio.sleep(self.breaker.reset_after)
+            if len(self.spool) > 0 or self.breaker.state != 'closed':
+                await loop.run_in_executor(None, self.recover)
+
+    def recover(self):
+        try:
+            self.guarded('ping')
+        except StorageUnavailable:
+            return
+        self.replay()
+
+    def replay(self):
+        '''Replays spooled writes in order until the spool is empty or the
+        database fails again. A write refused because the sheet changed in
+        the meantime is dropped, and one that fails for any other reason is
+        set aside, so that it cannot hold up the writes behind it. Returns
+        the number of writes replayed.
+        '''
+        if not self.replaying.acquire(blocking=False): #another thread is already replaying
+            return 0
+        replayed = 0
+        try:
+            while len(self.spool) > 0:
+                entry = self.spool.peek()
+                try:
+                    self.guarded(entry['method'], *entry['args'])
+                    self.spool.pop()
+                    replayed += 1
+                except StorageUnavailable:
+                    break
+                except SheetConflict:
+                    print("Dropped a spooled {} of a sheet changed since: {}".format(entry['method'], str(entry['args'][:2])))
+                    self.spool.pop(replayed=False)
+                    self.cache.evict(entry['args'][0], entry['args'][1])
+                except Exception as e:
+                    print("Set aside a spooled {} that failed: {}: {}".format(entry['method'], str(entry['args'][:2]), str(e)))
+                    self.spool.set_aside()
+                    if entry['method'] == 'update_fields': #the cached copies hold the change that failed
+                        for user_id, _ in entry['args'][1]:
+                            self.cache.evict(entry['args'][0], user_id)
+                    else:
+                        self.cache.evict(entry['args'][0], entry['args'][1])
+                if entry['method'] == 'update_fields':
+                    for user_id, _ in entry['args'][1]:
+                        self.bus.publish(entry['args'][0], user_id, None)
+                else:
+                    self.bus.publish(entry['args'][0], entry['args'][1], None)
+        finally:
+            self.spool.save()
+            self.replaying.release()
+        return replayed
+
+    def degraded(self):
+        '''Returns True if writes must be spooled because earlier writes are
+        still waiting, after trying to replay them.
+        '''
+        if len(self.spool) > 0 and self.breaker.state == 'closed':
+            self.replay()
+        return len(self.spool) > 0
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats.update(self.spool.stats())
+        return stats
+
+    def find(self, server_id, user_id, fields=None):
+        doc = self.cache.get(server_id, user_id, fields)
+        if doc is None and fields is not None: #partial sheets are not cached
+            return self.guarded('find', server_id, user_id, fields)
+        if doc is None:
+            doc = self.guarded('find', server_id, user_id)
+            if doc is not None:
+                self.cache.put(server_id, user_id, doc, doc.get('version', 0), keep_newer=True)
+        return doc
+
+    def find_many(self, server_id, user_ids):
+        docs = []
+        missing = []
+        for user_id in user_ids:
+            doc = self.cache.get(server_id, user_id)
+            if doc is None:
+                missing.append(user_id)
+            else:
+                docs.append(doc)
+        if len(missing) > 0:
+            for doc in self.guarded('find_many', server_id, missing):
+                self.cache.put(server_id, doc['user id'], doc, doc.get('version', 0), keep_newer=True)
+                docs.append(doc)
+        return docs
+
+    def changed(self, server_id, user_id, doc=None):
+        '''Updates the cache after a write, and tells other processes. If the
+        new sheet is not known, the cached copy is evicted and the event is
+        sent without a version, which makes every process evict its copy.
+        '''
+        if doc is None:
+            version = None
+            self.cache.evict(server_id, user_id)
+        else:
+            version = doc.get('version', 0)
+            self.cache.put(server_id, user_id, doc, version)
+        self.bus.publish(server_id, user_id, version)
+
+    def write(self, method, *args):
+        '''Makes a write through the breaker, unless writes are being spooled.
+        Returns True and the result if it was written, or False and None if
+        the database is unavailable and the write must be spooled instead.
+        '''
+        if not self.degraded():
+            try:
+                return True, self.guarded(method, *args)
+            except StorageUnavailable:
+                pass
+        return False, None
+
+    def save(self, server_id, user_id, doc):
+        written, _ = self.write('save', server_id, user_id, doc)
+        if not written:
+            self.spool.append('save', [server_id, user_id, doc])
+        self.changed(server_id, user_id, doc)
+
+    def patch(self, server_id, user_id, changes, doc=None, version=None):
+        try:
+            written, created = self.write('patch', server_id, user_id, changes, doc, version)
+        except SheetConflict: #the cached copy is out of date
+            self.cache.evict(server_id, user_id)
+            raise
+        if written:
+            self.changed(server_id, user_id, doc)
+            return created
+        cached = self.cache.get(server_id, user_id)
+        if version is not None and cached is not None and cached.get('version', 0) != version:
+            raise SheetConflict()
+        self.spool.append('patch', [server_id, user_id, changes, doc, version])
+        if cached is not None:
+            cached = copy.deepcopy(cached)
+            cached.update(changes)
+            doc = cached
+        self.changed(server_id, user_id, doc)
+        return False #whether the sheet is new is not known until the write is replayed
+
+    def update_fields(self, server_id, updates):
+        written, _ = self.write('update_fields', server_id, updates)
+        if written:
+            for user_id, _ in updates:
+                self.changed(server_id, user_id)
+            return
+        self.spool.append('update_fields', [server_id, [list(x) for x in updates]])
+        for user_id, fields in updates:
+            cached = self.cache.get(server_id, user_id)
+            if cached is not None:
+                cached = copy.deepcopy(cached)
+                cached.update(fields)
+                cached['version'] = cached.get('version', 0) + 1
+            self.changed(server_id, user_id, cached)
+
+    def delete(self, server_id, user_id):
+        written, _ = self.write('delete', server_id, user_id)
+        if not written:
+            self.spool.append('delete', [server_id, user_id])
+        self.changed(server_id, user_id)
+
+    def changed_server(self, server_id):
+        '''Evicts every cached sheet of a server after a server wide update,
+        and tells other processes to do the same.
+        '''
+        self.cache.evict_server(server_id)
+        self.bus.publish(server_id, None, None)
+
+    def award_beats(self, server_id, beats):
+        changed = self.guarded('award_beats', server_id, beats)
+        self.changed_server(server_id)
+        return changed
+
+    def remove_condition(self, server_id, condition):
+        changed = self.guarded('remove_condition', server_id, condition)
+        self.changed_server(server_id)
+        return changed
+
+    def heal_damage(self, server_id, field, amount):
+        changed = self.guarded('heal_damage', server_id, field, amount)
+        self.changed_server(server_id)
+        return changed
+
+    def restore_sheets(self, server_id, docs):
+        self.guarded('restore_sheets', server_id, docs)
+        self.changed_server(server_id)
+
+    def prune_sheets(self, server_id, user_ids):
+        removed = self.guarded('prune_sheets', server_id, user_ids)
+        self.changed_server(server_id)
+        return removed
+
+storage = None
+
+def get_storage():
+    global storage
+    if storage is None:
+        backend = os.environ.get('DB_BACKEND', 'mongo').lower()
+        timeout = float(os.environ.get('DB_TIMEOUT', 2))
+        if backend == 'sqlite':
+            backend = SQLiteStorage(os.environ.get('DB_PATH', 'godmachine.db'), timeout)
+            bus = get_bus()
+        else:
+            backend = MongoStorage(os.environ.get('DB_HOST'), int(os.environ.get('DB_PORT')), os.environ.get('DB_NAME'), timeout)
+            bus = get_bus(backend.db)
+        storage = CachedStorage(backend, bus, os.environ.get('SPOOL_PATH', 'write_spool.jsonl'), int(os.environ.get('SPOOL_SIZE', 1000)))
+    return storage
\ No newline at end of file